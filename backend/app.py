@@ -1,70 +1,440 @@
 import os
 import json
 import time
-import paramiko
-from flask import Flask, request, jsonify
+import queue
+import logging
+from flask import Blueprint, Flask, Response, g, request, jsonify, stream_with_context
 from flasgger import Swagger, swag_from
 from flask_cors import CORS
-from openai import OpenAI
 import pymongo
 
-app = Flask(__name__)
-swagger = Swagger(app)
-CORS(app)
+from chat_store import ChatStore, last_stored_seq
+from config_file import ConfigFile
+from context_window import ContextWindow
+from device_facts import DeviceFactsCache, changes_facts, format_facts
+from ssh_pool import DeviceConnectionPool
+from ssh_session import DEFAULT_OUTPUT_BUDGET, ExecutionSession
+from jobs import JobManager
+from model_router import (ESCALATE_FAILED_STEP, ESCALATE_HANDOFF, ESCALATE_INTERACTIVE, ESCALATE_PARSE_FAILURE,
+                          ESCALATE_VERIFY_ERROR, ModelRouter, parse_action)
+from plan import extract_tasks, is_interactive_command, looks_suspicious
+from response_cache import ResponseCache, plan_cache_key, request_cache_key
+from services import LazyServices
+from transcript import add_output, compact_messages, find_output
+import telemetry
+from telemetry import span, record_usage, start_thread
+
+# 所有路由定義於 api blueprint，由 create_app() 註冊到 Flask app
+api = Blueprint("api", __name__)
+logger = logging.getLogger(__name__)
 
 # === 1. 讀取 config.json 以取得敏感資訊 (例如 API Key) ===
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
-with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-    config = json.load(f)
-print("[INFO] 讀取 config.json 成功")
-
-# === 2. 建立 OpenAI 之 Client 物件 ===
-client_openai = OpenAI(api_key=config.get("OPENAI_API_KEY", ""))
-print("[INFO] OpenAI Client 建立成功")
-
-# === 3. 連線到 MongoDB ===
-mongo_uri = "mongodb://localhost:27017"  # 請根據環境調整
-mongo_client = pymongo.MongoClient(mongo_uri)
-db = mongo_client["myflaskdb"]
-chats_collection = db["chats"]
-print("[INFO] 連線到 MongoDB 成功")
-
-# === 幫助函式: 依 chat_id 取得聊天文件，若無則初始化 ===
-def init_chat_if_not_exists(chat_id):
-    chat_doc = chats_collection.find_one({"chat_id": chat_id})
-    if not chat_doc:
-        system_prompt = {
-            "role": "system",
-            "content": (
-                "你是 Assistant1，負責與使用者互動並回應使用者對於 Raspberry Pi 的需求；"
-                "但實際執行操作的工作由 Assistant2 代理完成。\n\n"
-                "規範如下：\n"
-                "1. 僅能以 Markdown 的形式回應，請務必使用適當的標題、段落與範例程式碼區塊。"
-                "2. 在給定指令時，請將需要執行的指令以「```bash ...```」格式包覆。"
-                "3. 第一行必須包含 cd 或其他完整路徑切換操作，並提供任何必要的 sudo 或安裝套件等指令；"
-                "   切勿要求使用者手動切換目錄或安裝套件。"
-                "4. 為了方便 Assistant2 自動執行，每個 Code Block 都必須是可以獨立執行的命令組合，"
-                "   並在同一區塊中加上操作步驟或說明。"
-                "5. 若指令需要多個步驟，請依照邏輯拆分成多個 Code Block，並在文字敘述中清楚解釋各步驟的意義與注意事項。"
-                "6. 若經確認使用者的需求無法僅透過 Raspberry Pi CLI (命令列) 完成，請禮貌拒絕並說明理由。\n\n"
-                "總結："
-                "請像在編寫教學文件 (README.md) 一樣，仔細撰寫可在 Raspberry Pi 上直接執行的程式碼區塊與文字解說；"
-                "Assistant2 會自動解析並執行你產生的 Code Block，因此務必確保其正確性與完整性。"
-            )
-        }
-        new_chat_doc = {
-            "chat_id": chat_id,
-            "messages": [system_prompt]
-        }
-        chats_collection.insert_one(new_chat_doc)
-        print(f"[INFO] 初始化聊天室 {chat_id} 完成")
-        return new_chat_doc
+# 可用環境變數 APP_CONFIG_PATH 指定其他設定檔 (例如 benchmark 使用的暫存設定)
+# 檔案修改後會自動重新載入：Device、DeviceGroups、OPENAI_API_KEY 與 Telemetry 立即生效，其他區塊需重新啟動
+CONFIG_PATH = os.environ.get("APP_CONFIG_PATH") or os.path.join(os.path.dirname(__file__), 'config.json')
+config = ConfigFile(CONFIG_PATH)
+
+# 結構化 log (每行一筆 JSON，附追蹤 ID)；Telemetry.log_format 設為 "text" 時改為單行文字
+def configure_logging(telemetry_config):
+    telemetry.configure_logging(
+        level=telemetry_config.get("log_level", "INFO"),
+        log_format=telemetry_config.get("log_format", "json"),
+    )
+
+if config.error is None:
+    logger.info("讀取 config.json 成功")
+
+# 外部服務 (OpenAI、MongoDB 以及需要建立索引的快取) 於第一次使用時才建立，匯入 app 不需要任何外部服務
+services = LazyServices()
+
+# === 2. OpenAI 之 Client 物件 (第一次呼叫 GPT 時建立，OPENAI_API_KEY 變更時重新建立) ===
+def openai_api_key():
+    return config.get("OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY", "")
+
+def create_openai_client():
+    # openai 套件匯入較慢 (約 1 秒)，延後到第一次呼叫 GPT 時
+    from openai import OpenAI
+    return OpenAI(api_key=openai_api_key())
+
+client_openai = services.register("OpenAI Client", create_openai_client)
+
+# === 3. MongoDB (第一次存取時連線；uri 可由環境變數 MONGODB_URI 覆寫) ===
+mongo_config = config.get("MongoDB", {})
+mongo_uri = os.environ.get("MONGODB_URI") or mongo_config.get("uri", "mongodb://localhost:27017")
+mongo_database = mongo_config.get("database", "myflaskdb")
+mongo_client = services.register(
+    "MongoDB Client", lambda: pymongo.MongoClient(mongo_uri, event_listeners=[telemetry.MongoCommandMetrics()]))
+db = services.register("MongoDB database", lambda: services.get("MongoDB Client")[mongo_database])
+
+# Assistant1 的系統提示；內容修改時請一併更新版本號，既有聊天室會沿用建立時的版本
+ASSISTANT1_PROMPT_VERSION = "assistant1-v2"
+ASSISTANT1_SYSTEM_PROMPT = (
+    "你是 Assistant1，負責與使用者互動並回應使用者對於 Raspberry Pi 的需求；"
+    "但實際執行操作的工作由 Assistant2 代理完成。\n\n"
+    "規範如下：\n"
+    "1. 僅能以 Markdown 的形式回應，請務必使用適當的標題、段落與範例程式碼區塊。"
+    "2. 在給定指令時，請將需要執行的指令以「```bash ...```」格式包覆。"
+    "3. 第一行必須包含 cd 或其他完整路徑切換操作，並提供任何必要的 sudo 或安裝套件等指令；"
+    "   切勿要求使用者手動切換目錄或安裝套件。"
+    "4. 為了方便 Assistant2 自動執行，每個 Code Block 都必須是可以獨立執行的命令組合，"
+    "   並在同一區塊中加上操作步驟或說明。"
+    "5. 若指令需要多個步驟，請依照邏輯拆分成多個 Code Block，並在文字敘述中清楚解釋各步驟的意義與注意事項。"
+    "6. 若經確認使用者的需求無法僅透過 Raspberry Pi CLI (命令列) 完成，請禮貌拒絕並說明理由。"
+    "7. 需要建立或修改檔案時，請在 Code Block 標頭加上 file=<路徑> 並提供完整的檔案內容，"
+    "   例如「```python file=/home/pi/Desktop/hello.py」，系統會直接寫入該檔案 (不存在的目錄會自動建立)；"
+    "   請勿使用 nano 等編輯器或 echo / cat > 檔案 的方式寫入。需要 root 權限的檔案 (例如 /etc 底下) 則以 bash Code Block 搭配 sudo tee 寫入。\n\n"
+    "總結："
+    "請像在編寫教學文件 (README.md) 一樣，仔細撰寫可在 Raspberry Pi 上直接執行的程式碼區塊與文字解說；"
+    "Assistant2 會自動解析並執行你產生的 Code Block，因此務必確保其正確性與完整性。"
+)
+
+# 聊天記錄改為逐筆附加 (messages collection)，system prompt 依版本只存一份
+# 索引與 system prompt 於第一次存取聊天記錄時建立
+chat_store = services.register(
+    "ChatStore", lambda: ChatStore(db, ASSISTANT1_PROMPT_VERSION, ASSISTANT1_SYSTEM_PROMPT))
+
+# 送給 Assistant1 的歷史訊息限制在 token 預算內，較舊的訊息於背景併入摘要
+context_config = config.get("Context", {})
+
+# === 4. 建立 SSH 連線池 (依 device_id 保留長連線，避免每次執行都重新握手) ===
+ssh_pool_config = config.get("SSHPool", {})
+ssh_pool = DeviceConnectionPool(
+    keepalive_interval=ssh_pool_config.get("keepalive_interval", 30),
+    max_channels_per_device=ssh_pool_config.get("max_channels_per_device", 4),
+    connect_timeout=ssh_pool_config.get("connect_timeout", 10),
+    acquire_timeout=ssh_pool_config.get("acquire_timeout", 60),
+)
+logger.info("SSH 連線池建立成功")
+
+# 遠端 shell 的逾時設定 (非互動式指令 / 互動式 shell)
+shell_config = config.get("Shell", {})
+
+# === 5. 建立背景工作佇列 (不同裝置平行執行，同一裝置依序執行) ===
+jobs_config = config.get("Jobs", {})
+job_manager = JobManager(
+    max_workers=jobs_config.get("max_workers", 4),
+    history_limit=jobs_config.get("history_limit", 200),
+)
+logger.info("背景工作佇列建立成功")
+
+# === 6. 裝置環境資訊快取 (OS、家目錄、已安裝套件等)，放入 Assistant1 / Assistant2 的 system prompt ===
+device_facts_config = config.get("DeviceFacts", {})
+device_facts = services.register("DeviceFactsCache", lambda: DeviceFactsCache(
+    db["device_facts"],
+    ttl_seconds=device_facts_config.get("ttl_seconds", 86400),
+    timeout=device_facts_config.get("timeout", 20),
+))
+
+# === 7. 回應快取：重複的 Assistant1 需求直接回傳先前的 Markdown，重複的計畫重播先前成功的動作 ===
+response_cache_config = config.get("ResponseCache", {})
+response_cache_enabled = response_cache_config.get("enabled", True)
+assistant1_cache = services.register("Assistant1 ResponseCache", lambda: ResponseCache(
+    db["assistant1_cache"],
+    ttl_seconds=response_cache_config.get("ttl_seconds", 604800),
+    max_entries=response_cache_config.get("max_entries", 500),
+))
+plan_cache = services.register("Plan ResponseCache", lambda: ResponseCache(
+    db["plan_cache"],
+    ttl_seconds=response_cache_config.get("ttl_seconds", 604800),
+    max_entries=response_cache_config.get("max_entries", 500),
+))
+
+# === 8. 模型設定：Assistant1 / 摘要各用一個模型，Assistant2 平常用較快的模型，必要時升級 ===
+model_router = ModelRouter(config.get("Models", {}), summary_model=context_config.get("summary_model"))
+logger.info(f"模型設定完成，Assistant2: {model_router.fast['model']} / {model_router.strong['model']}")
+
+# === 9. 設定檔變更：裝置設定、API Key 與 log 設定立即生效，其他區塊需重新啟動服務 ===
+RELOADABLE_CONFIG_KEYS = {"Device", "DeviceGroups", "OPENAI_API_KEY", "Telemetry"}
+
+def apply_config_change(old, new):
+    old_devices, new_devices = old.get("Device", {}), new.get("Device", {})
+    changed = sorted(device_id for device_id in set(old_devices) | set(new_devices)
+                     if old_devices.get(device_id) != new_devices.get(device_id))
+    for device_id in changed:
+        if device_id not in new_devices:
+            # 連線資訊變更的裝置由連線池在下次借出時重新連線；已移除的裝置直接捨棄連線
+            ssh_pool.invalidate(device_id)
+        if device_id in old_devices and services.created("DeviceFactsCache"):
+            device_facts.invalidate(device_id)
+    if changed:
+        logger.info(f"裝置設定已更新: {', '.join(changed)}")
+    if old.get("OPENAI_API_KEY") != new.get("OPENAI_API_KEY"):
+        services.reset("OpenAI Client")
+        logger.info("OPENAI_API_KEY 已更新")
+    if old.get("Telemetry") != new.get("Telemetry"):
+        configure_logging(new.get("Telemetry", {}))
+    restart_required = sorted(key for key in set(old) | set(new)
+                              if key not in RELOADABLE_CONFIG_KEYS and old.get(key) != new.get(key))
+    if restart_required:
+        logger.warning(f"{', '.join(restart_required)} 設定需重新啟動服務才會生效")
+
+config.on_change(apply_config_change)
+
+# === Assistant2 系統提示 ===
+ASSISTANT2_SYSTEM_PROMPT = (
+    "你是 Assistant2，你要解析markdown資訊並逐步回傳行動指令，指令將透過 Paramiko 於遠端連線並操作 Raspberry Pi 的 CLI。"
+    "你必須嚴格依照以下規範回覆，所有回覆均須以 JSON 格式輸出，且不得包含任何額外的 Markdown 或解說性文字。"
+    "所有 ExecuteCommand 與 ExecuteBatch 都會在同一個持續存在的 shell 中依序執行，cd 與 export 會延續到後續指令；"
+    "每次 CLI Output 都會附上 exit code 與目前工作目錄 (cwd)，因此不需要再以 ls 或 pwd 確認路徑切換是否成功。輸出指令時不可使用code block(```)，必須直接輸出純文字。\n\n"
+    "1. 當你要執行純 CLI 指令時，請回覆如下 JSON 格式：\n"
+    "{\"ExecuteCommand\": \"<打算執行之CLI指令>\"}\n"
+    "   若有多條可依序執行的非互動式指令，請以 ExecuteBatch 一次送出 (依序執行，任一條 exit code 非 0 即停止，其後的指令不會執行)：\n"
+    "{\"ExecuteBatch\": [\"<指令1>\", \"<指令2>\", \"<指令3>\"]}\n\n"
+    "2. 建立、修改或讀取檔案時，請優先使用以下動作 (透過 SFTP 直接讀寫，比 nano 或 echo > 檔案 更快速可靠)：\n"
+    "{\"WriteFile\": {\"path\": \"<檔案路徑>\", \"content\": \"<完整檔案內容>\", \"mode\": \"<選填，例如 755>\", \"append\": <選填，true 為附加於檔尾>}}\n"
+    "{\"ReadFile\": {\"path\": \"<檔案路徑>\", \"offset\": <選填，起始位元組>, \"length\": <選填，讀取位元組數>}}\n"
+    "   相對路徑以目前 cwd 為準，~ 代表家目錄，WriteFile 會自動建立不存在的目錄；ReadFile 過長時只回傳部分內容並註明剩餘位元組數，可再以 offset 讀取後續內容。"
+    "檔案以登入使用者的權限讀寫，需要 root 權限的檔案請改用 ExecuteCommand 搭配 sudo tee。\n\n"
+    "   當你要執行需要 invoke_shell() 的互動式命令（例如 crontab -e 等）時，請回覆如下 JSON 格式：\n"
+    "{\"ExecuteInvokeShellCommand\": \"<打算執行之指令>\"}\n"
+    "   若互動式程式仍在執行（例如 nano 畫面開啟中、等待 [Y/n] 確認），請以下列 JSON 格式將按鍵送入同一個互動式 shell：\n"
+    "{\"SendKeys\": [\"ctrl+x\", \"y\", \"enter\"]}\n"
+    "   可用按鍵名稱：enter、tab、esc、space、backspace、up、down、left、right、ctrl+<字母>，其他字串會原樣輸入。\n\n"
+    "3. 當你判斷命令執行發生錯誤時，請立刻回覆以下 JSON 格式（之後不再輸出任何 CLI 指令）：\n"
+    "{\"Error\": {\"ExecutedCommand\": \"<剛才執行的指令>\", \"RaspberryPiOutput\": \"<實際輸出結果>\", \"ExpectedBehavior\": \"<本應該看到或期望出現的結果描述>\"}}\n\n"
+    "4. 當目前 Task 順利完成時，請回覆以下 JSON 格式（之後不再輸出任何 CLI 指令）：\n"
+    "{\"Complete\": \"All commands executed successfully.\"}\n\n"
+    "5. 每次你僅能回覆一個動作 (一條指令、一個 ExecuteBatch 或一次檔案讀寫)。請依據 CLI Output 所附的 cwd 判斷是否需要切換目錄，以保證後續指令能夠正確執行。\n\n"
+    "6. 系統會將 Markdown 中的每個 Code Block 拆成一個 Task 依序指派給你，完整 Markdown 僅供理解上下文；"
+    "你只需完成目前指派的 Task，每次回覆僅提供一個動作；ExecuteBatch 中不可包含互動式指令。"
+    "系統可能已先直接執行目前 Task 的部分指令 (對話中以 ExecuteCommand / WriteFile 與其輸出呈現)，"
+    "此時請從尚未完成的步驟接手；若最後一條指令失敗，請判斷能否修正後繼續，否則回覆 Error。\n\n"
+    "7. Paramiko 功能說明：\n"
+    "   - 非互動式命令在持續存在的 shell session 中執行 (stdin 為 /dev/null，不會等待輸入)；\n"
+    "   - 使用 invoke_shell() 執行需要互動的命令（例如 nano、crontab），會自目前 cwd 開始；\n"
+    "   - 以 CLI Output 所附的 exit code 判斷指令是否成功 (0 為成功)；輸出過長時僅保留開頭與結尾，並標示省略的位元組數；\n"
+    "   - 你必須根據執行結果判斷是否需要回覆 Error 或 Complete 格式的訊息。\n\n"
+    "8. 每次 CLI Output 前都會標示步驟號碼 (例如 [步驟 3])；為節省篇幅，較早步驟的輸出只會保留開頭與結尾幾行的摘要。"
+    "若需要某個較早步驟的完整輸出才能判斷，請回覆：\n"
+    "{\"ShowOutput\": <步驟號碼>}\n\n"
+    "請務必依照以上規範回覆，所有回覆都必須僅以 JSON 格式輸出，且內容必須符合指定格式，不得包含任何額外文字。\n"
+    "切記編輯檔案請優先使用 WriteFile；若仍使用 ExecuteInvokeShellCommand 開啟編輯器等程式，一般都會需要以 SendKeys 輸出ctrl+某按鍵以保存並退出。\n\n"
+    "範例對話，假設目前 Task 為在桌面建立一hello.py會print Hello, World!:\n"
+    "User 回覆: Shell 已啟動 (cwd: /home/pi)\n"
+    "Assistant 回覆: {\"WriteFile\": {\"path\": \"Desktop/hello.py\", \"content\": \"print(\\\"Hello, World!\\\")\\n\"}}\n"
+    "User 回覆: [步驟 1] File Output (WriteFile /home/pi/Desktop/hello.py，已寫入 23 bytes)\n"
+    "Assistant 回覆: {\"ExecuteBatch\": [\"cd Desktop\", \"python3 hello.py\"]}\n"
+    "User 回覆: [步驟 2] Batch Output (已執行 2/2 條):\n"
+    "--- 1. cd Desktop (exit code: 0, cwd: /home/pi/Desktop)\n"
+    "--- 2. python3 hello.py (exit code: 0, cwd: /home/pi/Desktop)\n"
+    "Hello, World!\n"
+    "Assistant 回覆: {\"Complete\": \"All commands executed successfully.\"}"
+)
+
+# === 幫助函式: 取得裝置環境資訊；裝置不存在或無法取得時回傳 None ===
+def load_device_facts(device_id, collect=True):
+    device_info = config.get("Device", {}).get(device_id) if device_id else None
+    if not device_info:
+        return None
+    facts = device_facts.cached(device_id)
+    if facts is None and collect:
+        try:
+            with ssh_pool.lease(device_id, device_info) as ssh_client:
+                facts = device_facts.collect(device_id, ssh_client)
+        except Exception as e:
+            logger.error(f"無法取得裝置 {device_id} 的環境資訊: {e}")
+            return None
+    return facts
+
+def facts_system_messages(device_id, facts):
+    return [{"role": "system", "content": format_facts(device_id, facts)}] if facts else []
+
+# === 幫助函式: 取出 context_window.build() 結果中的對話脈絡 (摘要與最近訊息)，作為回應快取鍵的一部分 ===
+def conversation_context(messages, system_messages):
+    # build() 的結果依序為 system prompt、system_messages、摘要與最近訊息、本次的訊息
+    return messages[1 + len(system_messages):-1]
+
+# === 幫助函式: 呼叫 GPT 並記錄耗時與 token 用量 (purpose 區分 assistant1 / assistant2 / summary 等呼叫者) ===
+def create_chat_completion(purpose, **kwargs):
+    with span("openai.chat_completion", purpose=purpose, model=kwargs.get("model")) as current:
+        response = client_openai.chat.completions.create(**kwargs)
+        record_usage(getattr(response, "usage", None), kwargs.get("model"), purpose, current)
+        return response
+
+# === 幫助函式: 串流呼叫 GPT，逐一產生新的文字片段；token 用量由串流最後一個 chunk 取得 ===
+def stream_chat_completion(purpose, **kwargs):
+    with span("openai.chat_completion", purpose=purpose, model=kwargs.get("model"), stream=True) as current:
+        stream = client_openai.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        for chunk in stream:
+            record_usage(getattr(chunk, "usage", None), kwargs.get("model"), purpose, current)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if "first_token_ms" not in current.attributes:
+                    current.set(first_token_ms=round((time.monotonic() - current.started) * 1000, 2))
+                yield delta
+
+# === 幫助函式: 將較舊的對話併入聊天室摘要 ===
+SUMMARY_SYSTEM_PROMPT = (
+    "你負責維護使用者與 Assistant1 (Raspberry Pi 操作助理) 對話的摘要。"
+    "請將「先前摘要」與「新的對話」合併成一份精簡的繁體中文摘要，"
+    "保留使用者的需求、裝置與環境資訊、已執行的操作及其結果 (成功或錯誤)、尚未解決的問題；"
+    "省略寒暄與完整的程式碼內容，只輸出摘要本文。"
+)
+
+def summarize_conversation(previous_summary, messages):
+    transcript = "\n\n".join(f"[{m['role']}]\n{m['content']}" for m in messages)
+    response = create_chat_completion(
+        "summary",
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"先前摘要：\n{previous_summary or '(無)'}\n\n新的對話：\n{transcript}"}
+        ],
+        **model_router.kwargs("summary")
+    )
+    return response.choices[0].message.content
+
+context_window = ContextWindow(
+    chat_store,
+    summarize_conversation,
+    token_budget=context_config.get("token_budget", 6000),
+)
+
+# === 幫助函式: 將非互動式指令的執行結果整理成給 Assistant2 的訊息 ===
+def format_command_output(result, command_timeout):
+    combined_output = result.combined_output
+    if result.timed_out:
+        combined_output += f"\n[指令逾時 ({command_timeout} 秒)，已中止]"
+    return f"CLI Output (exit code: {result.exit_code}, cwd: {result.cwd}):\n{combined_output}"
+
+# === 幫助函式: 將 ExecuteBatch 各指令的執行結果整理成一則給 Assistant2 的訊息 ===
+def format_batch_output(commands, results, command_timeout):
+    lines = [f"Batch Output (已執行 {len(results)}/{len(commands)} 條):"]
+    for number, result in enumerate(results, start=1):
+        status = f"exit code: {result.exit_code}, cwd: {result.cwd}"
+        if result.timed_out:
+            status = f"指令逾時 ({command_timeout} 秒)，已中止"
+        lines.append(f"--- {number}. {result.command} ({status})")
+        if result.combined_output:
+            lines.append(result.combined_output)
+    if len(results) < len(commands):
+        lines.append("--- 未執行：" + "；".join(commands[len(results):]))
+    return "\n".join(lines)
+
+# === 幫助函式: 將 WriteFile / ReadFile 的結果整理成給 Assistant2 的訊息 ===
+def format_file_output(result):
+    if not result.ok:
+        return f"File Output ({result.action} {result.path} 失敗):\n{result.error}"
+    if result.action == "WriteFile":
+        mode = f"，權限 {result.mode:o}" if result.mode is not None else ""
+        return f"File Output (WriteFile {result.path}，已寫入 {result.size} bytes{mode})"
+    end = result.offset + len(result.data)
+    header = f"File Output (ReadFile {result.path}，bytes {result.offset}-{end} / 共 {result.size} bytes"
+    if result.remaining:
+        header += f"，尚有 {result.remaining} bytes 未讀取，可指定 offset {end} 繼續讀取"
+    if result.binary:
+        return header + "):\n[二進位檔案，未顯示內容]"
+    return f"{header}):\n{result.text}"
+
+# === 幫助函式: 將互動式 shell 的讀取結果整理成給 Assistant2 的訊息 ===
+def format_interactive_output(result):
+    if result.at_shell_prompt:
+        state = "已回到 shell 提示字元"
+    elif result.reason == "prompt":
+        state = "程式顯示輸入提示，等待輸入中，可使用 SendKeys"
+    elif result.reason == "idle":
+        state = "輸出已靜止但未偵測到提示字元 (全螢幕程式畫面或未換行的一行)，程式可能在等待輸入，可使用 SendKeys"
+    elif result.reason == "timeout":
+        state = "讀取逾時且未偵測到提示字元，程式可能仍在執行"
     else:
-        print(f"[INFO] 聊天室 {chat_id} 已存在")
-        return chat_doc
+        state = "互動式 shell 已關閉"
+    return f"CLI Output (interactive, {state}):\n{result.output}"
+
+# === 每個 HTTP 請求一個追蹤 ID (沿用前端或代理伺服器的 X-Request-ID)，並記錄請求耗時 ===
+@api.before_app_request
+def start_request_trace():
+    g.trace_token = telemetry.trace_id_var.set(request.headers.get("X-Request-ID") or telemetry.new_trace_id())
+    g.request_started = time.monotonic()
+
+@api.after_app_request
+def finish_request_trace(response):
+    response.headers["X-Trace-Id"] = telemetry.current_trace_id() or ""
+    if "request_started" in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        telemetry.HTTP_REQUEST_DURATION.observe(
+            time.monotonic() - g.request_started, method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
+
+@api.teardown_app_request
+def end_request_trace(exc):
+    if "trace_token" in g:
+        telemetry.trace_id_var.reset(g.pop("trace_token"))
+
+# === Prometheus 指標 API ===
+@api.route('/metrics', methods=['GET'])
+@swag_from({
+    'tags': ['Monitoring'],
+    'summary': 'Prometheus 指標 (GET)',
+    'description': (
+        "以 Prometheus text format 回傳：\n"
+        "- agent_span_duration_seconds：OpenAI 呼叫、SSH 連線 / 指令、SFTP 的耗時 (span, status)\n"
+        "- agent_llm_tokens_total：GPT 的 prompt / completion token 數 (model, purpose, type)\n"
+        "- agent_mongo_command_duration_seconds：MongoDB 指令耗時 (command, status)\n"
+        "- agent_http_request_duration_seconds：API 耗時 (method, endpoint, status)\n"
+        "- agent_executions_total / agent_execution_iterations：執行結果與每次執行的 Assistant2 回合數\n"
+        "- agent_tasks_total：Task 的完成方式 (direct / replayed / assistant2) 與狀態\n"
+        "- agent_cache_lookups_total：回應快取命中率 (cache, result)\n"
+        "- agent_model_escalations_total：Assistant2 改用 strong 模型的次數 (reason)"
+    ),
+    'produces': ['text/plain'],
+    'responses': {
+        200: {'description': 'Prometheus text format 0.0.4'}
+    }
+})
+def metrics():
+    return Response(telemetry.REGISTRY.render(), content_type=telemetry.CONTENT_TYPE)
+
+# === 健康檢查 API：liveness 只確認程序可回應，readiness 確認設定檔與 MongoDB 可用 ===
+HEALTH_CHECK_TIMEOUT = 2  # readiness 檢查 MongoDB 的逾時秒數
+
+@api.route('/health/live', methods=['GET'])
+@swag_from({
+    'tags': ['Monitoring'],
+    'summary': 'Liveness 檢查 (GET)',
+    'description': '不存取任何外部服務，程序可回應即回傳 200',
+    'responses': {
+        200: {'description': '服務運作中'}
+    }
+})
+def liveness():
+    return jsonify({"status": "alive"}), 200
+
+@api.route('/health/ready', methods=['GET'])
+@swag_from({
+    'tags': ['Monitoring'],
+    'summary': 'Readiness 檢查 (GET)',
+    'description': (
+        "確認 config.json 已成功載入、已設定 OPENAI_API_KEY，且 MongoDB 可連線 (第一次檢查時一併建立聊天記錄的索引)。"
+        "不會呼叫 OpenAI API 或連線到裝置。"
+    ),
+    'responses': {
+        200: {'description': '可接受請求，checks 為各項檢查結果'},
+        503: {'description': '尚未就緒，checks 中 ok 為 false 的項目附有錯誤原因'}
+    }
+})
+def readiness():
+    checks = {
+        # 設定檔改壞時仍以先前載入的設定運作，只回報錯誤
+        "config": {"ok": config.loaded, "devices": len(config.get("Device", {}))},
+        "openai": {"ok": bool(openai_api_key())},
+    }
+    if config.error is not None:
+        checks["config"]["error"] = config.error
+    if not checks["openai"]["ok"]:
+        checks["openai"]["error"] = "未設定 OPENAI_API_KEY"
+    try:
+        with pymongo.timeout(HEALTH_CHECK_TIMEOUT):
+            mongo_client.admin.command("ping")
+            services.get("ChatStore")
+        checks["mongodb"] = {"ok": True}
+    except Exception as e:
+        checks["mongodb"] = {"ok": False, "error": str(e)}
+    ready = all(check["ok"] for check in checks.values())
+    return jsonify({"status": "ready" if ready else "not_ready", "checks": checks}), 200 if ready else 503
 
 # === Assistant1 聊天 API ===
-@app.route('/assistant1/chat', methods=['POST'])
+@api.route('/assistant1/chat', methods=['POST'])
 @swag_from({
     'tags': ['Assistant1'],
     'summary': 'Assistant1聊天 (POST)',
@@ -78,7 +448,9 @@ def init_chat_if_not_exists(chat_id):
                 'type': 'object',
                 'properties': {
                     'chat_id': {'type': 'string', 'description': '用於區分多個聊天室的ID'},
-                    'user_message': {'type': 'string', 'description': '使用者對Raspberry Pi的自然語言需求'}
+                    'user_message': {'type': 'string', 'description': '使用者對Raspberry Pi的自然語言需求'},
+                    'device_id': {'type': 'string', 'description': '(選填) 目標裝置，其環境資訊會提供給 Assistant1 參考'},
+                    'use_cache': {'type': 'boolean', 'description': '(選填) 設為 false 時不讀取快取，重新呼叫 GPT 並以新回覆更新快取'}
                 }
             }
         }
@@ -90,7 +462,8 @@ def init_chat_if_not_exists(chat_id):
                 'type': 'object',
                 'properties': {
                     'assistant_markdown': {'type': 'string', 'description': 'Assistant1 的回覆Markdown'},
-                    'chat_id': {'type': 'string', 'description': '聊天室ID'}
+                    'chat_id': {'type': 'string', 'description': '聊天室ID'},
+                    'cached': {'type': 'boolean', 'description': '是否為快取的回覆 (未呼叫 GPT)'}
                 }
             }
         }
@@ -100,43 +473,145 @@ def assistant1_chat():
     data = request.json
     chat_id = data.get('chat_id', 'default')
     user_message = data.get('user_message', '')
-    print(f"[INFO] Assistant1 聊天，chat_id: {chat_id}")
+    device_id = data.get('device_id')
+    logger.info(f"Assistant1 聊天，chat_id: {chat_id}")
     
-    chat_doc = init_chat_if_not_exists(chat_id)
     user_msg = {"role": "user", "content": user_message}
-    chat_doc["messages"].append(user_msg)
+    facts = load_device_facts(device_id)
+    system_messages = facts_system_messages(device_id, facts)
+    messages = context_window.build(chat_id, user_msg, system_messages=system_messages)
+    cache_key = request_cache_key(user_message, facts, ASSISTANT1_PROMPT_VERSION,
+                                  conversation_context(messages, system_messages))
+    cached = assistant1_cache.get(cache_key) if response_cache_enabled and data.get('use_cache', True) else None
+    if response_cache_enabled and data.get('use_cache', True):
+        telemetry.CACHE_LOOKUPS.inc(cache="assistant1", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        logger.info("Assistant1 回覆命中快取，未呼叫 GPT")
+        chat_store.append(chat_id, user_msg, {"role": "assistant", "content": cached["markdown"]})
+        context_window.refresh_summary_async(chat_id, system_messages)
+        return jsonify({"assistant_markdown": cached["markdown"], "chat_id": chat_id, "cached": True}), 200
     
     try:
-        response = client_openai.chat.completions.create(
-            model="gpt-4o",
-            messages=chat_doc["messages"],
-            temperature=0.7
+        response = create_chat_completion(
+            "assistant1",
+            messages=messages,
+            **model_router.kwargs("assistant1")
         )
         assistant_reply = response.choices[0].message.content
-        print("[INFO] Assistant1 回覆取得成功")
+        logger.info("Assistant1 回覆取得成功")
         assistant_msg = {"role": "assistant", "content": assistant_reply}
-        chat_doc["messages"].append(assistant_msg)
-        
-        chats_collection.update_one(
-            {"chat_id": chat_id},
-            {"$set": {"messages": chat_doc["messages"]}}
-        )
+        chat_store.append(chat_id, user_msg, assistant_msg)
+        context_window.refresh_summary_async(chat_id, system_messages)
+        if response_cache_enabled:
+            assistant1_cache.put(cache_key, {"markdown": assistant_reply})
         
         return jsonify({
             "assistant_markdown": assistant_reply,
-            "chat_id": chat_id
+            "chat_id": chat_id,
+            "cached": False
         }), 200
         
     except Exception as e:
-        print(f"[ERROR] Assistant1 呼叫失敗: {e}")
+        logger.error(f"Assistant1 呼叫失敗: {e}")
         return jsonify({"error": str(e)}), 500
 
+# === Assistant1 聊天 API (SSE 串流版) ===
+@api.route('/assistant1/chat/stream', methods=['POST'])
+@swag_from({
+    'tags': ['Assistant1'],
+    'summary': 'Assistant1聊天 (POST, Server-Sent Events)',
+    'description': (
+        "參數與 /assistant1/chat 相同，但以 text/event-stream 逐步推送 GPT 產生的內容：\n"
+        "- delta：{text} 新產生的 Markdown 片段\n"
+        "- done：{assistant_markdown, chat_id, cached} 完整回覆，已寫入 MongoDB；命中快取時只會有一個 delta\n"
+        "- error：{error} 呼叫失敗"
+    ),
+    'produces': ['text/event-stream'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'chat_id': {'type': 'string', 'description': '用於區分多個聊天室的ID'},
+                    'user_message': {'type': 'string', 'description': '使用者對Raspberry Pi的自然語言需求'},
+                    'device_id': {'type': 'string', 'description': '(選填) 目標裝置，其環境資訊會提供給 Assistant1 參考'},
+                    'use_cache': {'type': 'boolean', 'description': '(選填) 設為 false 時不讀取快取，重新呼叫 GPT 並以新回覆更新快取'}
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {'description': 'text/event-stream 事件串流'}
+    }
+})
+def assistant1_chat_stream():
+    data = request.json
+    chat_id = data.get('chat_id', 'default')
+    user_message = data.get('user_message', '')
+    device_id = data.get('device_id')
+    use_cache = data.get('use_cache', True)
+    logger.info(f"Assistant1 串流聊天，chat_id: {chat_id}")
+    
+    events = queue.Queue()
+    
+    # 在背景執行緒接收 GPT 串流；即使前端中斷連線，完整回覆仍會寫入 MongoDB
+    def worker():
+        try:
+            user_msg = {"role": "user", "content": user_message}
+            facts = load_device_facts(device_id)
+            system_messages = facts_system_messages(device_id, facts)
+            messages = context_window.build(chat_id, user_msg, system_messages=system_messages)
+            cache_key = request_cache_key(user_message, facts, ASSISTANT1_PROMPT_VERSION,
+                                          conversation_context(messages, system_messages))
+            cached = assistant1_cache.get(cache_key) if response_cache_enabled and use_cache else None
+            if response_cache_enabled and use_cache:
+                telemetry.CACHE_LOOKUPS.inc(cache="assistant1", result="hit" if cached is not None else "miss")
+            if cached is not None:
+                logger.info("Assistant1 回覆命中快取，未呼叫 GPT")
+                chat_store.append(chat_id, user_msg, {"role": "assistant", "content": cached["markdown"]})
+                context_window.refresh_summary_async(chat_id, system_messages)
+                events.put(("delta", {"text": cached["markdown"]}))
+                events.put(("done", {"assistant_markdown": cached["markdown"], "chat_id": chat_id, "cached": True}))
+                return
+            parts = []
+            for delta in stream_chat_completion(
+                "assistant1",
+                messages=messages,
+                **model_router.kwargs("assistant1")
+            ):
+                parts.append(delta)
+                events.put(("delta", {"text": delta}))
+            assistant_reply = "".join(parts)
+            logger.info("Assistant1 串流回覆完成")
+            chat_store.append(chat_id, user_msg, {"role": "assistant", "content": assistant_reply})
+            context_window.refresh_summary_async(chat_id, system_messages)
+            if response_cache_enabled:
+                assistant1_cache.put(cache_key, {"markdown": assistant_reply})
+            events.put(("done", {"assistant_markdown": assistant_reply, "chat_id": chat_id, "cached": False}))
+        except Exception as e:
+            logger.error(f"Assistant1 串流呼叫失敗: {e}")
+            events.put(("error", {"error": str(e)}))
+        finally:
+            events.put(None)
+    
+    start_thread(worker)
+    return sse_response(queue_events(events))
+
 # === 查詢聊天室歷史 API ===
-@app.route('/assistant1/history/<string:chat_id>', methods=['GET'])
+@api.route('/assistant1/history/<string:chat_id>', methods=['GET'])
 @swag_from({
     'tags': ['Assistant1'],
     'summary': '查詢聊天室歷史 (GET, MongoDB)',
-    'description': '從 MongoDB chats_collection 中取出 messages',
+    'description': (
+        "從 MongoDB 取出聊天室訊息，可依序號分頁：\n"
+        "- 未指定游標：回傳最新的 limit 筆 (未指定 limit 時回傳全部)\n"
+        "- before：回傳 seq 小於 before 的最新 limit 筆 (向前載入較舊訊息)\n"
+        "- since：回傳 seq 大於 since 的 limit 筆 (增量更新)\n"
+        "回應包含最新訊息時會附上 ETag；帶 If-None-Match 且聊天室沒有新訊息時回傳 304。"
+    ),
     'parameters': [
         {
             'name': 'chat_id',
@@ -144,11 +619,16 @@ def assistant1_chat():
             'type': 'string',
             'required': True,
             'description': '聊天室 ID'
-        }
+        },
+        {'name': 'limit', 'in': 'query', 'type': 'integer', 'required': False, 'description': '最多回傳的訊息數'},
+        {'name': 'before', 'in': 'query', 'type': 'integer', 'required': False, 'description': '只回傳 seq 小於此值的訊息'},
+        {'name': 'since', 'in': 'query', 'type': 'integer', 'required': False, 'description': '只回傳 seq 大於此值的訊息'},
+        {'name': 'include_system', 'in': 'query', 'type': 'boolean', 'required': False,
+         'description': '是否在開頭附上 system prompt (預設 true)'}
     ],
     'responses': {
         200: {
-            'description': '回傳該聊天室的所有訊息陣列',
+            'description': '回傳該聊天室的訊息陣列與分頁資訊',
             'schema': {
                 'type': 'object',
                 'properties': {
@@ -158,28 +638,125 @@ def assistant1_chat():
                         'items': {
                             'type': 'object',
                             'properties': {
+                                'seq': {'type': 'integer'},
                                 'role': {'type': 'string'},
                                 'content': {'type': 'string'}
                             }
                         }
-                    }
+                    },
+                    'message_count': {'type': 'integer'},
+                    'first_seq': {'type': 'integer'},
+                    'last_seq': {'type': 'integer'},
+                    'has_older': {'type': 'boolean'},
+                    'has_newer': {'type': 'boolean'}
                 }
             }
-        }
+        },
+        304: {'description': '聊天室沒有新訊息 (If-None-Match 與目前 ETag 相同)'}
     }
 })
 def get_chat_history(chat_id):
-    chat_doc = chats_collection.find_one({"chat_id": chat_id})
-    if not chat_doc:
-        chat_doc = init_chat_if_not_exists(chat_id)
-    print(f"[INFO] 查詢聊天室 {chat_id} 歷史成功")
-    return jsonify({
+    args = history_args()
+    chat_doc = chat_store.init_chat(chat_id)
+    etag = history_etag(chat_id, chat_doc, args)
+    if history_unchanged(chat_doc, args, etag):
+        return history_not_modified(chat_id, etag)
+    
+    history = chat_store.page(chat_id, limit=args["limit"], before=args["before"], since=args["since"])
+    system_prompt = chat_store.system_prompt(chat_doc["system_prompt_version"]) if args["include_system"] else None
+    return history_response(chat_id, chat_doc, history, system_prompt, args, etag)
+
+# === 幫助函式: 聊天室歷史 API 的參數、ETag 與回應 (asyncio 版的 async_app 共用) ===
+def history_args():
+    return {
+        "limit": request.args.get("limit", type=int),
+        "before": request.args.get("before", type=int),
+        "since": request.args.get("since", type=int),
+        "include_system": request.args.get("include_system", "true").lower() not in ("0", "false", "no"),
+    }
+
+def history_etag(chat_id, chat_doc, args):
+    # 訊息只會附加，因此 (prompt 版本, 已寫入的最大序號) 即可代表聊天室目前的狀態；
+    # 首次載入 (limit) 與之後的增量更新 (since) 共用同一個 ETag，只有往前翻頁 (before) 的回應另外加上分頁參數
+    etag = f"{chat_id}:{chat_doc['system_prompt_version']}:{last_stored_seq(chat_doc)}:{int(args['include_system'])}"
+    if args["before"] is not None and args["since"] is None:
+        etag += f":{args['before']}:{args['limit'] or ''}"
+    return etag
+
+def history_unchanged(chat_doc, args, etag):
+    # since 落後於已寫入的序號時仍有新訊息要回傳，即使 ETag 相同也不回 304
+    return request.if_none_match.contains_weak(etag) and \
+        (args["since"] is None or args["since"] >= last_stored_seq(chat_doc))
+
+def history_not_modified(chat_id, etag):
+    logger.info(f"聊天室 {chat_id} 沒有新訊息，回傳 304")
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+def history_response(chat_id, chat_doc, history, system_prompt, args, etag):
+    message_count = chat_doc.get("message_count", 0)
+    stored_seq = last_stored_seq(chat_doc)
+    since = args["since"]
+    first_seq = history[0]["seq"] if history else None
+    last_seq = history[-1]["seq"] if history else None
+    if system_prompt is not None:
+        history.insert(0, {"role": "system", "content": system_prompt})
+    logger.info(f"查詢聊天室 {chat_id} 歷史成功，共 {len(history)} 筆")
+    response = jsonify({
         "chat_id": chat_id,
-        "history": chat_doc["messages"]
-    }), 200
+        "history": history,
+        "message_count": message_count,
+        "first_seq": first_seq,
+        "last_seq": last_seq,
+        "has_older": bool(first_seq and first_seq > 1),
+        "has_newer": (last_seq or since or 0) < stored_seq
+    })
+    # 僅在回應已包含最新訊息時附上 ETag，避免快取到尚未寫入完成的狀態
+    if (last_seq or since or 0) >= stored_seq and args["before"] is None:
+        response.set_etag(etag, weak=True)
+    return response, 200
+
+# === 聊天室列表 API ===
+@api.route('/assistant1/chats', methods=['GET'])
+@swag_from({
+    'tags': ['Assistant1'],
+    'summary': '聊天室列表 (GET, MongoDB)',
+    'description': '依最後更新時間由新到舊列出聊天室，只包含 id、標題、訊息數與最後更新時間',
+    'parameters': [
+        {'name': 'limit', 'in': 'query', 'type': 'integer', 'required': False, 'description': '最多回傳的聊天室數 (預設 50)'}
+    ],
+    'responses': {
+        200: {
+            'description': '聊天室列表',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'chats': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'chat_id': {'type': 'string'},
+                                'title': {'type': 'string'},
+                                'message_count': {'type': 'integer'},
+                                'updated_at': {'type': 'number'}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def list_chats():
+    limit = request.args.get("limit", 50, type=int)
+    chats = chat_store.list_chats(limit=limit)
+    logger.info(f"查詢聊天室列表成功，共 {len(chats)} 個")
+    return jsonify({"chats": chats}), 200
 
 # === Assistant2 執行 API ===
-@app.route('/assistant2/execute', methods=['POST'])
+@api.route('/assistant2/execute', methods=['POST'])
 @swag_from({
     'tags': ['Assistant2'],
     'summary': 'Assistant2 執行指令 (POST)',
@@ -209,14 +786,32 @@ def get_chat_history(chat_id):
             'type': 'string',
             'required': True,
             'description': 'Assistant1 產生的 Markdown 指令'
+        },
+        {
+            'name': 'async',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': '為 true 時僅將執行加入背景工作佇列並立即回傳 job_id (HTTP 202)'
         }
     ],
     'responses': {
+        '202': {
+            'description': '已加入背景工作佇列 (async=true)',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'job_id': {'type': 'string'},
+                    'status': {'type': 'string'}
+                }
+            }
+        },
         '200': {
             'description': 'Assistant2 執行完成，返回最終結果與更新後的聊天室記錄',
             'schema': {
                 'type': 'object',
                 'properties': {
+                    'job_id': {'type': 'string'},
                     'status': {'type': 'string'},
                     'final_result': {'type': 'string'},
                     'chat_id': {'type': 'string'},
@@ -237,184 +832,926 @@ def get_chat_history(chat_id):
     }
 })
 def assistant2_execute():
+    job, response = start_execution()
+    if response is not None:
+        return response
+    
+    # 同步模式：等待背景工作完成後回傳與以往相同的結果
+    job.done_event.wait()
+    return execution_response(job)
+
+# === 幫助函式: 讀取執行 API 的表單參數並加入背景工作佇列，回傳 (job, 立即回傳的回應) ===
+def start_execution():
     # 讀取表單參數（formData）
     chat_id = request.form.get("chat_id", "chat1")
     device_id = request.form.get("device_id", "Device1")
     markdown_content = request.form.get("markdown_content", "")
-    print(f"[INFO] Assistant2 執行 API 呼叫，chat_id: {chat_id}, device_id: {device_id}")
+    run_async = request.form.get("async", "false").lower() in ("1", "true", "yes")
+    logger.info(f"Assistant2 執行 API 呼叫，chat_id: {chat_id}, device_id: {device_id}")
+    
+    if device_id not in config.get("Device", {}):
+        return None, (jsonify({"error": f"Device {device_id} not found in config.json"}), 400)
+    job = submit_execution(chat_id, device_id, markdown_content)
+    if run_async:
+        return job, (jsonify({"job_id": job.job_id, "status": job.status}), 202)
+    return job, None
+
+# === 幫助函式: 已結束的執行工作之回應 ===
+def execution_response(job):
+    if job.status != "succeeded":
+        return jsonify({"error": job.error, "job_id": job.job_id}), job.status_code or 500
+    return jsonify({"job_id": job.job_id, **job.result}), 200
+
+# === Assistant2 執行 API (SSE 串流版) ===
+@api.route('/assistant2/execute/stream', methods=['POST'])
+@swag_from({
+    'tags': ['Assistant2'],
+    'summary': 'Assistant2 執行指令 (POST, Server-Sent Events)',
+    'description': (
+        "參數與 /assistant2/execute 相同，但以 text/event-stream 即時推送執行進度：\n"
+        "- job：{job_id, status} 已加入背景工作佇列\n"
+        "- task：{index, total, code, status} Task (Code Block) 狀態變化\n"
+        "- iteration：{iteration} 目前互動回合\n"
+        "- action：{type, command} Assistant2 選擇的動作\n"
+        "- output：{stream, text} 指令的即時輸出 (stdout / stderr / interactive)\n"
+        "- result：{exit_code, cwd, dropped_bytes} 非互動式指令執行完畢\n"
+        "- status：{status, final_result} Assistant2 結束互動\n"
+        "- done：{status, final_result, new_markdown, chat_id} 全部完成\n"
+        "- error：{error} 執行失敗\n"
+        "長時間無事件時會送出 SSE 註解作為 keepalive。"
+    ),
+    'produces': ['text/event-stream'],
+    'parameters': [
+        {'name': 'chat_id', 'in': 'formData', 'type': 'string', 'required': True, 'description': '聊天室 ID'},
+        {'name': 'device_id', 'in': 'formData', 'type': 'string', 'required': True, 'description': 'config.json 中定義的裝置 key'},
+        {'name': 'markdown_content', 'in': 'formData', 'type': 'string', 'required': True, 'description': 'Assistant1 產生的 Markdown 指令'}
+    ],
+    'responses': {
+        '200': {'description': 'text/event-stream 事件串流'}
+    }
+})
+def assistant2_execute_stream():
+    chat_id = request.form.get("chat_id", "chat1")
+    device_id = request.form.get("device_id", "Device1")
+    markdown_content = request.form.get("markdown_content", "")
+    logger.info(f"Assistant2 串流執行 API 呼叫，chat_id: {chat_id}, device_id: {device_id}")
+    
+    if device_id not in config.get("Device", {}):
+        return jsonify({"error": f"Device {device_id} not found in config.json"}), 400
+    # 執行在背景工作中進行；即使前端中斷連線，執行結果仍會寫入聊天記錄
+    job = submit_execution(chat_id, device_id, markdown_content)
+    return sse_response(job_events(job))
+
+# === Assistant2 多裝置執行 API ===
+@api.route('/assistant2/execute/fleet', methods=['POST'])
+@swag_from({
+    'tags': ['Assistant2'],
+    'summary': 'Assistant2 多裝置平行執行 (POST)',
+    'description': (
+        "將同一份 Markdown 平行執行於多台裝置 (device_ids 或 config.json 的 DeviceGroups 群組)，"
+        "同時執行的裝置數不超過 parallelism；全部結束後彙整各裝置結果寫入聊天記錄，並由 Assistant1 產生一次新 Markdown。"
+        "async=true 時立即回傳 job_id，可透過 /assistant2/jobs/<job_id> 與 /events 追蹤 (事件附帶 device_id)。"
+    ),
+    'parameters': [
+        {'name': 'chat_id', 'in': 'formData', 'type': 'string', 'required': True, 'description': '聊天室 ID'},
+        {'name': 'device_ids', 'in': 'formData', 'type': 'string', 'required': False, 'description': '以逗號分隔的裝置 key'},
+        {'name': 'group', 'in': 'formData', 'type': 'string', 'required': False, 'description': 'config.json 中 DeviceGroups 的群組名稱'},
+        {'name': 'markdown_content', 'in': 'formData', 'type': 'string', 'required': True, 'description': 'Assistant1 產生的 Markdown 指令'},
+        {'name': 'parallelism', 'in': 'formData', 'type': 'integer', 'required': False, 'description': '同時執行的裝置數上限'},
+        {'name': 'async', 'in': 'formData', 'type': 'boolean', 'required': False, 'description': '為 true 時立即回傳 job_id (HTTP 202)'}
+    ],
+    'responses': {
+        '202': {'description': '已加入背景工作佇列 (async=true)'},
+        '200': {
+            'description': '所有裝置執行結束，回傳彙整結果',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'job_id': {'type': 'string'},
+                    'status': {'type': 'string'},
+                    'completed': {'type': 'integer'},
+                    'total': {'type': 'integer'},
+                    'duration_seconds': {'type': 'number'},
+                    'devices': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'device_id': {'type': 'string'},
+                                'job_id': {'type': 'string'},
+                                'status': {'type': 'string'},
+                                'final_result': {'type': 'object'},
+                                'error': {'type': 'string'},
+                                'wait_seconds': {'type': 'number'},
+                                'run_seconds': {'type': 'number'}
+                            }
+                        }
+                    },
+                    'new_markdown': {'type': 'string'},
+                    'chat_id': {'type': 'string'}
+                }
+            }
+        },
+        '400': {'description': '裝置或群組不存在'}
+    }
+})
+def assistant2_execute_fleet():
+    chat_id = request.form.get("chat_id", "chat1")
+    markdown_content = request.form.get("markdown_content", "")
+    group = request.form.get("group", "")
+    run_async = request.form.get("async", "false").lower() in ("1", "true", "yes")
     
-    # 取得或初始化該聊天室記錄
-    chat_doc = init_chat_if_not_exists(chat_id)
+    if group:
+        device_ids = config.get("DeviceGroups", {}).get(group)
+        if device_ids is None:
+            return jsonify({"error": f"Device group {group} not found in config.json"}), 400
+    else:
+        device_ids = [d.strip() for d in request.form.get("device_ids", "").split(",") if d.strip()]
+    device_ids = list(dict.fromkeys(device_ids))
+    if not device_ids:
+        return jsonify({"error": "請提供 device_ids 或 group"}), 400
+    missing = [d for d in device_ids if d not in config.get("Device", {})]
+    if missing:
+        return jsonify({"error": f"Device {', '.join(missing)} not found in config.json"}), 400
+    parallelism = max(1, request.form.get("parallelism", jobs_config.get("fleet_parallelism", 4), type=int))
+    logger.info(f"Assistant2 多裝置執行 API 呼叫，chat_id: {chat_id}, 裝置: {device_ids}, 平行數: {parallelism}")
     
-    # 建立 Assistant2 對話初始訊息 (系統提示自行補全，此處以 "省略" 表示)
-    assistant2_system = (
-        "你是 Assistant2，你要解析markdown資訊並逐步回傳行動指令，指令將透過 Paramiko 於遠端連線並操作 Raspberry Pi 的 CLI。"
-        "你必須嚴格依照以下規範回覆，所有回覆均須以 JSON 格式輸出，且不得包含任何額外的 Markdown 或解說性文字。"
-        "此外，回覆的第一行務必包含 ls檢視當前位置，再接著進行其他完整路徑切換行為(若當下步驟需要)，完成路竟切換後也須ls檢視是先前ls之資訊不同以確保路徑切換成功，否則系統無法自動完成路徑切換。輸出指令時不可使用code block(```)，必須直接輸出純文字。\n\n"
-        "1. 當你要執行純 CLI 指令時，請回覆如下 JSON 格式：\n"
-        "{\"ExecuteCommand\": \"<打算執行之CLI指令>\"}\n\n"
-        "2. 當你要執行需要 invoke_shell() 的互動式命令（例如 nano、crontab 等）時，請回覆如下 JSON 格式：\n"
-        "{\"ExecuteInvokeShellCommand\": \"<打算執行之指令>\"}\n\n"
-        "3. 當你判斷命令執行發生錯誤時，請立刻回覆以下 JSON 格式（之後不再輸出任何 CLI 指令）：\n"
-        "{\"Error\": {\"ExecutedCommand\": \"<剛才執行的指令>\", \"RaspberryPiOutput\": \"<實際輸出結果>\", \"ExpectedBehavior\": \"<本應該看到或期望出現的結果描述>\"}}\n\n"
-        "4. 當所有任務順利完成時，請回覆以下 JSON 格式（之後不再輸出任何 CLI 指令）：\n"
-        "{\"Complete\": \"All commands executed successfully.\"}\n\n"
-        "5. 每次你僅能回覆一條指令。回覆的第一行必須包含檢查當前位置（例如 ls），並在需要時進行目錄切換或其他必要操作，以保證後續指令能夠正確執行。\n\n"
-        "6. 若 Markdown 中包含多個 Code Block，你應依序拆分並逐步執行，每次回覆僅提供一條指令，且不得混合多個指令。\n\n"
-        "7. Paramiko 功能說明：\n"
-        "   - 使用 exec_command() 執行非互動式命令；\n"
-        "   - 使用 invoke_shell() 執行需要互動的命令（例如 nano、crontab）；\n"
-        "   - 你必須根據執行結果判斷是否需要回覆 Error 或 Complete 格式的訊息。\n\n"
-        "請務必依照以上規範回覆，所有回覆都必須僅以 JSON 格式輸出，且內容必須符合指定格式，不得包含任何額外文字。\n"
-        "切記若是有使用ExecuteInvokeShellCommand，一般都會需要輸出ctrl+某案鍵以保存並退出shell。\n\n"
-        "範例對話，假設markdown資訊為在桌面建立一hello.py會print Hello, World!:\n"
-        "Assistant 回覆: {\"ExecuteCommand\": \"ls\"}\n"
-        "User 回覆: CLI Output:\nBookshelf\nDesktop\nDocuments\nDownloads\nhello.py\nMusic\nPictures\nPublic\nTemplates\nVideos\n"
-        "Assistant 回覆: {\"ExecuteCommand\": \"cd Desktop\"}\n"
-        "User 回覆: CLI Output:\n"
-        "Assistant 回覆: {\"ExecuteCommand\": \"echo 'print(\\\"Hello, World!\\\")' > hello.py\"}\n"
-        "User 回覆: CLI Output:\n"
-        "Assistant 回覆: {\"Complete\": \"All commands executed successfully.\"}"
+    job = job_manager.submit_detached(
+        lambda job: execute_markdown_on_fleet(chat_id, device_ids, markdown_content, parallelism, job),
+        metadata={"chat_id": chat_id, "device_ids": device_ids}
     )
-    messages = [
-        {"role": "system", "content": assistant2_system},
-        {"role": "user", "content": markdown_content}
-    ]
-    print("[INFO] Assistant2 對話初始訊息建立完成")
+    if run_async:
+        return jsonify({"job_id": job.job_id, "status": job.status}), 202
+    job.done_event.wait()
+    if job.status != "succeeded":
+        return jsonify({"error": job.error, "job_id": job.job_id}), job.status_code or 500
+    return jsonify({"job_id": job.job_id, **job.result}), 200
+
+# === 背景工作狀態查詢 API ===
+@api.route('/assistant2/jobs/<string:job_id>', methods=['GET'])
+@swag_from({
+    'tags': ['Assistant2'],
+    'summary': '查詢背景工作狀態 (GET)',
+    'description': '回傳工作狀態 (queued / running / succeeded / failed / cancelled)、各 Task 進度與最終結果',
+    'parameters': [
+        {'name': 'job_id', 'in': 'path', 'type': 'string', 'required': True, 'description': '工作 ID'}
+    ],
+    'responses': {
+        200: {'description': '工作狀態'},
+        404: {'description': '找不到該工作'}
+    }
+})
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(job_summary(job)), 200
+
+# === 取消背景工作 API ===
+@api.route('/assistant2/jobs/<string:job_id>/cancel', methods=['POST'])
+@swag_from({
+    'tags': ['Assistant2'],
+    'summary': '取消背景工作 (POST)',
+    'description': '排隊中的工作直接移除；執行中的工作會在下一個步驟開始前停止',
+    'parameters': [
+        {'name': 'job_id', 'in': 'path', 'type': 'string', 'required': True, 'description': '工作 ID'}
+    ],
+    'responses': {
+        200: {'description': '取消請求已送出，回傳目前工作狀態'},
+        404: {'description': '找不到該工作'}
+    }
+})
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    logger.info(f"已要求取消工作 {job_id}")
+    return jsonify(job_summary(job)), 200
+
+# === 背景工作事件串流 API (可用於重新連線) ===
+@api.route('/assistant2/jobs/<string:job_id>/events', methods=['GET'])
+@swag_from({
+    'tags': ['Assistant2'],
+    'summary': '背景工作事件串流 (GET, Server-Sent Events)',
+    'description': '自頭重播該工作的所有事件，格式與 /assistant2/execute/stream 相同',
+    'produces': ['text/event-stream'],
+    'parameters': [
+        {'name': 'job_id', 'in': 'path', 'type': 'string', 'required': True, 'description': '工作 ID'}
+    ],
+    'responses': {
+        200: {'description': 'text/event-stream 事件串流'},
+        404: {'description': '找不到該工作'}
+    }
+})
+def get_job_events(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return sse_response(job_events(job))
+
+# === 幫助函式: 將 Assistant2 執行加入背景工作佇列 ===
+def submit_execution(chat_id, device_id, markdown_content):
+    def run(job):
+        return execute_markdown(chat_id, device_id, markdown_content, emit=job.emit, cancel_event=job.cancel_event)
+    
+    job = job_manager.submit(device_id, run, metadata={"chat_id": chat_id})
+    logger.info(f"Assistant2 執行已加入背景工作佇列，job_id: {job.job_id}")
+    return job
+
+# === 幫助函式: 工作狀態摘要 (省略完整聊天記錄) ===
+def job_summary(job):
+    summary = job.to_dict()
+    if summary["result"]:
+        summary["result"] = {k: v for k, v in summary["result"].items() if k != "messages"}
+    return summary
+
+# === 幫助函式: 依序產生背景工作的事件，最後以 done 或 error 結束；None 代表 keepalive ===
+def job_events(job, keepalive_interval=15):
+    yield "job", {"job_id": job.job_id, "status": job.status}
+    index = 0
+    while True:
+        new_events = job.events_since(index, timeout=keepalive_interval)
+        index += len(new_events)
+        for item in new_events:
+            yield item
+        if new_events:
+            continue
+        if job.finished:
+            break
+        yield None
+    if job.status == "succeeded":
+        yield "done", {"job_id": job.job_id, **job_summary(job)["result"]}
+    else:
+        yield "error", {"job_id": job.job_id, "status": job.status, "error": job.error}
+
+# === 幫助函式: 依序產生佇列中的事件，直到收到 None 為止；逾時無事件時產生 None 作為 keepalive ===
+def queue_events(events, keepalive_interval=15):
+    while True:
+        try:
+            item = events.get(timeout=keepalive_interval)
+        except queue.Empty:
+            yield None
+            continue
+        if item is None:
+            break
+        yield item
+
+# === 幫助函式: 將 (event, data) 事件轉成 SSE 回應 ===
+def sse_response(events):
+    def generate():
+        for item in events:
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# === Assistant2 執行過程中的錯誤 (附帶 HTTP 狀態碼) ===
+class ExecutionError(Exception):
+    def __init__(self, message, status_code=500, connection_lost=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.connection_lost = connection_lost
+
+def execute_markdown(chat_id, device_id, markdown_content, emit=None, cancel_event=None):
+    """Assistant2 依 Assistant1 的 Markdown 與 Raspberry Pi 多輪互動，再由 Assistant1 產生新的 Markdown。
+
+    Markdown 中的每個 shell Code Block 成為一個 Task 依序執行，每個 Task 使用獨立的 Assistant2 對話；
+    任一 Task 失敗即清空剩餘的 Task queue，並將錯誤、當前 Task 與被清除的 Task 回報給 Assistant1。
+    emit(event, data) 會在每個階段被呼叫，供 SSE 串流即時推送；cancel_event 被設定時於下一步驟前停止。
+    失敗時拋出 ExecutionError。
+    """
+    emit = emit or (lambda event, data: None)
+    final_status, final_result = run_device_plan(device_id, markdown_content, emit, cancel_event)
+    emit("status", {"status": final_status, "final_result": final_result})
+    new_markdown, messages = report_to_assistant1(chat_id, final_status, final_result, device_id)
+    return {
+        "status": final_status,
+        "final_result": final_result,
+        "new_markdown": new_markdown,
+        "chat_id": chat_id,
+        "messages": messages
+    }
+
+# === 在單一裝置上執行 Markdown 的 Task queue，回傳 (final_status, final_result) ===
+def run_device_plan(device_id, markdown_content, emit, cancel_event=None):
+    # 建立 Task queue；若沒有 shell Code Block，則將整份 Markdown 視為單一 Task
+    tasks = extract_tasks(markdown_content) or [{"index": 1, "language": "markdown", "code": None}]
+    logger.info(f"建立 Task queue 完成，共 {len(tasks)} 個 Task")
     
     # 讀取 device 連線資訊
-    device_info = config["Device"].get(device_id)
+    device_info = config.get("Device", {}).get(device_id)
     if not device_info:
-        return jsonify({"error": f"Device {device_id} not found in config.json"}), 400
+        raise ExecutionError(f"Device {device_id} not found in config.json", 400)
     hostname = device_info.get("hostname")
-    username = device_info.get("username")
-    password = device_info.get("password")
-    print(f"[INFO] 讀取 Device {device_id} 連線資訊成功")
+    logger.info(f"讀取 Device {device_id} 連線資訊成功")
+    
+    # 自連線池借出 SSH 連線 (已有存活連線時直接沿用)
+    logger.info(f"自連線池取得 {hostname} 的連線 ...")
+    try:
+        ssh_client = ssh_pool.acquire(device_id, device_info, channels=ExecutionSession.CHANNELS)
+    except Exception as e:
+        raise ExecutionError(f"無法連線至 Raspberry Pi: {str(e)}")
+    logger.info("SSH 連線就緒")
+    
+    connection_lost = False
+    try:
+        # 建立本次執行共用的持續性 shell，cd / export 會延續到後續指令
+        try:
+            session = ExecutionSession(
+                ssh_client,
+                command_timeout=shell_config.get("command_timeout", 300),
+                output_budget=shell_config.get("output_budget", DEFAULT_OUTPUT_BUDGET),
+                interactive_options={
+                    "idle_timeout": shell_config.get("interactive_idle_timeout", 3.0),
+                    "hard_timeout": shell_config.get("interactive_hard_timeout", 120),
+                },
+            ).start()
+        except Exception as e:
+            connection_lost = True
+            raise ExecutionError(f"無法啟動遠端 shell: {str(e)}")
+        logger.info(f"持續性 shell 啟動成功，cwd: {session.cwd}")
+        
+        try:
+            facts = device_facts.get(device_id, ssh_client)
+        except Exception as e:
+            logger.error(f"無法取得裝置 {device_id} 的環境資訊: {e}")
+            facts = None
+        
+        # 記錄本次執行的指令，執行後若可能改變裝置環境則讓快取失效
+        executed = []
+        written = []
+        iterations = 0
+        def tracking_emit(event, data):
+            nonlocal iterations
+            if event == "iteration":
+                iterations += 1
+            elif event == "action" and data["type"] in ("ExecuteCommand", "ExecuteBatch", "ExecuteInvokeShellCommand"):
+                executed.extend(data["command"] if isinstance(data["command"], list) else [data["command"]])
+            elif event == "action" and data["type"] == "WriteFile":
+                written.append(data["command"])
+            emit(event, data)
+        
+        # 相同 Markdown 在此裝置上曾成功完成時，先重播當時的動作，結果與紀錄不同時才交給 Assistant2
+        cache_key = plan_cache_key(markdown_content, device_id)
+        cached_plan = plan_cache.get(cache_key) if response_cache_enabled else None
+        if response_cache_enabled:
+            telemetry.CACHE_LOOKUPS.inc(cache="plan", result="hit" if cached_plan is not None else "miss")
+        if cached_plan is not None:
+            logger.info("計畫命中快取，重播先前成功的執行紀錄")
+        recorded = []
+        try:
+            final_status, final_result = run_task_queue(
+                session, markdown_content, tasks, tracking_emit, cancel_event,
+                facts_message=format_facts(device_id, facts) if facts else None,
+                replay=cached_plan["tasks"] if cached_plan else None,
+                record=recorded
+            )
+            telemetry.EXECUTIONS.inc(status=final_status)
+            telemetry.EXECUTION_ITERATIONS.observe(iterations)
+            if response_cache_enabled:
+                if final_status == "Complete" and all(step["type"] in REPLAYABLE_ACTIONS and not step.get("suspicious")
+                                                      for steps in recorded for step in steps):
+                    plan_cache.put(cache_key, {"tasks": recorded})
+                elif cached_plan is not None:
+                    plan_cache.invalidate(cache_key)
+        finally:
+            session.close()
+            if written or any(changes_facts(command) for command in executed):
+                device_facts.invalidate(device_id)
+    except ExecutionError as e:
+        connection_lost = connection_lost or e.connection_lost
+        telemetry.EXECUTIONS.inc(status="Cancelled" if e.status_code == 409 else "Failed")
+        raise
+    finally:
+        ssh_pool.release(device_id, ExecutionSession.CHANNELS, discard=connection_lost)
+    return final_status, final_result
+
+# === 將執行結果記錄到聊天室，並由 Assistant1 產生新的 Markdown，回傳 (new_markdown, messages) ===
+def report_to_assistant1(chat_id, final_status, final_result, device_id=None):
+    # 僅將最終結果記錄到聊天室中
+    final_message = {"role": "user", "content": json.dumps({final_status: final_result}, ensure_ascii=False)}
+    # 執行後快取可能已失效，此處只使用仍有效的快取，不再連線蒐集
+    facts = load_device_facts(device_id, collect=False)
+    system_messages = facts_system_messages(device_id, facts)
+    window = context_window.build(chat_id, final_message, system_messages=system_messages)
+    chat_store.append(chat_id, final_message)
+    logger.info("聊天記錄更新完成，僅記錄最終結果")
+    
+    # 將聊天室的對話視窗 (摘要 + 最近訊息) 餵給 Assistant1 以產生新的 Markdown 回覆
+    try:
+        new_response = create_chat_completion(
+            "assistant1_report",
+            messages=window,
+            **model_router.kwargs("assistant1")
+        )
+    except Exception as e:
+        raise ExecutionError(f"Assistant1 呼叫失敗: {str(e)}")
+    new_markdown = new_response.choices[0].message.content
+    logger.info("Assistant1 產生新 Markdown 回覆成功")
+    assistant_msg = {"role": "assistant", "content": new_markdown}
+    chat_store.append(chat_id, assistant_msg)
+    context_window.refresh_summary_async(chat_id, system_messages)
+    # 對話視窗只用於這次的 Assistant1 呼叫；回應中的 messages 與先前相同，是聊天室的完整對話
+    return new_markdown, chat_store.history(chat_id)
+
+# === 多裝置執行：同一份 Markdown 平行執行於多台裝置，最後彙整回報 Assistant1 一次 ===
+def execute_markdown_on_fleet(chat_id, device_ids, markdown_content, parallelism, job):
+    """每台裝置各自成為一個子工作 (沿用同一裝置依序執行的規則)，同時執行的裝置數不超過 parallelism。
+
+    子工作的事件會附上 device_id 轉送到 job；job 被取消時一併取消所有子工作。
+    """
+    started_at = time.time()
+    pending = list(device_ids)
+    running = {}
+    finished = queue.Queue()
+    summaries = {}
+    
+    def submit_device(device_id):
+        def run(child):
+            def emit(event, data):
+                child.emit(event, data)
+                job.emit(event, {**data, "device_id": device_id})
+            return run_device_plan(device_id, markdown_content, emit, child.cancel_event)
+        
+        child = job_manager.submit(device_id, run, metadata={"chat_id": chat_id, "parent_job_id": job.job_id})
+        child.add_done_callback(finished.put)
+        running[child.job_id] = (device_id, child)
+        job.emit("device", {"device_id": device_id, "job_id": child.job_id, "status": "queued"})
+    
+    while pending or running:
+        while pending and len(running) < parallelism and not job.cancel_event.is_set():
+            submit_device(pending.pop(0))
+        if job.cancel_event.is_set():
+            for device_id, child in running.values():
+                job_manager.cancel(child.job_id)
+            for device_id in pending:
+                summaries[device_id] = {"device_id": device_id, "job_id": None, "status": "cancelled",
+                                        "final_result": None, "error": "工作已取消"}
+            pending = []
+        try:
+            child = finished.get(timeout=1)
+        except queue.Empty:
+            continue
+        device_id, _ = running.pop(child.job_id)
+        status, final_result = child.result if child.status == "succeeded" else (child.status, None)
+        summaries[device_id] = {
+            "device_id": device_id,
+            "job_id": child.job_id,
+            "status": status,
+            "final_result": final_result,
+            "error": child.error,
+            "wait_seconds": round((child.started_at or child.finished_at) - child.created_at, 3),
+            "run_seconds": round(child.finished_at - child.started_at, 3) if child.started_at else 0.0
+        }
+        job.emit("device", summaries[device_id])
+        logger.info(f"裝置 {device_id} 執行結束，狀態: {status}")
+    
+    if job.cancel_event.is_set():
+        raise ExecutionError("工作已取消", status_code=409)
+    
+    devices = [summaries[device_id] for device_id in device_ids]
+    completed = sum(1 for summary in devices if summary["status"] == "Complete")
+    final_status = "Complete" if completed == len(devices) else "Error"
+    final_result = {
+        summary["device_id"]: summary["final_result"] if summary["final_result"] is not None else summary["error"]
+        for summary in devices
+    }
+    emit_summary = {"status": final_status, "completed": completed, "total": len(devices)}
+    job.emit("status", {**emit_summary, "final_result": final_result})
+    new_markdown, messages = report_to_assistant1(chat_id, final_status, final_result)
+    return {
+        **emit_summary,
+        "final_result": final_result,
+        "devices": devices,
+        "duration_seconds": round(time.time() - started_at, 3),
+        "new_markdown": new_markdown,
+        "chat_id": chat_id,
+        "messages": messages
+    }
+
+# === 依序執行 Task queue，回傳 (final_status, final_result) ===
+def run_task_queue(session, markdown_content, tasks, emit, cancel_event=None, facts_message=None,
+                   replay=None, record=None):
+    """replay 為快取中各 Task 先前成功執行的動作 (重播至第一個結果不同的動作為止)；
+    record 不為 None 時會依序附上每個 Task 實際執行的動作，供之後重播。"""
+    total = len(tasks)
+    for position, task in enumerate(tasks):
+        emit("task", {"index": task["index"], "total": total, "code": task["code"], "status": "running"})
+        logger.info(f"開始執行 Task {task['index']}/{total}")
+        
+        # 每個 Task 使用獨立的暫時對話，完成後即捨棄
+        if task["code"] is None:
+            task_message = "請依上述 Markdown 逐步完成所有操作。"
+        elif task.get("file"):
+            task_message = f"目前 Task ({task['index']}/{total})：將以下內容寫入 {task['file']}\n{task['code']}"
+        else:
+            task_message = f"目前 Task ({task['index']}/{total})：\n{task['code']}"
+        messages = [{"role": "system", "content": ASSISTANT2_SYSTEM_PROMPT}]
+        if facts_message:
+            messages.append({"role": "system", "content": facts_message})
+        messages += [
+            {"role": "user", "content": markdown_content},
+            {"role": "user", "content": task_message},
+            {"role": "user", "content": f"Shell 已啟動 (cwd: {session.cwd})"}
+        ]
+        
+        # 快速路徑：重播快取的動作，或直接執行 code block 的指令，僅在互動式步驟或執行失敗時交由 Assistant2 接手
+        steps = []
+        replaying = replay is not None and position < len(replay)
+        direct = not replaying and task["code"] is not None and shell_config.get("direct_execution", True)
+        handoff = None
+        if replaying:
+            handoff, transcript = replay_steps(session, replay[position], emit, cancel_event, steps)
+            messages.extend(transcript)
+            if handoff:
+                # 第一個結果不同的動作之後，剩餘的 Task 改走一般流程
+                replay = None
+        elif direct and task.get("file"):
+            handoff, transcript = write_file_directly(session, task["file"], task["code"], emit, steps)
+            messages.extend(transcript)
+        elif direct:
+            handoff, transcript = run_commands_directly(session, task["commands"], emit, cancel_event, steps)
+            messages.extend(transcript)
+        if (replaying or direct) and handoff is None:
+            status, result = "Complete", "All commands executed successfully."
+            logger.info(f"Task {task['index']} 已{'重播' if replaying else '直接執行'}完成，未呼叫 Assistant2")
+        else:
+            if handoff:
+                messages.append({"role": "user", "content": handoff})
+            status, result = run_assistant2_loop(session, messages, emit, cancel_event, steps, escalate=bool(handoff))
+        if record is not None:
+            record.append(steps)
+        if replaying and handoff is None:
+            path = "replayed"
+        elif direct and handoff is None:
+            path = "direct"
+        else:
+            path = "assistant2"
+        telemetry.TASKS.inc(path=path, status=status)
+        emit("task", {"index": task["index"], "total": total, "code": task["code"], "status": status,
+                      "direct": direct and handoff is None, "replayed": replaying and handoff is None})
+        
+        if status != "Complete":
+            # 清空剩餘的 Task queue，並回報當前 Task 與被清除的 Task
+            cleared = tasks[position + 1:]
+            for skipped in cleared:
+                emit("task", {"index": skipped["index"], "total": total, "code": skipped["code"], "status": "Cleared"})
+            logger.info(f"Task {task['index']} 未完成 ({status})，清空剩餘 {len(cleared)} 個 Task")
+            return status, {
+                "Detail": result,
+                "CurrentTask": task["code"],
+                "ClearedTasks": [skipped["code"] for skipped in cleared]
+            }
+    return "Complete", "All commands executed successfully."
+
+# === 直接依序執行 Task 的指令，回傳 (handoff, transcript) ===
+def run_commands_directly(session, commands, emit, cancel_event=None, steps=None):
+    """handoff 為 None 表示所有指令都已成功執行；否則為交給 Assistant2 接手時的說明訊息。
+
+    transcript 以 Assistant2 的對話格式 (ExecuteCommand / CLI Output) 記錄已執行的指令，
+    讓 Assistant2 接手時能從中斷處繼續；steps 會附上已執行的動作 (供快取重播)。
+    """
+    steps = [] if steps is None else steps
+    def on_output(stream, text):
+        emit("output", {"stream": stream, "text": text})
     
-    # 建立 SSH 連線
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    print(f"[INFO] 嘗試連線到 {hostname} ...")
+    transcript = []
+    for command in commands:
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExecutionError("工作已取消", status_code=409)
+        if is_interactive_command(command):
+            logger.info(f"指令需要互動，交由 Assistant2 接手: {command}")
+            return f"下一條指令需要互動：{command}\n請接手完成目前 Task 剩餘的步驟。", transcript
+        
+        logger.info(f"直接執行 CLI 指令: {command}")
+        emit("action", {"type": "ExecuteCommand", "command": command, "direct": True})
+        try:
+            result = session.run(command, on_output=on_output)
+        except Exception as e:
+            raise ExecutionError(f"執行 CLI 指令失敗: {str(e)}", connection_lost=True)
+        output_message = format_command_output(result, session.command_timeout)
+        transcript.append({"role": "assistant", "content": json.dumps({"ExecuteCommand": command}, ensure_ascii=False)})
+        add_output(transcript, output_message)
+        # 與 replay_steps 相同：exit code 為 0 但輸出疑似含有錯誤訊息的步驟標記 suspicious，不寫入快取
+        suspicious = result.ok and looks_suspicious(result.combined_output)
+        step = {"type": "ExecuteCommand", "command": command, "ok": result.ok}
+        steps.append({**step, "suspicious": True} if suspicious else step)
+        emit("result", {"exit_code": result.exit_code, "cwd": result.cwd, "dropped_bytes": result.dropped_bytes})
+        logger.debug(f"{'成功' if result.ok else '失敗'}，省略 {result.dropped_bytes} bytes\n{output_message}")
+        
+        if not result.ok:
+            logger.info("指令執行失敗，交由 Assistant2 判斷")
+            return "上一條指令執行失敗，請判斷能否修正並完成目前 Task 剩餘的步驟，否則回覆 Error。", transcript
+        if suspicious:
+            logger.info("指令輸出可能含有錯誤訊息，交由 Assistant2 判斷")
+            return ("上一條指令的 exit code 為 0，但輸出可能含有錯誤訊息。"
+                    "請判斷是否成功，並完成目前 Task 剩餘的步驟，否則回覆 Error。"), transcript
+    return None, transcript
+
+# === 直接以 SFTP 寫入檔案 Task 的內容，回傳 (handoff, transcript) ===
+def write_file_directly(session, path, content, emit, steps=None):
+    """與 run_commands_directly 相同，寫入失敗 (例如權限不足) 時交由 Assistant2 接手。"""
+    steps = [] if steps is None else steps
+    logger.info(f"直接寫入檔案: {path}")
+    emit("action", {"type": "WriteFile", "command": path, "direct": True})
     try:
-        ssh_client.connect(hostname=hostname, username=username, password=password, port=22)
+        result = session.write_file(path, content)
     except Exception as e:
-        return jsonify({"error": f"無法連線至 Raspberry Pi: {str(e)}"}), 500
-    print("[INFO] SSH 連線建立成功")
+        raise ExecutionError(f"寫入檔案失敗: {str(e)}", connection_lost=True)
+    output_message = format_file_output(result)
+    transcript = [{"role": "assistant", "content": json.dumps(
+        {"WriteFile": {"path": path, "content": content}}, ensure_ascii=False)}]
+    add_output(transcript, output_message)
+    steps.append({"type": "WriteFile", "path": path, "content": content, "mode": None, "append": False, "ok": result.ok})
+    emit("result", {"path": result.path, "bytes": result.size, "error": result.error})
+    logger.debug(output_message)
+    if not result.ok:
+        logger.info("檔案寫入失敗，交由 Assistant2 判斷")
+        return "檔案寫入失敗，請判斷能否以其他方式 (例如 sudo tee) 完成目前 Task，否則回覆 Error。", transcript
+    return None, transcript
+
+# 可由快取重播的動作；使用過互動式 shell 的執行結果依賴畫面與時序，不會被快取
+REPLAYABLE_ACTIONS = {"ExecuteCommand", "ExecuteBatch", "WriteFile"}
+
+def batch_ok(commands, results):
+    return len(results) == len(commands) and all(result.ok for result in results)
+
+# === 依快取的執行紀錄重播 Task 的動作，回傳 (handoff, transcript) ===
+def replay_steps(session, recorded_steps, emit, cancel_event=None, steps=None):
+    """與 run_commands_directly 相同；某個動作的成功與否與紀錄不同，或指令成功但輸出可能含有錯誤訊息時
+    停止重播，交由 Assistant2 接手。後者會在 steps 中標記 suspicious，執行結束後捨棄這份執行紀錄。"""
+    steps = [] if steps is None else steps
+    def on_output(stream, text):
+        emit("output", {"stream": stream, "text": text})
+    
+    transcript = []
+    for step in recorded_steps:
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExecutionError("工作已取消", status_code=409)
+        action = step["type"]
+        logger.info(f"重播 {action}: {step.get('command', step.get('path'))}")
+        emit("action", {"type": action, "command": step.get("command", step.get("path")), "replayed": True})
+        try:
+            if action == "ExecuteCommand":
+                result = session.run(step["command"], on_output=on_output)
+                ok = result.ok
+                suspicious = ok and looks_suspicious(result.combined_output)
+                output_message = format_command_output(result, session.command_timeout)
+                emit("result", {"exit_code": result.exit_code, "cwd": result.cwd, "dropped_bytes": result.dropped_bytes})
+                payload = step["command"]
+            elif action == "ExecuteBatch":
+                results = session.run_batch(step["command"], on_output=on_output)
+                ok = batch_ok(step["command"], results)
+                suspicious = ok and any(looks_suspicious(result.combined_output) for result in results)
+                output_message = format_batch_output(step["command"], results, session.command_timeout)
+                for result in results:
+                    emit("result", {"exit_code": result.exit_code, "cwd": result.cwd, "dropped_bytes": result.dropped_bytes})
+                payload = step["command"]
+            else:
+                result = session.write_file(step["path"], step["content"], mode=step.get("mode"), append=step.get("append", False))
+                ok = result.ok
+                suspicious = False
+                output_message = format_file_output(result)
+                emit("result", {"path": result.path, "bytes": result.size, "error": result.error})
+                payload = {key: step[key] for key in ("path", "content", "mode", "append") if step.get(key) is not None}
+        except Exception as e:
+            raise ExecutionError(f"重播 {action} 失敗: {str(e)}", connection_lost=True)
+        transcript.append({"role": "assistant", "content": json.dumps({action: payload}, ensure_ascii=False)})
+        add_output(transcript, output_message)
+        steps.append({**step, "ok": ok, "suspicious": True} if suspicious else {**step, "ok": ok})
+        logger.debug(f"{'成功' if ok else '失敗'}\n{output_message}")
+        if ok != step["ok"]:
+            logger.info("重播結果與快取的執行紀錄不同，交由 Assistant2 接手")
+            return ("系統依先前成功的執行紀錄重播了上述動作，但上一個動作的結果與紀錄不同。"
+                    "請判斷並完成目前 Task 剩餘的步驟，否則回覆 Error。"), transcript
+        if suspicious:
+            # 與直接執行相同的檢查：exit code 為 0 但輸出可疑時不再信任這份執行紀錄
+            logger.info("重播的指令輸出可能含有錯誤訊息，捨棄快取的執行紀錄並交由 Assistant2 判斷")
+            return ("系統依先前成功的執行紀錄重播了上述動作，上一個動作的 exit code 為 0，但輸出可能含有錯誤訊息。"
+                    "請判斷是否成功，並完成目前 Task 剩餘的步驟，否則回覆 Error。"), transcript
+    return None, transcript
+
+# === 向 Assistant2 要求下一個動作，回傳 (parsed, model)；無法取得有效 JSON 時 parsed 為 None ===
+def request_assistant2_action(messages, escalate_reason=None):
+    """平常使用 fast 模型；escalate_reason 不為 None 時改用 strong 模型。
+
+    回覆無法解析時以 strong 模型重新要求 (最多 max_parse_retries 次)；fast 模型回覆 Error 時，
+    先以 strong 模型確認是否真的無法完成。重新要求不會把無效的回覆加入對話，也不計入互動回合數。
+    """
+    prompt = compact_messages(messages, keep_recent=shell_config.get("verbatim_outputs", 2))
+    parse_failures = 0
+    while True:
+        tier, kwargs = model_router.assistant2_kwargs(escalate_reason)
+        if escalate_reason:
+            telemetry.MODEL_ESCALATIONS.inc(reason=escalate_reason)
+        try:
+            response = create_chat_completion("assistant2", messages=prompt, **kwargs)
+        except Exception as e:
+            raise ExecutionError(f"OpenAI 呼叫失敗: {str(e)}")
+        assistant_reply = response.choices[0].message.content
+        logger.debug(f"Assistant2 回覆 ({kwargs['model']}):\n{assistant_reply}")
+        parsed = parse_action(assistant_reply)
+        if parsed is None:
+            parse_failures += 1
+            logger.error(f"JSON 解析失敗 ({kwargs['model']}，第 {parse_failures} 次)")
+            if parse_failures > model_router.max_parse_retries:
+                return None, kwargs["model"]
+            escalate_reason = ESCALATE_PARSE_FAILURE
+            continue
+        if "Error" in parsed and tier == "fast" and model_router.verify_errors and model_router.tiered:
+            logger.info(f"{kwargs['model']} 回覆 Error，改以 {model_router.strong['model']} 確認")
+            escalate_reason = ESCALATE_VERIFY_ERROR
+            continue
+        return parsed, kwargs["model"]
+
+# === 單一 Task 中 Assistant2 與 Raspberry Pi 的多輪互動，回傳 (final_status, final_result) ===
+def run_assistant2_loop(session, messages, emit, cancel_event=None, steps=None, escalate=False):
+    """steps 會依序附上 Assistant2 執行過的動作與其成功與否 (ReadFile / ShowOutput 不影響裝置，不記錄)。
+
+    escalate 為 True (直接執行失敗或遇到互動式指令而交由 Assistant2 接手) 時，第一回合即使用 strong 模型。
+    """
+    steps = [] if steps is None else steps
+    def on_output(stream, text):
+        emit("output", {"stream": stream, "text": text})
     
     max_iterations = 15
     iteration_count = 0
     final_status = "Incomplete"
     final_result = ""
+    escalate_reason = ESCALATE_HANDOFF if escalate else None
     
     while iteration_count < max_iterations:
+        if cancel_event is not None and cancel_event.is_set():
+            raise ExecutionError("工作已取消", status_code=409)
         iteration_count += 1
-        print(f"[INFO] Assistant2 互動回合 {iteration_count} 開始")
-        try:
-            response = client_openai.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0.7
-            )
-        except Exception as e:
-            ssh_client.close()
-            return jsonify({"error": f"OpenAI 呼叫失敗: {str(e)}"}), 500
-        
-        assistant_reply = response.choices[0].message.content
-        print(f"\n=== Assistant2 Reply (Iteration {iteration_count}) ===")
-        print(assistant_reply)
-        messages.append({"role": "assistant", "content": assistant_reply})
-        
-        trimmed_reply = assistant_reply.strip()
-        parsed = None
-        if trimmed_reply.startswith("{"):
-            try:
-                parsed = json.loads(trimmed_reply)
-            except Exception:
-                print("[ERROR] JSON 解析失敗")
-                parsed = None
+        logger.info(f"Assistant2 互動回合 {iteration_count} 開始")
+        emit("iteration", {"iteration": iteration_count, "max_iterations": max_iterations})
+        parsed, model = request_assistant2_action(messages, escalate_reason)
+        if parsed is None:
+            raise ExecutionError("Assistant2 回覆非 JSON 格式")
+        logger.info(f"Assistant2 ({model}) 回覆: {next(iter(parsed))}")
+        # 對話中只保留解析後的 JSON，避免模型額外輸出的文字影響後續回合
+        messages.append({"role": "assistant", "content": json.dumps(parsed, ensure_ascii=False)})
+        # 預設下一回合使用 fast 模型；動作失敗或互動式程式仍在執行時再升級
+        escalate_reason = None
         
         if parsed:
             if "Error" in parsed:
                 final_status = "Error"
                 final_result = parsed["Error"]
-                print("[INFO] Assistant2 回傳 Error，結束互動")
+                logger.info("Assistant2 回傳 Error，結束互動")
                 break
             elif "Complete" in parsed:
                 final_status = "Complete"
                 final_result = parsed["Complete"]
-                print("[INFO] Assistant2 回傳 Complete，結束互動")
+                logger.info("Assistant2 回傳 Complete，結束互動")
                 break
             elif "ExecuteCommand" in parsed:
                 command = parsed["ExecuteCommand"]
-                print(f"[INFO] 執行非互動式 CLI 指令: {command}")
+                logger.info(f"執行非互動式 CLI 指令: {command}")
+                emit("action", {"type": "ExecuteCommand", "command": command})
+                try:
+                    result = session.run(command, on_output=on_output)
+                except Exception as e:
+                    raise ExecutionError(f"執行 CLI 指令失敗: {str(e)}", connection_lost=True)
+                output_message = format_command_output(result, session.command_timeout)
+                add_output(messages, output_message)
+                steps.append({"type": "ExecuteCommand", "command": command, "ok": result.ok})
+                emit("result", {"exit_code": result.exit_code, "cwd": result.cwd, "dropped_bytes": result.dropped_bytes})
+                logger.debug(f"{'成功' if result.ok else '失敗'}，省略 {result.dropped_bytes} bytes\n{output_message}")
+                if not result.ok:
+                    escalate_reason = ESCALATE_FAILED_STEP
+            elif "ExecuteBatch" in parsed:
+                commands = parsed["ExecuteBatch"]
+                if not isinstance(commands, list) or not commands or \
+                        not all(isinstance(command, str) and command.strip() for command in commands):
+                    messages.append({"role": "user", "content": "ExecuteBatch 必須是非空的指令字串陣列"})
+                    escalate_reason = ESCALATE_PARSE_FAILURE
+                    continue
+                interactive = [command for command in commands if is_interactive_command(command)]
+                if interactive:
+                    messages.append({"role": "user", "content": "ExecuteBatch 中不可包含互動式指令，請改用 "
+                                     f"ExecuteInvokeShellCommand：{'；'.join(interactive)}"})
+                    escalate_reason = ESCALATE_INTERACTIVE
+                    continue
+                logger.info(f"批次執行 {len(commands)} 條 CLI 指令: {commands}")
+                emit("action", {"type": "ExecuteBatch", "command": commands})
                 try:
-                    stdin, stdout, stderr = ssh_client.exec_command(command)
-                    cmd_output = stdout.read().decode('utf-8', errors='ignore')
-                    cmd_err = stderr.read().decode('utf-8', errors='ignore')
-                    combined_output = (cmd_output + "\n" + cmd_err).strip()
+                    results = session.run_batch(commands, on_output=on_output)
                 except Exception as e:
-                    ssh_client.close()
-                    return jsonify({"error": f"執行 CLI 指令失敗: {str(e)}"}), 500
-                messages.append({"role": "user", "content": f"CLI Output:\n{combined_output}"})
-                print(f"[CMD OUTPUT]\n{combined_output}")
+                    raise ExecutionError(f"批次執行 CLI 指令失敗: {str(e)}", connection_lost=True)
+                for result in results:
+                    emit("result", {"exit_code": result.exit_code, "cwd": result.cwd, "dropped_bytes": result.dropped_bytes})
+                output_message = format_batch_output(commands, results, session.command_timeout)
+                add_output(messages, output_message)
+                steps.append({"type": "ExecuteBatch", "command": commands, "ok": batch_ok(commands, results)})
+                logger.debug(f"批次執行 {len(results)}/{len(commands)} 條\n{output_message}")
+                if not batch_ok(commands, results):
+                    escalate_reason = ESCALATE_FAILED_STEP
             elif "ExecuteInvokeShellCommand" in parsed:
                 command = parsed["ExecuteInvokeShellCommand"]
-                print(f"[INFO] 執行互動式指令 (invoke_shell): {command}")
+                logger.info(f"執行互動式指令 (invoke_shell): {command}")
+                emit("action", {"type": "ExecuteInvokeShellCommand", "command": command})
                 try:
-                    channel = ssh_client.invoke_shell()
-                    channel.send(command + "\n")
-                    time.sleep(2)
-                    output = ""
-                    while channel.recv_ready():
-                        output += channel.recv(1024).decode('utf-8', errors='ignore')
-                        time.sleep(0.5)
-                    channel.close()
+                    result = session.interactive_shell().send_line(command, on_output=on_output)
                 except Exception as e:
-                    ssh_client.close()
-                    return jsonify({"error": f"執行互動式 CLI 指令失敗: {str(e)}"}), 500
-                messages.append({"role": "user", "content": f"CLI Output:\n{output}"})
-                print(f"[CMD OUTPUT]\n{output}")
-        else:
-            ssh_client.close()
-            return jsonify({"error": "Assistant2 回覆非 JSON 格式"}), 500
+                    raise ExecutionError(f"執行互動式 CLI 指令失敗: {str(e)}", connection_lost=True)
+                add_output(messages, format_interactive_output(result))
+                steps.append({"type": "ExecuteInvokeShellCommand", "command": command})
+                logger.debug(f"({result.reason})\n{result.output}")
+                if not result.at_shell_prompt:
+                    escalate_reason = ESCALATE_INTERACTIVE
+            elif "SendKeys" in parsed:
+                keys = parsed["SendKeys"]
+                logger.info(f"傳送按鍵至互動式 shell: {keys}")
+                emit("action", {"type": "SendKeys", "command": keys})
+                if session.interactive is None:
+                    messages.append({"role": "user", "content": "CLI Output:\n尚未開啟互動式 shell，請先使用 ExecuteInvokeShellCommand"})
+                    escalate_reason = ESCALATE_INTERACTIVE
+                    continue
+                try:
+                    result = session.interactive.send_keys(keys, on_output=on_output)
+                except Exception as e:
+                    raise ExecutionError(f"傳送按鍵失敗: {str(e)}", connection_lost=True)
+                add_output(messages, format_interactive_output(result))
+                steps.append({"type": "SendKeys", "command": keys})
+                logger.debug(f"({result.reason})\n{result.output}")
+                if not result.at_shell_prompt:
+                    escalate_reason = ESCALATE_INTERACTIVE
+            elif "WriteFile" in parsed or "ReadFile" in parsed:
+                action = "WriteFile" if "WriteFile" in parsed else "ReadFile"
+                spec = parsed[action]
+                if not isinstance(spec, dict) or not isinstance(spec.get("path"), str) or not spec["path"].strip() \
+                        or (action == "WriteFile" and not isinstance(spec.get("content"), str)):
+                    messages.append({"role": "user", "content": f"{action} 必須包含 path" +
+                                     (" 與 content 字串" if action == "WriteFile" else " 字串")})
+                    escalate_reason = ESCALATE_PARSE_FAILURE
+                    continue
+                offset, length = spec.get("offset") or 0, spec.get("length")
+                if action == "ReadFile" and not (isinstance(offset, int) and (length is None or isinstance(length, int))):
+                    messages.append({"role": "user", "content": "ReadFile 的 offset 與 length 必須是整數"})
+                    escalate_reason = ESCALATE_PARSE_FAILURE
+                    continue
+                path = spec["path"]
+                logger.info(f"{action}: {path}")
+                emit("action", {"type": action, "command": path})
+                try:
+                    if action == "WriteFile":
+                        result = session.write_file(path, spec["content"], mode=spec.get("mode"),
+                                                    append=bool(spec.get("append")))
+                    else:
+                        result = session.read_file(path, offset=offset, length=length, on_output=on_output)
+                except Exception as e:
+                    raise ExecutionError(f"{action} 失敗: {str(e)}", connection_lost=True)
+                output_message = format_file_output(result)
+                add_output(messages, output_message)
+                if action == "WriteFile":
+                    steps.append({"type": "WriteFile", "path": path, "content": spec["content"], "mode": spec.get("mode"),
+                                  "append": bool(spec.get("append")), "ok": result.ok})
+                emit("result", {"path": result.path, "bytes": result.size if action == "WriteFile" else len(result.data),
+                                "error": result.error})
+                logger.debug(output_message)
+                if not result.ok:
+                    escalate_reason = ESCALATE_FAILED_STEP
+            elif "ShowOutput" in parsed:
+                step = parsed["ShowOutput"]
+                logger.info(f"Assistant2 要求步驟 {step} 的完整輸出")
+                emit("action", {"type": "ShowOutput", "command": str(step)})
+                content = find_output(messages, step) if isinstance(step, int) else None
+                if content is None:
+                    messages.append({"role": "user", "content": f"找不到步驟 {step} 的輸出"})
+                else:
+                    add_output(messages, f"步驟 {step} 的完整輸出：\n{content}")
+            else:
+                messages.append({"role": "user", "content": f"未知的動作：{', '.join(parsed)}，請依規範回覆"})
+                escalate_reason = ESCALATE_PARSE_FAILURE
         
-        print(f"[INFO] 回合 {iteration_count} 結束")
-    
-    ssh_client.close()
-    
-    # 僅將最終結果記錄到聊天室中
-    final_message = {"role": "user", "content": json.dumps({final_status: final_result}, ensure_ascii=False)}
-    chat_doc["messages"].append(final_message)
-    chats_collection.update_one(
-        {"chat_id": chat_id},
-        {"$set": {"messages": chat_doc["messages"]}}
-    )
-    print("[INFO] 聊天記錄更新完成，僅記錄最終結果")
-    
-    # 將更新後的聊天室記錄餵給 Assistant1 以產生新的 Markdown 回覆
-    try:
-        new_response = client_openai.chat.completions.create(
-            model="gpt-4o",
-            messages=chat_doc["messages"],
-            temperature=0.7
-        )
-    except Exception as e:
-        return jsonify({"error": f"Assistant1 呼叫失敗: {str(e)}"}), 500
-    new_markdown = new_response.choices[0].message.content
-    print("[INFO] Assistant1 產生新 Markdown 回覆成功")
-    chat_doc["messages"].append({"role": "assistant", "content": new_markdown})
-    chats_collection.update_one(
-        {"chat_id": chat_id},
-        {"$set": {"messages": chat_doc["messages"]}}
-    )
+        logger.info(f"回合 {iteration_count} 結束")
     
-    return jsonify({
-        "status": final_status,
-        "final_result": final_result,
-        "new_markdown": new_markdown,
-        "chat_id": chat_id,
-        "messages": chat_doc["messages"]
-    }), 200
+    return final_status, final_result
+
+# === 建立 Flask app：註冊路由、Swagger 文件與 CORS；外部服務於第一次使用時才連線 ===
+def create_app(setup_logging=True):
+    """setup_logging 為 True 時依 Telemetry 設定 log 格式 (會取代 root logger 的 handler)，
+    因此只在啟動服務時設定；匯入 app 的程式 (async_app、benchmark、test.py) 保留自己的 log 設定。"""
+    if setup_logging:
+        configure_logging(config.get("Telemetry", {}))
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(api)
+    Swagger(flask_app)
+    CORS(flask_app, expose_headers=["ETag", "X-Trace-Id"])
+    return flask_app
+
+# 供 async_app 轉交請求使用，匯入時不變更 log 設定
+app = create_app(setup_logging=False)
 
 if __name__ == '__main__':
+    configure_logging(config.get("Telemetry", {}))
     app.run(debug=True, port=5000)
@@ -0,0 +1,308 @@
+import asyncio
+import contextvars
+import io
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from flask import request, jsonify
+
+import app as wsgi
+import telemetry
+from chat_store import AsyncChatStore
+from response_cache import AsyncResponseCache, request_cache_key
+from telemetry import span, record_usage
+
+logger = logging.getLogger(__name__)
+
+# === asyncio 版服務 (ASGI)：等待 GPT、MongoDB 與執行結果時不佔用執行緒 ===
+# 與 app.py 共用 Flask 的路由、Swagger 文件、設定與背景工作佇列：
+# - /assistant1/chat、/assistant1/history/<chat_id>、/assistant2/execute 以 asyncio 處理
+#   (AsyncOpenAI、pymongo AsyncMongoClient；SSH 與其他阻塞操作交給有上限的執行緒池)
+# - 其餘路由 (含 /apidocs 與 SSE 串流) 交由原本的 Flask app 在執行緒池中處理
+async_config = wsgi.config.get("AsyncServer", {})
+blocking_executor = ThreadPoolExecutor(
+    max_workers=async_config.get("blocking_workers", 16), thread_name_prefix="async-blocking")
+wsgi_executor = ThreadPoolExecutor(
+    max_workers=async_config.get("wsgi_workers", 64), thread_name_prefix="async-wsgi")
+
+# 與 app.py 相同，client 於第一次使用時才建立
+services = wsgi.services
+
+
+def create_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=wsgi.openai_api_key())
+
+
+client_openai = services.register("AsyncOpenAI Client", create_openai_client)
+mongo_client = services.register(
+    "AsyncMongoClient", lambda: pymongo.AsyncMongoClient(wsgi.mongo_uri, event_listeners=[telemetry.MongoCommandMetrics()]))
+db = services.register("AsyncMongoClient database", lambda: services.get("AsyncMongoClient")[wsgi.mongo_database])
+chat_store = services.register("AsyncChatStore", lambda: AsyncChatStore(
+    db, wsgi.chat_store, wsgi.ASSISTANT1_PROMPT_VERSION, wsgi.ASSISTANT1_SYSTEM_PROMPT))
+assistant1_cache = services.register("Assistant1 AsyncResponseCache", lambda: AsyncResponseCache(
+    db["assistant1_cache"],
+    ttl_seconds=wsgi.response_cache_config.get("ttl_seconds", 604800),
+    max_entries=wsgi.response_cache_config.get("max_entries", 500),
+))
+
+
+def apply_config_change(old, new):
+    if old.get("OPENAI_API_KEY") != new.get("OPENAI_API_KEY"):
+        services.reset("AsyncOpenAI Client")
+
+
+wsgi.config.on_change(apply_config_change)
+
+
+# === 幫助函式: 在執行緒池中執行阻塞函式 (沿用目前的追蹤 ID) ===
+async def run_blocking(func, *args, executor=blocking_executor, context=None):
+    """context 指定時在同一個 contextvars.Context 中執行 (依序呼叫間需保留 Flask 的請求 context 時使用)。"""
+    # 空的 Context 為 falsy，不能以 or 判斷
+    context = contextvars.copy_context() if context is None else context
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, func, *args)
+
+
+# === 幫助函式: 非同步呼叫 GPT 並記錄耗時與 token 用量 ===
+async def create_chat_completion(purpose, **kwargs):
+    with span("openai.chat_completion", purpose=purpose, model=kwargs.get("model")) as current:
+        response = await client_openai.chat.completions.create(**kwargs)
+        record_usage(getattr(response, "usage", None), kwargs.get("model"), purpose, current)
+        return response
+
+
+# === 幫助函式: 等待背景工作結束，等待期間不佔用執行緒 ===
+async def wait_for_job(job):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(
+        lambda: done.done() or done.set_result(None)))
+    await done
+
+
+# === Assistant1 聊天 API (與 app.assistant1_chat 相同的參數與回應) ===
+async def assistant1_chat():
+    data = request.json
+    chat_id = data.get('chat_id', 'default')
+    user_message = data.get('user_message', '')
+    device_id = data.get('device_id')
+    logger.info(f"Assistant1 聊天 (asyncio)，chat_id: {chat_id}")
+
+    user_msg = {"role": "user", "content": user_message}
+    facts = await run_blocking(wsgi.load_device_facts, device_id)
+    system_messages = wsgi.facts_system_messages(device_id, facts)
+    messages = await wsgi.context_window.abuild(chat_store, chat_id, user_msg, system_messages=system_messages)
+    cache_key = request_cache_key(user_message, facts, wsgi.ASSISTANT1_PROMPT_VERSION,
+                                  wsgi.conversation_context(messages, system_messages))
+    use_cache = wsgi.response_cache_enabled and data.get('use_cache', True)
+    cached = await assistant1_cache.get(cache_key) if use_cache else None
+    if use_cache:
+        telemetry.CACHE_LOOKUPS.inc(cache="assistant1", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        logger.info("Assistant1 回覆命中快取，未呼叫 GPT")
+        await chat_store.append(chat_id, user_msg, {"role": "assistant", "content": cached["markdown"]})
+        wsgi.context_window.refresh_summary_async(chat_id, system_messages)
+        return jsonify({"assistant_markdown": cached["markdown"], "chat_id": chat_id, "cached": True}), 200
+
+    try:
+        response = await create_chat_completion(
+            "assistant1",
+            messages=messages,
+            **wsgi.model_router.kwargs("assistant1")
+        )
+        assistant_reply = response.choices[0].message.content
+        logger.info("Assistant1 回覆取得成功")
+        await chat_store.append(chat_id, user_msg, {"role": "assistant", "content": assistant_reply})
+        wsgi.context_window.refresh_summary_async(chat_id, system_messages)
+        if wsgi.response_cache_enabled:
+            await assistant1_cache.put(cache_key, {"markdown": assistant_reply})
+
+        return jsonify({
+            "assistant_markdown": assistant_reply,
+            "chat_id": chat_id,
+            "cached": False
+        }), 200
+
+    except Exception as e:
+        logger.error(f"Assistant1 呼叫失敗: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# === 查詢聊天室歷史 API (與 app.get_chat_history 相同的參數與回應) ===
+async def get_chat_history(chat_id):
+    args = wsgi.history_args()
+    chat_doc = await chat_store.init_chat(chat_id)
+    etag = wsgi.history_etag(chat_id, chat_doc, args)
+    if wsgi.history_unchanged(chat_doc, args, etag):
+        return wsgi.history_not_modified(chat_id, etag)
+
+    history = await chat_store.page(chat_id, limit=args["limit"], before=args["before"], since=args["since"])
+    system_prompt = await chat_store.system_prompt(chat_doc["system_prompt_version"]) if args["include_system"] else None
+    return wsgi.history_response(chat_id, chat_doc, history, system_prompt, args, etag)
+
+
+# === Assistant2 執行 API (與 app.assistant2_execute 相同的參數與回應) ===
+async def assistant2_execute():
+    # SSH 與 Assistant2 的互動在背景工作佇列 (Jobs.max_workers) 中執行，這裡只等待結果
+    job, response = wsgi.start_execution()
+    if response is not None:
+        return response
+    await wait_for_job(job)
+    return wsgi.execution_response(job)
+
+
+# 以 asyncio 處理的 Flask endpoint；路由比對與 Swagger 文件仍以 app.py 的定義為準
+ASYNC_VIEWS = {
+    "api.assistant1_chat": assistant1_chat,
+    "api.get_chat_history": get_chat_history,
+    "api.assistant2_execute": assistant2_execute,
+}
+
+
+# === ASGI 介面 ===
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    body = await read_body(receive)
+    environ = build_environ(scope, body)
+    ctx = wsgi.app.request_context(environ)
+    ctx.push()
+    view = ASYNC_VIEWS.get(request.endpoint) if request.method in ("GET", "POST") else None
+    if view is None or request.routing_exception is not None:
+        ctx.pop()
+        await call_wsgi(environ, send)
+        return
+    try:
+        # 依序執行 Flask 的 before_request (追蹤 ID)、view 與 after_request (CORS、ETag、耗時指標)
+        try:
+            response = wsgi.app.preprocess_request()
+            if response is None:
+                response = await view(**request.view_args)
+        except Exception as e:
+            # 與 Flask 相同：HTTPException (例如 400 / 415) 照常回應，其他例外回傳 500
+            try:
+                response = wsgi.app.handle_user_exception(e)
+            except Exception as unhandled:
+                response = wsgi.app.handle_exception(unhandled)
+        response = wsgi.app.process_response(wsgi.app.make_response(response))
+        await send_response(send, response.status_code, response.headers.items(), [response.get_data()])
+    finally:
+        ctx.pop()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # 由 ASGI 伺服器啟動時才設定 log 格式，匯入 async_app 不會變更 log 設定
+            wsgi.configure_logging(wsgi.config.get("Telemetry", {}))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            blocking_executor.shutdown(wait=False)
+            wsgi_executor.shutdown(wait=False)
+            if services.created("AsyncMongoClient"):
+                await mongo_client.close()
+            if services.created("AsyncOpenAI Client"):
+                await client_openai.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+def build_environ(scope, body):
+    """依 PEP 3333 將 ASGI 的 HTTP scope 轉成 WSGI environ。"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def send_response(send, status, headers, chunks):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def call_wsgi(environ, send):
+    """在 wsgi_executor 中執行 Flask app；回應內容逐塊讀取，SSE 串流可即時送出。"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+        return lambda data: None
+
+    def next_chunk(iterator):
+        return next(iterator, None)
+
+    # stream_with_context 會在第一次讀取時推入請求 context，之後的讀取與 close 必須在同一個 Context
+    context = contextvars.copy_context()
+    result = await run_blocking(wsgi.app, environ, start_response, executor=wsgi_executor, context=context)
+    iterator = iter(result)
+    try:
+        chunk = await run_blocking(next_chunk, iterator, executor=wsgi_executor, context=context)
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in started["headers"]],
+        })
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await run_blocking(next_chunk, iterator, executor=wsgi_executor, context=context)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await run_blocking(result.close, executor=wsgi_executor, context=context)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=async_config.get("host", "127.0.0.1"), port=async_config.get("port", 5000))
@@ -0,0 +1,107 @@
+import threading
+import time
+import types
+
+from context_window import count_tokens
+
+
+def _usage(prompt_tokens, completion_tokens):
+    return types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                 total_tokens=prompt_tokens + completion_tokens)
+
+
+# === 取代 client_openai 的本機假 LLM：依劇本回放 Assistant1 / Assistant2 的回覆 ===
+class ScriptedLLM:
+    """與 OpenAI client 介面相同 (client.chat.completions.create)，依 system prompt 判斷呼叫者：
+
+    - Assistant2：依序回放劇本的 assistant2 回覆；每個 Task 的對話各自從第一則開始，用完後回覆 Complete。
+    - Assistant1：聊天時回覆劇本的 markdown，收到執行結果 ({"Complete": ...} / {"Error": ...}) 時回覆 report。
+    - 摘要：回覆固定的摘要文字。
+
+    每次呼叫會等待 latency + 每個輸出 token token_latency 秒，並以 count_tokens 計算 usage。
+    """
+
+    def __init__(self, scenarios, latency=0.5, token_latency=0.0):
+        self.scenarios = {scenario["markdown"]: scenario for scenario in scenarios}
+        self.default_scenario = scenarios[0]
+        self.latency = latency
+        self.token_latency = token_latency
+        self.calls = []
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, model, messages, stream=False, **kwargs):
+        started = time.monotonic()
+        kind, reply = self._reply(messages)
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        completion_tokens = count_tokens(reply)
+        delay = self.latency + self.token_latency * completion_tokens
+        if stream:
+            include_usage = (kwargs.get("stream_options") or {}).get("include_usage", False)
+            return self._stream(model, kind, reply, prompt_tokens, completion_tokens, delay, started, include_usage)
+        time.sleep(delay)
+        self._record(model, kind, prompt_tokens, completion_tokens, started)
+        message = types.SimpleNamespace(role="assistant", content=reply)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=_usage(prompt_tokens, completion_tokens),
+        )
+
+    def _stream(self, model, kind, reply, prompt_tokens, completion_tokens, delay, started, include_usage):
+        pieces = [reply[index:index + 16] for index in range(0, len(reply), 16)] or [""]
+        for piece in pieces:
+            time.sleep(delay / len(pieces))
+            delta = types.SimpleNamespace(content=piece)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(index=0, delta=delta, finish_reason=None)],
+                                        usage=None)
+        if include_usage:
+            # 與 OpenAI 相同：stream_options.include_usage 時最後多一個 choices 為空、附上 usage 的 chunk
+            yield types.SimpleNamespace(choices=[], usage=_usage(prompt_tokens, completion_tokens))
+        self._record(model, kind, prompt_tokens, completion_tokens, started)
+
+    def _record(self, model, kind, prompt_tokens, completion_tokens, started):
+        with self._lock:
+            self.calls.append({
+                "model": model,
+                "kind": kind,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "seconds": time.monotonic() - started,
+            })
+
+    def _reply(self, messages):
+        system_prompt = messages[0]["content"]
+        if system_prompt.startswith("你是 Assistant2"):
+            return "assistant2", self._assistant2_reply(messages)
+        if "摘要" in system_prompt and not system_prompt.startswith("你是 Assistant1"):
+            return "summary", "使用者請 Assistant1 在 Raspberry Pi 上執行例行操作，皆已完成。"
+        last = messages[-1]["content"]
+        for scenario in self.scenarios.values():
+            if scenario["user_message"] == last:
+                return "assistant1", scenario["markdown"]
+        if last.startswith(('{"Complete"', '{"Error"')):
+            return "assistant1_report", self.default_scenario["report"]
+        return "assistant1", self.default_scenario["markdown"]
+
+    def _assistant2_reply(self, messages):
+        # 對話以 (執行緒, Markdown, Task) 區分；同一個 Task 的對話每回合都比上一回合長，變短即為新的對話
+        markdown = next(message["content"] for message in messages[1:] if message["role"] == "user")
+        task = next((message["content"] for message in messages
+                     if message["content"].startswith(("目前 Task", "請依上述 Markdown"))), "")
+        key = (threading.get_ident(), markdown, task)
+        scenario = self.scenarios.get(markdown, self.default_scenario)
+        with self._lock:
+            index, length = self._cursors.get(key, (0, None))
+            if length is None or len(messages) <= length:
+                index = 0
+            self._cursors[key] = (index + 1, len(messages))
+        replies = scenario["assistant2"]
+        if index < len(replies):
+            return replies[index]
+        return '{"Complete": "All commands executed successfully."}'
+
+    def reset_stats(self):
+        with self._lock:
+            calls, self.calls = self.calls, []
+        return calls
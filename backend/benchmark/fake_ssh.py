@@ -0,0 +1,207 @@
+import errno
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+
+# === 本機 SSH 伺服器：在 sandbox 目錄中以 bash 執行指令，取代實體 Raspberry Pi ===
+class SandboxSSHServer:
+    """每個登入帳號對應 sandbox_root 底下的一個家目錄 (例如 pi1 → <sandbox_root>/pi1)，任何密碼皆可登入。
+
+    指令以本機 bash 執行，只是把家目錄與工作目錄限制在 sandbox 內，並非安全隔離，僅供 benchmark 劇本使用。
+    SFTP 只能存取該帳號的家目錄。
+    """
+
+    def __init__(self, sandbox_root, host="127.0.0.1", port=0):
+        self.sandbox_root = os.path.realpath(sandbox_root)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+        self._transports = []
+        self._closed = False
+
+    def home(self, username):
+        path = os.path.join(self.sandbox_root, username)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def start(self):
+        self.sock.listen(100)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def close(self):
+        self._closed = True
+        self.sock.close()
+        for transport in self._transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", SFTPServer, SandboxSFTP)
+            transport.start_server(server=_SessionHandler(self))
+            self._transports.append(transport)
+
+
+class _SessionHandler(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+        self.home = None
+
+    def check_auth_password(self, username, password):
+        self.home = self.server.home(username)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._spawn(channel, ["bash", "-c", command.decode("utf-8")], merge_stderr=False)
+        return True
+
+    def check_channel_shell_request(self, channel):
+        # invoke_shell：以互動式 bash 模擬登入 shell，提示字元與 Raspberry Pi 相同格式
+        self._spawn(channel, ["bash", "--noprofile", "--norc", "-i"], merge_stderr=True, prompt="pi@sandbox:\\w$ ")
+        return True
+
+    def _spawn(self, channel, argv, merge_stderr, prompt=None):
+        env = {"HOME": self.home, "PATH": os.environ.get("PATH", "/usr/bin:/bin"), "LANG": "C.UTF-8", "TERM": "xterm"}
+        if prompt:
+            env["PS1"] = prompt
+        process = subprocess.Popen(
+            argv, cwd=self.home, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+        )
+        threading.Thread(target=_serve_channel, args=(channel, process), daemon=True).start()
+
+
+def _pump(source, send):
+    closed = False
+    while True:
+        data = os.read(source.fileno(), 65536)
+        if not data:
+            return
+        if not closed:
+            try:
+                send(data)
+            except OSError:
+                # 用戶端已關閉 channel (例如逾時中止)：繼續讀取並丟棄輸出，避免程序卡在寫入
+                closed = True
+
+
+def _serve_channel(channel, process):
+    def feed():
+        while True:
+            data = channel.recv(65536)
+            if not data:
+                break
+            try:
+                process.stdin.write(data)
+                process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                break
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    threading.Thread(target=feed, daemon=True).start()
+    pumps = [threading.Thread(target=_pump, args=(process.stdout, channel.sendall))]
+    if process.stderr is not None:
+        pumps.append(threading.Thread(target=_pump, args=(process.stderr, channel.sendall_stderr)))
+    for thread in pumps:
+        thread.start()
+    for thread in pumps:
+        thread.join()
+    try:
+        channel.send_exit_status(process.wait())
+        channel.close()
+    except (EOFError, OSError):
+        pass
+
+
+# === 限制在家目錄內的 SFTP ===
+class _SandboxHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class SandboxSFTP(SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.home = server.home
+
+    def _local(self, path):
+        path = os.path.realpath(os.path.join(self.home, path))
+        if path != self.home and not path.startswith(self.home + os.sep):
+            raise PermissionError(errno.EACCES, "outside of sandbox")
+        return path
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join(self.home, path))
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _SandboxHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self._local(path), attr.st_mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
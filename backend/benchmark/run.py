@@ -0,0 +1,306 @@
+import argparse
+import contextlib
+import functools
+import importlib
+import json
+import math
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+import pymongo.monitoring
+
+from benchmark.fake_llm import ScriptedLLM
+from benchmark.fake_ssh import SandboxSSHServer
+from benchmark.scenarios import load_scenarios
+
+try:
+    import mongomock
+except ImportError:  # 未安裝 mongomock 時必須以 --mongo-uri 指定本機 MongoDB
+    mongomock = None
+
+
+# === 累計函式執行時間 (SSH 操作、mongomock 存取) ===
+class Stopwatch:
+    """巢狀呼叫 (例如 run() 內重新 start()) 只計算最外層一次。"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self, owner, name):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            depth = getattr(self._local, "depth", 0)
+            self._local.depth = depth + 1
+            started = time.monotonic()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+                if depth == 0:
+                    with self._lock:
+                        self.seconds += time.monotonic() - started
+                        self.calls += 1
+
+        setattr(owner, name, timed)
+
+    def reset(self):
+        with self._lock:
+            totals = (self.seconds, self.calls)
+            self.seconds, self.calls = 0.0, 0
+        return totals
+
+
+# === 以 pymongo command monitoring 累計實際 MongoDB 的指令時間 ===
+class MongoCommandTimer(pymongo.monitoring.CommandListener):
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._add(event.duration_micros)
+
+    def failed(self, event):
+        self._add(event.duration_micros)
+
+    def _add(self, micros):
+        with self._lock:
+            self.seconds += micros / 1e6
+            self.calls += 1
+
+    def reset(self):
+        with self._lock:
+            totals = (self.seconds, self.calls)
+            self.seconds, self.calls = 0.0, 0
+        return totals
+
+
+def instrument_ssh(stopwatch):
+    import device_facts
+    import ssh_pool
+    import ssh_session
+    for name in ("start", "run", "run_batch", "write_file", "read_file", "close"):
+        stopwatch.wrap(ssh_session.ExecutionSession, name)
+    for name in ("open", "send_line", "send_keys", "close"):
+        stopwatch.wrap(ssh_session.InteractiveShell, name)
+    stopwatch.wrap(device_facts, "capture_exec")
+    stopwatch.wrap(ssh_pool.DeviceConnectionPool, "_connect")
+
+
+def instrument_mongomock(stopwatch):
+    # mongomock 的 find() 在建立 cursor 時即完成查詢，因此包裝 collection 方法即可涵蓋存取時間
+    for name in ("find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one",
+                 "update_many", "delete_one", "delete_many", "count_documents", "create_index"):
+        stopwatch.wrap(mongomock.collection.Collection, name)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+# === 單次操作：Assistant1 聊天取得 Markdown，再交由 Assistant2 在裝置上執行 ===
+def run_operation(flask_app, scenario, device_id):
+    client = flask_app.test_client()
+    chat_id = f"bench-{uuid.uuid4().hex[:12]}"
+    started = time.monotonic()
+    response = client.post("/assistant1/chat", json={
+        "chat_id": chat_id, "user_message": scenario["user_message"], "device_id": device_id,
+    })
+    chat_seconds = time.monotonic() - started
+    if response.status_code != 200:
+        return {"scenario": scenario["name"], "chat": chat_seconds, "execute": 0.0, "status": f"HTTP {response.status_code}"}
+    markdown = response.get_json()["assistant_markdown"]
+    started = time.monotonic()
+    response = client.post("/assistant2/execute", data={
+        "chat_id": chat_id, "device_id": device_id, "markdown_content": markdown,
+    })
+    execute_seconds = time.monotonic() - started
+    body = response.get_json() or {}
+    status = body.get("status") if response.status_code == 200 else f"HTTP {response.status_code}"
+    return {"scenario": scenario["name"], "chat": chat_seconds, "execute": execute_seconds, "status": status}
+
+
+def run_level(server, llm, ssh_timer, mongo_timer, scenarios, devices, concurrency, requests):
+    llm.reset_stats()
+    ssh_timer.reset()
+    mongo_timer.reset()
+    free_devices = queue.Queue()
+    for device_id in devices[:concurrency]:
+        free_devices.put(device_id)
+
+    def operation(number):
+        device_id = free_devices.get()
+        try:
+            return run_operation(server.app, scenarios[number % len(scenarios)], device_id)
+        finally:
+            free_devices.put(device_id)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(operation, range(requests)))
+    wall = time.monotonic() - started
+
+    calls = llm.reset_stats()
+    ssh_seconds, ssh_calls = ssh_timer.reset()
+    mongo_seconds, mongo_calls = mongo_timer.reset()
+    chat = [result["chat"] for result in results]
+    execute = [result["execute"] for result in results]
+    total = [result["chat"] + result["execute"] for result in results]
+    execution_calls = [call for call in calls if call["kind"] in ("assistant2", "assistant1_report")]
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": sum(1 for result in results if result["status"] != "Complete"),
+        "throughput": requests / wall if wall else 0.0,
+        "chat_p50": percentile(chat, 50),
+        "chat_p95": percentile(chat, 95),
+        "execute_p50": percentile(execute, 50),
+        "execute_p95": percentile(execute, 95),
+        "total_p50": percentile(total, 50),
+        "total_p95": percentile(total, 95),
+        "llm_calls_per_execution": len(execution_calls) / requests,
+        "assistant2_calls_per_execution": sum(1 for call in calls if call["kind"] == "assistant2") / requests,
+        "prompt_tokens_per_request": sum(call["prompt_tokens"] for call in calls) / requests,
+        "completion_tokens_per_request": sum(call["completion_tokens"] for call in calls) / requests,
+        "ssh_seconds_per_request": ssh_seconds / requests,
+        "ssh_calls": ssh_calls,
+        "mongo_seconds_per_request": mongo_seconds / requests,
+        "mongo_calls": mongo_calls,
+        "statuses": {status: sum(1 for result in results if result["status"] == status)
+                     for status in sorted({result["status"] for result in results})},
+    }
+
+
+def format_report(levels):
+    header = (f"{'conc':>4} {'req':>4} {'fail':>4} {'ops/s':>6} "
+              f"{'chat p50/p95 ms':>16} {'exec p50/p95 ms':>16} {'total p50/p95 ms':>17} "
+              f"{'llm/exec':>8} {'a2/exec':>7} {'tok in/out':>12} {'ssh ms':>7} {'mongo ms':>8}")
+    lines = [header, "-" * len(header)]
+    for level in levels:
+        lines.append(
+            f"{level['concurrency']:>4} {level['requests']:>4} {level['failures']:>4} {level['throughput']:>6.2f} "
+            f"{level['chat_p50'] * 1000:>7.0f}/{level['chat_p95'] * 1000:<8.0f} "
+            f"{level['execute_p50'] * 1000:>7.0f}/{level['execute_p95'] * 1000:<8.0f} "
+            f"{level['total_p50'] * 1000:>8.0f}/{level['total_p95'] * 1000:<8.0f} "
+            f"{level['llm_calls_per_execution']:>8.2f} {level['assistant2_calls_per_execution']:>7.2f} "
+            f"{level['prompt_tokens_per_request']:>6.0f}/{level['completion_tokens_per_request']:<5.0f} "
+            f"{level['ssh_seconds_per_request'] * 1000:>7.0f} {level['mongo_seconds_per_request'] * 1000:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmark",
+        description="以假 LLM、本機 SSH 伺服器與 mongomock (或本機 MongoDB) 量測 /assistant1/chat 與 /assistant2/execute 的延遲。",
+    )
+    parser.add_argument("--scenarios", default="", help="以逗號分隔的劇本名稱，預設為全部 (disk_space, hello_file, testlog)")
+    parser.add_argument("--concurrency", default="1,4,8", help="以逗號分隔的並行數，預設 1,4,8")
+    parser.add_argument("--requests", type=int, default=24, help="每個並行數送出的操作數 (聊天 + 執行)")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="假 LLM 每次呼叫的固定延遲秒數")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="假 LLM 每個輸出 token 的額外延遲秒數")
+    parser.add_argument("--mongo-uri", default=None, help="使用本機 MongoDB (會建立並於結束時刪除暫時的資料庫)；未指定時使用 mongomock")
+    parser.add_argument("--response-cache", action="store_true", help="啟用回應快取 (預設關閉，量測未命中快取的完整流程)")
+    parser.add_argument("--no-warmup", action="store_true", help="不先在每台裝置上執行一輪 (建立 SSH 連線與環境資訊快取)")
+    parser.add_argument("--sandbox", default=None, help="SSH 伺服器的 sandbox 目錄，預設為暫存目錄並於結束時刪除")
+    parser.add_argument("--log", default=os.devnull, help="後端 log 寫入的檔案，預設丟棄")
+    parser.add_argument("--json", default=None, help="將結果另存為 JSON 檔")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = load_scenarios([name for name in args.scenarios.split(",") if name])
+    levels = [int(value) for value in args.concurrency.split(",") if value]
+    if args.mongo_uri is None and mongomock is None:
+        sys.exit("[ERROR] 未安裝 mongomock，請安裝或以 --mongo-uri 指定本機 MongoDB")
+
+    sandbox = args.sandbox or tempfile.mkdtemp(prefix="a2-bench-")
+    ssh_server = SandboxSSHServer(sandbox).start()
+    devices = [f"Device{number}" for number in range(1, max(levels) + 1)]
+    for number in range(1, len(devices) + 1):
+        home = ssh_server.home(f"pi{number}")
+        for scenario in scenarios:
+            for directory in scenario["directories"]:
+                os.makedirs(os.path.join(home, directory), exist_ok=True)
+
+    database = f"benchmark_{uuid.uuid4().hex[:8]}"
+    config = {
+        "OPENAI_API_KEY": "benchmark",
+        "Device": {
+            device_id: {"hostname": ssh_server.host, "port": ssh_server.port, "username": f"pi{number}", "password": "benchmark"}
+            for number, device_id in enumerate(devices, start=1)
+        },
+        "MongoDB": {"uri": args.mongo_uri or "mongodb://localhost:27017", "database": database},
+        "Jobs": {"max_workers": len(devices)},
+        "ResponseCache": {"enabled": args.response_cache},
+    }
+    config_path = os.path.join(sandbox, "config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.environ["APP_CONFIG_PATH"] = config_path
+
+    ssh_timer = Stopwatch()
+    if args.mongo_uri is None:
+        mongo_timer = Stopwatch()
+        instrument_mongomock(mongo_timer)
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        mongo_timer = MongoCommandTimer()
+        pymongo.monitoring.register(mongo_timer)
+    llm = ScriptedLLM(scenarios, latency=args.llm_latency, token_latency=args.llm_token_latency)
+
+    report = sys.stdout
+    results = []
+    with open(args.log, "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        try:
+            server = importlib.import_module("app")
+            server.client_openai = llm
+            instrument_ssh(ssh_timer)
+            if not args.no_warmup:
+                warmup = len(devices) * len(scenarios)
+                run_level(server, llm, ssh_timer, mongo_timer, scenarios, devices, len(devices), warmup)
+            for concurrency in levels:
+                print(f"[BENCH] concurrency {concurrency}", file=report, flush=True)
+                results.append(run_level(server, llm, ssh_timer, mongo_timer, scenarios, devices,
+                                         concurrency, args.requests))
+            server.ssh_pool.close_all()
+            if args.mongo_uri is not None:
+                server.mongo_client.drop_database(database)
+        finally:
+            ssh_server.close()
+            if args.sandbox is None:
+                shutil.rmtree(sandbox, ignore_errors=True)
+
+    print(f"\nscenarios: {', '.join(scenario['name'] for scenario in scenarios)}; "
+          f"llm latency {args.llm_latency}s + {args.llm_token_latency}s/token; "
+          f"mongo: {'MongoDB ' + args.mongo_uri if args.mongo_uri else 'mongomock'}; "
+          f"response cache: {'on' if args.response_cache else 'off'}\n", file=report)
+    print(format_report(results), file=report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"arguments": vars(args), "levels": results}, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
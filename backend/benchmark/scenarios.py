@@ -0,0 +1,36 @@
+import json
+import os
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS_PATH = os.path.join(BENCHMARK_DIR, "scenarios.json")
+TESTLOG_PATH = os.path.join(os.path.dirname(BENCHMARK_DIR), "Testlog.json")
+
+
+def testlog_scenario(path=TESTLOG_PATH):
+    """由 test.py 在實體 Raspberry Pi 上錄下的 Testlog.json 建立劇本：Markdown 為第一則 user 訊息，
+    Assistant2 依序回放當時的每一則回覆 (含 nano 的互動式步驟)。"""
+    with open(path, "r", encoding="utf-8") as f:
+        messages = json.load(f)
+    return {
+        "name": "testlog",
+        "user_message": "在桌面建立一個會印出 Hello, World! 的 Python 檔案並執行",
+        "markdown": messages[1]["content"],
+        "assistant2": [message["content"] for message in messages if message["role"] == "assistant"],
+        "report": "### 執行完成\n\n`hello.py` 已建立並成功印出 Hello, World!。",
+        "directories": ["Desktop"],
+    }
+
+
+def load_scenarios(names=None):
+    """回傳指定名稱的劇本 (未指定時為全部)，名稱不存在時拋出 ValueError。"""
+    with open(SCENARIOS_PATH, "r", encoding="utf-8") as f:
+        scenarios = json.load(f)
+    scenarios.append(testlog_scenario())
+    if not names:
+        return scenarios
+    by_name = {scenario["name"]: scenario for scenario in scenarios}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"未知的劇本: {', '.join(unknown)} (可用: {', '.join(by_name)})")
+    return [by_name[name] for name in names]
@@ -0,0 +1,301 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+
+import pymongo
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+# === 同步與 asyncio 版本共用的查詢 / 文件格式 ===
+def _chat_defaults(chat_id, system_prompt_version):
+    now = time.time()
+    return {
+        "chat_id": chat_id,
+        "system_prompt_version": system_prompt_version,
+        "message_count": 0,
+        "last_seq": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _message_docs(chat_id, first_seq, messages):
+    now = time.time()
+    return [
+        {"chat_id": chat_id, "seq": first_seq + offset, "role": message["role"],
+         "content": message["content"], "created_at": now}
+        for offset, message in enumerate(messages)
+    ]
+
+
+def last_stored_seq(chat_doc):
+    """已寫入 messages 的最大序號。message_count 是已配置的序號，寫入失敗時會留下空號而大於 last_seq；
+    舊版的聊天室文件沒有 last_seq，以 message_count 代替。"""
+    return chat_doc.get("last_seq", chat_doc.get("message_count", 0))
+
+
+def _stored_update(first_seq, messages):
+    return {"$max": {"last_seq": first_seq + len(messages) - 1}}
+
+
+def _title(messages):
+    # 以第一則使用者訊息的第一行作為聊天室標題
+    for message in messages:
+        if message["role"] == "user" and message["content"].strip():
+            return message["content"].strip().splitlines()[0][:40]
+    return None
+
+
+def _page_query(chat_id, before=None, since=None):
+    """回傳 (query, 排序方向)：since 指定時由舊到新，否則由新到舊。"""
+    if since is not None:
+        return {"chat_id": chat_id, "seq": {"$gt": since}}, 1
+    query = {"chat_id": chat_id}
+    if before is not None:
+        query["seq"] = {"$lt": before}
+    return query, -1
+
+
+PAGE_PROJECTION = {"_id": 0, "seq": 1, "role": 1, "content": 1}
+
+# (collection, 索引鍵, 選項)：同步與 asyncio 版本建立相同的索引
+CHAT_INDEXES = [
+    ("chats", "chat_id", {"unique": True}),
+    ("chats", [("updated_at", pymongo.DESCENDING)], {}),
+    ("messages", [("chat_id", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], {"unique": True}),
+    ("system_prompts", "version", {"unique": True}),
+]
+
+
+def _system_prompt_upsert(version, content):
+    return (
+        {"version": version},
+        {"$setOnInsert": {"version": version, "content": content, "created_at": time.time()}},
+    )
+
+
+# === 聊天記錄儲存層：訊息逐筆附加，不再重寫整個 messages 陣列 ===
+class ChatStore:
+    """建立時會確保索引存在並登錄目前版本的 system prompt。
+
+    chats 只保存聊天室的中繼資料 (使用的 system prompt 版本、訊息數)；
+    訊息存於 messages collection，以 (chat_id, seq) 排序；system prompt 依版本只存一份於 system_prompts。
+
+    舊版將 messages 陣列內嵌於 chats 文件的聊天室，會在第一次存取時搬移到 messages collection。
+    """
+
+    def __init__(self, db, system_prompt_version, system_prompt):
+        self.chats = db["chats"]
+        self.messages = db["messages"]
+        self.system_prompts = db["system_prompts"]
+        self.system_prompt_version = system_prompt_version
+        self._prompt_cache = {}
+        self._known_chats = set()
+        self._lock = threading.Lock()
+        self.ensure_indexes()
+        self.register_system_prompt(system_prompt_version, system_prompt)
+
+    def ensure_indexes(self):
+        for name, keys, options in CHAT_INDEXES:
+            getattr(self, name).create_index(keys, **options)
+
+    def register_system_prompt(self, version, content):
+        self.system_prompts.update_one(*_system_prompt_upsert(version, content), upsert=True)
+        self._prompt_cache[version] = content
+
+    def system_prompt(self, version):
+        content = self._prompt_cache.get(version)
+        if content is None:
+            doc = self.system_prompts.find_one({"version": version})
+            content = doc["content"] if doc else ""
+            self._prompt_cache[version] = content
+        return content
+
+    def init_chat(self, chat_id):
+        """以 upsert 原子地建立聊天室 (已存在時不變動)，回傳聊天室文件。"""
+        chat_doc = self.chats.find_one_and_update(
+            {"chat_id": chat_id},
+            {"$setOnInsert": _chat_defaults(chat_id, self.system_prompt_version)},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if "messages" in chat_doc:
+            chat_doc = self._migrate_embedded_messages(chat_id)
+        with self._lock:
+            self._known_chats.add(chat_id)
+        return chat_doc
+
+    def append(self, chat_id, *messages):
+        """附加訊息到聊天室末端；以 $inc 原子地配置序號，並發寫入也不會互相覆蓋。
+        寫入成功後才以 $max 更新 last_seq，寫入失敗留下的空號不會讓聊天室一直顯示有未寫入的訊息。"""
+        if not messages:
+            return
+        if chat_id not in self._known_chats:
+            self.init_chat(chat_id)
+        chat_doc = self.chats.find_one_and_update(
+            {"chat_id": chat_id},
+            {"$inc": {"message_count": len(messages)}, "$set": {"updated_at": time.time()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        first_seq = chat_doc["message_count"] - len(messages) + 1
+        if "title" not in chat_doc:
+            self._set_title(chat_id, messages)
+        self.messages.insert_many(_message_docs(chat_id, first_seq, messages))
+        self.chats.update_one({"chat_id": chat_id}, _stored_update(first_seq, messages))
+
+    def page(self, chat_id, limit=None, before=None, since=None):
+        """依序號分頁讀取訊息 (含 seq)。
+
+        since 指定時回傳 seq > since 的最舊 limit 筆 (增量更新)；
+        否則回傳 seq < before (未指定則為全部) 的最新 limit 筆。
+        """
+        query, direction = _page_query(chat_id, before, since)
+        cursor = self.messages.find(query, PAGE_PROJECTION).sort("seq", direction)
+        if limit:
+            cursor = cursor.limit(limit)
+        messages = list(cursor)
+        return messages if direction == 1 else messages[::-1]
+
+    def history(self, chat_id):
+        """聊天室的完整對話：system prompt 加上所有訊息 (僅 role 與 content)，格式與舊版內嵌的 messages 陣列相同。"""
+        chat_doc = self.init_chat(chat_id)
+        system = {"role": "system", "content": self.system_prompt(chat_doc["system_prompt_version"])}
+        return [system] + [{"role": message["role"], "content": message["content"]} for message in self.page(chat_id)]
+
+    def list_chats(self, limit=50):
+        """聊天室列表 (僅 id、標題、訊息數與最後更新時間)，依最後更新時間由新到舊。"""
+        projection = {"_id": 0, "chat_id": 1, "title": 1, "message_count": 1, "updated_at": 1}
+        return list(self.chats.find({}, projection).sort("updated_at", -1).limit(limit))
+
+    def set_summary(self, chat_id, summary, summary_seq, expected_seq=0):
+        """更新聊天室摘要；expected_seq 與目前記錄不同 (其他請求已先更新) 時不寫入並回傳 False。"""
+        current = {"$in": [0, None]} if not expected_seq else expected_seq
+        result = self.chats.update_one(
+            {"chat_id": chat_id, "summary_seq": current},
+            {"$set": {"summary": summary, "summary_seq": summary_seq}},
+        )
+        return result.modified_count == 1
+
+    def _set_title(self, chat_id, messages):
+        title = _title(messages)
+        if title:
+            self.chats.update_one({"chat_id": chat_id, "title": {"$exists": False}}, {"$set": {"title": title}})
+
+    def _migrate_embedded_messages(self, chat_id):
+        # 以 $unset 原子地取走內嵌陣列，避免兩個請求重複搬移
+        legacy = self.chats.find_one_and_update(
+            {"chat_id": chat_id, "messages": {"$exists": True}},
+            {"$unset": {"messages": ""}},
+        )
+        if legacy is None:
+            return self.chats.find_one({"chat_id": chat_id})
+        messages = legacy["messages"]
+        version = self.system_prompt_version
+        if messages and messages[0]["role"] == "system":
+            content = messages.pop(0)["content"]
+            if content != self.system_prompt(version):
+                version = "legacy-" + hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+                self.register_system_prompt(version, content)
+        if messages:
+            created_at = legacy.get("created_at", time.time())
+            self.messages.insert_many([
+                {"chat_id": chat_id, "seq": seq, "role": message["role"],
+                 "content": message["content"], "created_at": created_at}
+                for seq, message in enumerate(messages, start=1)
+            ])
+            self._set_title(chat_id, messages)
+        logger.info(f"聊天室 {chat_id} 的 {len(messages)} 筆內嵌訊息已搬移至 messages collection")
+        return self.chats.find_one_and_update(
+            {"chat_id": chat_id},
+            {"$set": {
+                "system_prompt_version": version,
+                "message_count": len(messages),
+                "last_seq": len(messages),
+                "created_at": legacy.get("created_at", time.time()),
+                "updated_at": time.time(),
+            }},
+            return_document=ReturnDocument.AFTER,
+        )
+
+
+# === asyncio 版聊天記錄儲存層 (pymongo AsyncMongoClient)，供 async_app 使用 ===
+class AsyncChatStore:
+    """與 ChatStore 共用同一批 collection 與文件格式。建立時不進行任何 I/O，
+    第一次使用時才以非同步的 create_index 建立索引並登錄 system prompt。
+
+    舊版內嵌訊息的聊天室只會搬移一次，因此交由同步的 ChatStore 在背景執行緒處理。
+    """
+
+    def __init__(self, db, chat_store, system_prompt_version, system_prompt):
+        self.db = db
+        self.chats = db["chats"]
+        self.messages = db["messages"]
+        self.system_prompts = db["system_prompts"]
+        self.chat_store = chat_store
+        self.system_prompt_version = system_prompt_version
+        self._prompt_cache = {}
+        self._initial_prompt = system_prompt
+        self._known_chats = set()
+        self._ready = False
+
+    async def ensure_ready(self):
+        if self._ready:
+            return
+        for name, keys, options in CHAT_INDEXES:
+            await self.db[name].create_index(keys, **options)
+        await self.system_prompts.update_one(
+            *_system_prompt_upsert(self.system_prompt_version, self._initial_prompt), upsert=True)
+        self._prompt_cache[self.system_prompt_version] = self._initial_prompt
+        self._ready = True
+
+    async def system_prompt(self, version):
+        await self.ensure_ready()
+        content = self._prompt_cache.get(version)
+        if content is None:
+            doc = await self.system_prompts.find_one({"version": version})
+            content = doc["content"] if doc else ""
+            self._prompt_cache[version] = content
+        return content
+
+    async def init_chat(self, chat_id):
+        await self.ensure_ready()
+        chat_doc = await self.chats.find_one_and_update(
+            {"chat_id": chat_id},
+            {"$setOnInsert": _chat_defaults(chat_id, self.system_prompt_version)},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if "messages" in chat_doc:
+            chat_doc = await asyncio.to_thread(self.chat_store.init_chat, chat_id)
+        self._known_chats.add(chat_id)
+        return chat_doc
+
+    async def append(self, chat_id, *messages):
+        if not messages:
+            return
+        if chat_id not in self._known_chats:
+            await self.init_chat(chat_id)
+        chat_doc = await self.chats.find_one_and_update(
+            {"chat_id": chat_id},
+            {"$inc": {"message_count": len(messages)}, "$set": {"updated_at": time.time()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        first_seq = chat_doc["message_count"] - len(messages) + 1
+        title = _title(messages) if "title" not in chat_doc else None
+        if title:
+            await self.chats.update_one({"chat_id": chat_id, "title": {"$exists": False}}, {"$set": {"title": title}})
+        await self.messages.insert_many(_message_docs(chat_id, first_seq, messages))
+        await self.chats.update_one({"chat_id": chat_id}, _stored_update(first_seq, messages))
+
+    async def page(self, chat_id, limit=None, before=None, since=None):
+        await self.ensure_ready()
+        query, direction = _page_query(chat_id, before, since)
+        cursor = self.messages.find(query, PAGE_PROJECTION).sort("seq", direction)
+        if limit:
+            cursor = cursor.limit(limit)
+        messages = await cursor.to_list(None)
+        return messages if direction == 1 else messages[::-1]
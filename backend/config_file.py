@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# === config.json：檔案修改後自動重新載入，新增或修改裝置不需重新啟動服務 ===
+class ConfigFile:
+    """以 config.get("Device", {}) 等方式讀取目前的設定。
+
+    每次讀取時最多每 check_interval 秒檢查一次檔案的修改時間，有變更才重新解析；
+    檔案不存在或內容不是有效的 JSON 時保留上一次成功載入的設定 (首次載入失敗時為空設定)，
+    錯誤原因記錄於 error，供 readiness 檢查回報；loaded 表示是否曾成功載入。
+    """
+
+    def __init__(self, path, check_interval=2.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.error = None
+        self.loaded = False
+        self._data = {}
+        self._stamp = None
+        self._checked_at = 0.0
+        self._listeners = []
+        self._initialized = False
+        self._lock = threading.Lock()
+        self.reload()
+        self._initialized = True
+
+    def on_change(self, callback):
+        """設定內容變更時呼叫 callback(old, new) (在觸發重新載入的執行緒上執行)。"""
+        self._listeners.append(callback)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    @property
+    def data(self):
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self.reload()
+        return self._data
+
+    def reload(self):
+        """檔案有變更時重新載入，回傳設定內容是否改變。"""
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+            except OSError as e:
+                if self.error is None:
+                    logger.error(f"無法讀取設定檔 {self.path}: {e}")
+                self.error = f"無法讀取設定檔: {e.strerror}"
+                self._stamp = None
+                return False
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp == self._stamp:
+                return False
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise ValueError("最外層必須是 JSON 物件")
+            except (OSError, ValueError) as e:
+                logger.error(f"設定檔 {self.path} 載入失敗，沿用先前的設定: {e}")
+                self.error = f"設定檔載入失敗: {e}"
+                self._stamp = stamp
+                return False
+            old, self._data, self._stamp, self.error = self._data, data, stamp, None
+            self.loaded = True
+        if old == data:
+            return False
+        if self._initialized:
+            logger.info(f"設定檔 {self.path} 已重新載入")
+            for callback in self._listeners:
+                try:
+                    callback(old, data)
+                except Exception as e:
+                    logger.error(f"套用新設定失敗: {e}")
+        return True
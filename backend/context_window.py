@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # 未安裝 tiktoken 時改用字元數估算
+    tiktoken = None
+
+from telemetry import start_thread
+
+logger = logging.getLogger(__name__)
+
+
+# 每則訊息在 chat completion 中額外佔用的 token (role 與分隔符號)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def count_tokens(text):
+    """計算文字的 token 數；沒有 tiktoken 時以 ASCII 約 4 字元 1 token、其他字元 1 字元 1 token 估算。"""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+# === Assistant1 的對話視窗：system prompt + 摘要 + 在 token 預算內的最近訊息 ===
+class ContextWindow:
+    """較舊、超出預算的訊息由 summarize(previous_summary, messages) 增量併入聊天室的摘要，
+    摘要與其涵蓋到的序號 (summary_seq) 存於 chats 文件；完整訊息仍保留在 messages collection。
+
+    token_budget 為送給 GPT 的歷史訊息 (含 system prompt 與摘要) 上限，不含本次新加入的訊息。
+    超出預算、尚未併入摘要的訊息在背景摘要完成前仍會送出 (最多再多 token_budget)，
+    更舊的部分則先同步併入摘要，任何一則訊息都不會在摘要完成前被略過。
+    """
+
+    def __init__(self, chat_store, summarize, token_budget=6000):
+        self.chat_store = chat_store
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self._summarizing = set()
+        self._lock = threading.Lock()
+
+    def build(self, chat_id, *new_messages, system_messages=()):
+        """回傳本次呼叫 GPT 要送出的訊息列表，最後附上 new_messages。
+
+        system_messages (例如裝置環境資訊) 會接在 system prompt 之後，並計入 token 預算。
+        """
+        for attempt in range(2):
+            chat_doc = self.chat_store.init_chat(chat_id)
+            system_prompt = self.chat_store.system_prompt(chat_doc["system_prompt_version"])
+            history = self.chat_store.page(chat_id, since=chat_doc.get("summary_seq", 0))
+            messages, dropped = self._assemble(chat_id, chat_doc, system_prompt, history, new_messages, system_messages)
+            if not dropped or attempt or not self._summarize_now(chat_id, system_messages):
+                return messages
+
+    async def abuild(self, async_store, chat_id, *new_messages, system_messages=()):
+        """build() 的 asyncio 版本，以 AsyncChatStore 讀取聊天記錄 (同步摘要在執行緒中進行)。"""
+        for attempt in range(2):
+            chat_doc = await async_store.init_chat(chat_id)
+            system_prompt = await async_store.system_prompt(chat_doc["system_prompt_version"])
+            history = await async_store.page(chat_id, since=chat_doc.get("summary_seq", 0))
+            messages, dropped = self._assemble(chat_id, chat_doc, system_prompt, history, new_messages, system_messages)
+            if not dropped or attempt or not await asyncio.to_thread(self._summarize_now, chat_id, system_messages):
+                return messages
+
+    def _assemble(self, chat_id, chat_doc, system_prompt, history, new_messages, system_messages):
+        """回傳 (messages, dropped)；dropped 為沒有送出、也尚未併入摘要的訊息數。"""
+        messages = self._leading_messages(system_prompt, chat_doc.get("summary", ""), system_messages)
+        recent, overflow = self._split(history, self._history_budget(messages))
+        # 背景摘要完成前，超出預算的訊息仍接在摘要之後送出，模型才看得到這幾個回合
+        pending, dropped = self._split(overflow, self.token_budget)
+        if overflow:
+            logger.info(f"聊天室 {chat_id} 有 {len(overflow)} 筆訊息超出 token 預算，等待併入摘要")
+        messages += [{"role": m["role"], "content": m["content"]} for m in pending + recent]
+        return messages + list(new_messages), len(dropped)
+
+    def _summarize_now(self, chat_id, system_messages):
+        """超出預算的訊息多到無法暫時附上時，先同步更新摘要；失敗時回傳 False (本回合略過最舊的訊息)。
+
+        摘要已被其他請求先更新時同樣回傳 True，由呼叫端重新讀取。
+        """
+        logger.info(f"聊天室 {chat_id} 尚未摘要的訊息過多，先同步更新摘要")
+        try:
+            self.refresh_summary(chat_id, system_messages)
+            return True
+        except Exception as e:
+            logger.error(f"聊天室 {chat_id} 摘要更新失敗: {e}")
+            return False
+
+    def refresh_summary(self, chat_id, system_messages=()):
+        """將超出預算的最舊訊息併入摘要；沒有超出時不呼叫 GPT。
+
+        system_messages 需與 build() 相同，兩者才會以相同的預算判斷哪些訊息超出。
+        """
+        chat_doc = self.chat_store.init_chat(chat_id)
+        summary = chat_doc.get("summary", "")
+        summary_seq = chat_doc.get("summary_seq", 0)
+        system_prompt = self.chat_store.system_prompt(chat_doc["system_prompt_version"])
+        history = self.chat_store.page(chat_id, since=summary_seq)
+        _, overflow = self._split(history, self._history_budget(
+            self._leading_messages(system_prompt, summary, system_messages)))
+        if not overflow:
+            return False
+        new_summary = self.summarize(summary, [{"role": m["role"], "content": m["content"]} for m in overflow])
+        updated = self.chat_store.set_summary(chat_id, new_summary, overflow[-1]["seq"], expected_seq=summary_seq)
+        logger.info(f"聊天室 {chat_id} 摘要已更新至 seq {overflow[-1]['seq']}" if updated
+                    else f"聊天室 {chat_id} 摘要已被其他請求更新，略過")
+        return updated
+
+    def refresh_summary_async(self, chat_id, system_messages=()):
+        """在背景更新摘要，不增加本回合的回應時間；同一聊天室同時只會有一個摘要工作。"""
+        with self._lock:
+            if chat_id in self._summarizing:
+                return
+            self._summarizing.add(chat_id)
+
+        def run():
+            try:
+                self.refresh_summary(chat_id, system_messages)
+            except Exception as e:
+                logger.error(f"聊天室 {chat_id} 摘要更新失敗: {e}")
+            finally:
+                with self._lock:
+                    self._summarizing.discard(chat_id)
+
+        start_thread(run)
+
+    def _leading_messages(self, system_prompt, summary, system_messages):
+        # 排在歷史訊息之前的固定部分：system prompt、裝置資訊等 system_messages 與摘要
+        messages = [{"role": "system", "content": system_prompt}, *system_messages]
+        if summary:
+            messages.append(self._summary_message(summary))
+        return messages
+
+    def _history_budget(self, leading_messages):
+        return self.token_budget - sum(message_tokens(m) for m in leading_messages)
+
+    @staticmethod
+    def _split(history, budget):
+        # 由新到舊保留在預算內的訊息，其餘 (較舊) 的為 overflow
+        used = 0
+        keep_from = len(history)
+        for index in range(len(history) - 1, -1, -1):
+            used += message_tokens(history[index])
+            if used > budget:
+                break
+            keep_from = index
+        return history[keep_from:], history[:keep_from]
+
+    @staticmethod
+    def _summary_message(summary):
+        return {"role": "system", "content": f"先前對話摘要：\n{summary}"}
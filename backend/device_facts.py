@@ -0,0 +1,108 @@
+import datetime
+import logging
+import re
+
+from mongo_indexes import ensure_ttl_index
+from ssh_session import capture_exec
+
+logger = logging.getLogger(__name__)
+
+
+# 常用且會影響指令寫法的套件，只回報有安裝的
+KEY_PACKAGES = [
+    "git", "curl", "build-essential", "python3-pip", "python3-venv", "nodejs", "npm",
+    "docker-ce", "docker.io", "nginx", "apache2", "mariadb-server", "sqlite3", "vim", "nano",
+]
+
+# 以一次 SSH 指令蒐集所有資訊，每一段以 "### 名稱" 開頭
+FACTS_COMMAND = "\n".join([
+    "section() { printf '\\n### %s\\n' \"$1\"; }",
+    "section hostname; hostname",
+    "section os; (. /etc/os-release 2>/dev/null && echo \"$PRETTY_NAME\")",
+    "section kernel; uname -srm",
+    "section home; echo \"$HOME\"",
+    "section home_listing; ls -1A \"$HOME\" 2>/dev/null | head -n 40",
+    "section disk; df -h \"$HOME\" 2>/dev/null | awk 'NR==2 {print $4 \" free of \" $2}'",
+    "section memory; free -m 2>/dev/null | awk 'NR==2 {print $7 \" MB available of \" $2 \" MB\"}'",
+    "section python; python3 --version 2>&1",
+    "section packages; dpkg-query -W -f='${Status} ${Package} ${Version}\\n' "
+    + " ".join(KEY_PACKAGES) + " 2>/dev/null | awk '$3 == \"installed\" {print $4 \" \" $5}'",
+])
+
+# 執行後可能讓快取的裝置資訊過期的指令 (安裝套件、變更家目錄內容、改主機名稱等)
+FACT_CHANGING_PATTERN = re.compile(
+    r"(^|[\s;&|(])(apt|apt-get|dpkg|pip3?|snap|mkdir|rm|rmdir|mv|cp|touch|ln|tar|unzip|wget"
+    r"|git\s+(clone|init|pull|checkout)|hostnamectl|raspi-config|npm)\s|(?<![0-9&>])>>?(?!\s*(/dev/null|&))"
+)
+
+
+def parse_facts(output):
+    facts = {}
+    for section in output.split("\n### ")[1:]:
+        name, _, value = section.partition("\n")
+        facts[name.strip()] = value.strip()
+    facts["home_listing"] = facts.get("home_listing", "").splitlines()
+    facts["packages"] = facts.get("packages", "").splitlines()
+    return facts
+
+
+def changes_facts(command):
+    return bool(FACT_CHANGING_PATTERN.search(command))
+
+
+def format_facts(device_id, facts):
+    """整理成放進 system prompt 的精簡文字。"""
+    lines = [
+        f"裝置 {device_id} 的環境資訊 (快取於 {facts.get('collected_at', '')})：",
+        f"- 主機名稱：{facts.get('hostname', '')}，OS：{facts.get('os', '')}，Kernel：{facts.get('kernel', '')}",
+        f"- 家目錄：{facts.get('home', '')}，內容：{', '.join(facts.get('home_listing', [])) or '(空)'}",
+        f"- 磁碟：{facts.get('disk', '')}，記憶體：{facts.get('memory', '')}，{facts.get('python', '')}",
+        f"- 已安裝套件：{', '.join(facts.get('packages', [])) or '(無)'}",
+    ]
+    return "\n".join(lines)
+
+
+# === 依 device_id 快取於 MongoDB 的裝置資訊，逾時 (TTL) 後重新蒐集 ===
+class DeviceFactsCache:
+    def __init__(self, collection, ttl_seconds=86400, timeout=20):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.timeout = timeout
+        self.collection.create_index("device_id", unique=True)
+        # MongoDB 會自動刪除過期的文件；讀取時仍會檢查時間，避免刪除排程延遲時用到過期資料
+        ensure_ttl_index(self.collection, "collected_at", ttl_seconds)
+
+    def cached(self, device_id):
+        """回傳未過期的快取資訊，沒有時回傳 None (不會連線到裝置)。"""
+        doc = self.collection.find_one({"device_id": device_id})
+        if doc is None:
+            return None
+        collected_at = doc["collected_at"].replace(tzinfo=datetime.timezone.utc)
+        if (datetime.datetime.now(datetime.timezone.utc) - collected_at).total_seconds() > self.ttl_seconds:
+            return None
+        return doc["facts"]
+
+    def get(self, device_id, ssh_client):
+        facts = self.cached(device_id)
+        if facts is None:
+            facts = self.collect(device_id, ssh_client)
+        return facts
+
+    def collect(self, device_id, ssh_client):
+        result = capture_exec(ssh_client, FACTS_COMMAND, timeout=self.timeout)
+        if result.timed_out:
+            raise TimeoutError(f"蒐集裝置 {device_id} 資訊逾時")
+        collected_at = datetime.datetime.now(datetime.timezone.utc)
+        facts = parse_facts(result.stdout)
+        facts["collected_at"] = collected_at.strftime("%Y-%m-%d %H:%M UTC")
+        self.collection.update_one(
+            {"device_id": device_id},
+            {"$set": {"device_id": device_id, "facts": facts, "collected_at": collected_at}},
+            upsert=True,
+        )
+        logger.info(f"已蒐集裝置 {device_id} 的環境資訊")
+        return facts
+
+    def invalidate(self, device_id):
+        self.collection.delete_one({"device_id": device_id})
+        logger.info(f"裝置 {device_id} 的環境資訊快取已失效")
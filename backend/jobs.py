@@ -0,0 +1,184 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telemetry import current_trace_id, trace_id_var
+
+logger = logging.getLogger(__name__)
+
+
+# === 單一背景工作 (一次 Assistant2 執行) ===
+class Job:
+    def __init__(self, device_id, func, metadata=None):
+        self.job_id = uuid.uuid4().hex
+        self.device_id = device_id
+        self.func = func
+        self.metadata = metadata or {}
+        # 沿用送出工作的 HTTP 請求之追蹤 ID，背景執行時的 log 才能對應回原本的請求
+        self.trace_id = current_trace_id()
+        self.status = "queued"  # queued / running / succeeded / failed / cancelled
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.tasks = {}
+        self.cancel_event = threading.Event()
+        self.done_event = threading.Event()
+        self._done_callbacks = []
+        self._events = []
+        self._events_cond = threading.Condition()
+
+    def add_done_callback(self, callback):
+        """工作結束時呼叫 callback(job)；若已結束則立即呼叫。"""
+        with self._events_cond:
+            if not self.done_event.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    # --- 事件紀錄：供 SSE 串流重播 ---
+    def emit(self, event, data):
+        if event == "task":
+            # 多裝置執行時不同裝置的 Task 以 device_id 區分
+            self.tasks[(data.get("device_id") or "", data["index"])] = data
+        with self._events_cond:
+            self._events.append((event, data))
+            self._events_cond.notify_all()
+
+    def events_since(self, index, timeout=None):
+        """回傳第 index 筆之後的事件；若尚無新事件且工作未結束，最多等待 timeout 秒。"""
+        with self._events_cond:
+            if index >= len(self._events) and not self.done_event.is_set():
+                self._events_cond.wait(timeout)
+            return self._events[index:]
+
+    @property
+    def finished(self):
+        return self.done_event.is_set()
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "device_id": self.device_id,
+            **self.metadata,
+            "status": self.status,
+            "trace_id": self.trace_id,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "tasks": [self.tasks[key] for key in sorted(self.tasks)],
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+# === 背景工作佇列：有上限的 worker pool，且同一裝置一次只執行一個工作 ===
+class JobManager:
+    """不同裝置的工作平行執行；同一裝置的工作依送出順序排隊，避免兩份計畫的指令交錯。
+
+    func(job) 回傳值存入 job.result；拋出例外時記錄於 job.error，
+    例外若帶有 status_code 屬性一併保留，供 API 回傳對應的 HTTP 狀態碼。
+    """
+
+    def __init__(self, max_workers=4, history_limit=200):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        self.history_limit = history_limit
+        self._jobs = OrderedDict()
+        self._device_queues = {}
+        self._busy_devices = set()
+        self._lock = threading.RLock()
+
+    def submit(self, device_id, func, metadata=None):
+        job = Job(device_id, func, metadata)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._trim_history()
+            if device_id in self._busy_devices:
+                self._device_queues.setdefault(device_id, deque()).append(job)
+                logger.info(f"工作 {job.job_id} 排隊中，等待裝置 {device_id} 完成目前工作")
+            else:
+                self._busy_devices.add(device_id)
+                self.executor.submit(self._run, job)
+        return job
+
+    def submit_detached(self, func, metadata=None):
+        """在獨立執行緒執行不佔用 worker 的協調工作 (例如多裝置執行)，其子工作再透過 submit() 排入佇列。"""
+        job = Job(None, func, metadata)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._trim_history()
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """取消工作；排隊中的工作直接移除，執行中的工作會在下一個步驟之前停止。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.cancel_event.set()
+            queued = self._device_queues.get(job.device_id)
+            if queued and job in queued:
+                queued.remove(job)
+                self._finish(job, "cancelled", error="工作已取消")
+        return job
+
+    def _run(self, job):
+        token = trace_id_var.set(job.trace_id)
+        try:
+            self._run_job(job)
+        finally:
+            trace_id_var.reset(token)
+        if job.device_id is not None:
+            self._dispatch_next(job.device_id)
+
+    def _run_job(self, job):
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled", error="工作已取消")
+        else:
+            job.status = "running"
+            job.started_at = time.time()
+            logger.info(f"開始執行工作 {job.job_id} (裝置 {job.device_id})")
+            try:
+                job.result = job.func(job)
+                self._finish(job, "succeeded")
+            except Exception as e:
+                status = "cancelled" if job.cancel_event.is_set() else "failed"
+                self._finish(job, status, error=str(e), status_code=getattr(e, "status_code", 500))
+
+    def _finish(self, job, status, error=None, status_code=None):
+        job.status = status
+        job.error = error
+        job.status_code = status_code
+        job.finished_at = time.time()
+        logger.info(f"工作 {job.job_id} 結束，狀態: {status}")
+        with job._events_cond:
+            job.done_event.set()
+            job._events_cond.notify_all()
+            callbacks, job._done_callbacks = job._done_callbacks, []
+        for callback in callbacks:
+            callback(job)
+
+    def _dispatch_next(self, device_id):
+        with self._lock:
+            queued = self._device_queues.get(device_id)
+            if queued:
+                self.executor.submit(self._run, queued.popleft())
+            else:
+                self._busy_devices.discard(device_id)
+                self._device_queues.pop(device_id, None)
+
+    def _trim_history(self):
+        # 只保留最近 history_limit 筆已結束的工作
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self._jobs) - self.history_limit)]:
+            del self._jobs[job_id]
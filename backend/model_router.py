@@ -0,0 +1,77 @@
+import json
+
+
+# 各呼叫者預設使用的模型；config.json 的 Models 區塊可逐項覆寫
+DEFAULT_MODELS = {
+    "assistant1": {"model": "gpt-4o", "temperature": 0.7},
+    "summary": {"model": "gpt-4o-mini", "temperature": 0.3},
+    "assistant2": {
+        # 一般步驟：只需輸出一個小 JSON 物件，使用較快、較便宜的模型與固定的輸出
+        "fast": {"model": "gpt-4o-mini", "temperature": 0, "json_mode": True},
+        # 升級：上一個動作失敗、回覆無法解析、互動式程式執行中，或 fast 模型判定 Error 時改用
+        "strong": {"model": "gpt-4o", "temperature": 0.2, "json_mode": True},
+        "max_parse_retries": 2,
+        "verify_errors": True,
+    },
+}
+
+# 升級的原因 (同時作為 metrics 的 label)
+ESCALATE_HANDOFF = "handoff"
+ESCALATE_FAILED_STEP = "failed_step"
+ESCALATE_PARSE_FAILURE = "parse_failure"
+ESCALATE_INTERACTIVE = "interactive"
+ESCALATE_VERIFY_ERROR = "verify_error"
+
+
+def parse_action(reply):
+    """將 Assistant2 的回覆解析為單一動作的 dict；不是 JSON 物件時回傳 None。
+
+    JSON mode 之外的模型偶爾會以 ```json 包覆或在前後加上說明，因此取第一個 { 到最後一個 } 之間的內容。
+    """
+    text = (reply or "").strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return None
+    try:
+        parsed = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) and parsed else None
+
+
+# === 模型路由：依呼叫者與 Assistant2 目前的狀態決定模型與參數 ===
+class ModelRouter:
+    def __init__(self, models_config=None, summary_model=None):
+        models_config = models_config or {}
+        self.assistant1 = {**DEFAULT_MODELS["assistant1"], **models_config.get("assistant1", {})}
+        # 舊版設定以 Context.summary_model 指定摘要模型
+        summary_default = {**DEFAULT_MODELS["summary"], **({"model": summary_model} if summary_model else {})}
+        self.summary = {**summary_default, **models_config.get("summary", {})}
+        assistant2 = {**DEFAULT_MODELS["assistant2"], **models_config.get("assistant2", {})}
+        self.fast = {**DEFAULT_MODELS["assistant2"]["fast"], **assistant2["fast"]}
+        self.strong = {**DEFAULT_MODELS["assistant2"]["strong"], **assistant2["strong"]}
+        self.max_parse_retries = assistant2["max_parse_retries"]
+        self.verify_errors = assistant2["verify_errors"]
+
+    def kwargs(self, purpose):
+        """回傳 assistant1 / summary 呼叫 chat completion 的 model 與 temperature 參數。"""
+        return self._completion_kwargs(getattr(self, purpose))
+
+    def assistant2_kwargs(self, escalate_reason=None):
+        """回傳 (tier 名稱, chat completion 參數)；escalate_reason 不為 None 時使用 strong tier。"""
+        tier = "strong" if escalate_reason else "fast"
+        return tier, self._completion_kwargs(self.strong if escalate_reason else self.fast)
+
+    @property
+    def tiered(self):
+        """fast 與 strong 為同一個模型時，升級不會有效果 (例如兩者都設定為 gpt-4o)。"""
+        return self.fast["model"] != self.strong["model"]
+
+    @staticmethod
+    def _completion_kwargs(settings):
+        kwargs = {"model": settings["model"], "temperature": settings.get("temperature", 0.7)}
+        if settings.get("seed") is not None:
+            kwargs["seed"] = settings["seed"]
+        if settings.get("json_mode"):
+            kwargs["response_format"] = {"type": "json_object"}
+        return kwargs
@@ -0,0 +1,41 @@
+import logging
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+# 既有索引的選項 (例如 expireAfterSeconds) 與要建立的不同時 MongoDB 回傳的錯誤碼
+INDEX_CONFLICT_CODES = (85, 86)  # IndexOptionsConflict / IndexKeySpecsConflict
+
+
+# === TTL 索引：設定檔的過期秒數改變時更新既有索引 ===
+def ensure_ttl_index(collection, field, ttl_seconds):
+    """直接 create_index 會因既有索引的 expireAfterSeconds 不同而失敗，此時改以 collMod 更新。"""
+    try:
+        collection.create_index(field, expireAfterSeconds=ttl_seconds)
+    except OperationFailure as e:
+        if e.code not in INDEX_CONFLICT_CODES:
+            raise
+        try:
+            collection.database.command(
+                "collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl_seconds})
+            logger.info(f"{collection.name}.{field} 的 TTL 索引已更新為 {ttl_seconds} 秒")
+        except OperationFailure as e:
+            # 讀取時仍會檢查時間，只是過期的文件不會自動刪除
+            logger.error(f"無法更新 {collection.name}.{field} 的 TTL 索引: {e}")
+
+
+async def ensure_ttl_index_async(collection, field, ttl_seconds):
+    """ensure_ttl_index() 的 asyncio 版本 (pymongo AsyncMongoClient 的 collection)。"""
+    try:
+        await collection.create_index(field, expireAfterSeconds=ttl_seconds)
+    except OperationFailure as e:
+        if e.code not in INDEX_CONFLICT_CODES:
+            raise
+        try:
+            await collection.database.command(
+                "collMod", collection.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl_seconds})
+            logger.info(f"{collection.name}.{field} 的 TTL 索引已更新為 {ttl_seconds} 秒")
+        except OperationFailure as e:
+            logger.error(f"無法更新 {collection.name}.{field} 的 TTL 索引: {e}")
@@ -0,0 +1,110 @@
+import re
+import textwrap
+
+
+# Markdown 的 fenced code block (允許清單內縮排)
+CODE_BLOCK_PATTERN = re.compile(
+    r"^(?P<indent>[ \t]*)```[ \t]*(?P<lang>[\w+-]*)(?P<info>[^\n]*)\n(?P<code>.*?)^[ \t]*```[ \t]*$",
+    re.MULTILINE | re.DOTALL,
+)
+
+# 視為需在 Raspberry Pi 上執行的 code block 語言
+SHELL_LANGUAGES = {"", "bash", "sh", "shell", "zsh", "console"}
+
+# code block 標頭中的 file=<路徑> 表示區塊內容為要寫入該路徑的完整檔案 (例如 ```python file=~/hello.py)
+FILE_TARGET_PATTERN = re.compile(r"(^|\s)file=(?P<path>\S+)")
+
+# 需要終端機互動的程式，交由 Assistant2 以 invoke_shell 處理
+INTERACTIVE_COMMAND_PATTERN = re.compile(
+    r"^(sudo\s+(-\S+\s+)*)?("
+    r"(nano|vi|vim|vim\.tiny|emacs|pico|less|more|top|htop|raspi-config|visudo|alsamixer|nmtui|passwd"
+    r"|mysql_secure_installation)\b"
+    r"|crontab\s+(-u\s+\S+\s+)?-e\b"
+    r"|(python3?|node|bash|sh)\s*$"
+    r")"
+)
+
+# 上述程式中可用參數改為非互動模式的指令 (例如 top -b 以批次模式輸出後結束)
+BATCH_MODE_PATTERN = re.compile(r"^(sudo\s+(-\S+\s+)*)?top\b.*\s(-[A-Za-z]*b|--batch)")
+
+# 未指定 -y 的 apt 安裝 / 移除會等待確認 (stdin 為 /dev/null 時直接中止)
+APT_CONFIRM_PATTERN = re.compile(r"^(sudo\s+)?apt(-get)?\s+(install|upgrade|full-upgrade|dist-upgrade|remove|purge|autoremove)\b")
+APT_YES_PATTERN = re.compile(r"\s(-\w*y\w*|--yes|--assume-yes)\b")
+
+# exit code 為 0 但仍可能代表失敗的輸出，交由 Assistant2 判斷
+# 只比對獨立的字詞：前後緊接路徑或檔名字元時 (例如 error.log、/var/log/failed-units、on_error) 不算
+SUSPICIOUS_OUTPUT_PATTERN = re.compile(
+    r"(?<![\w./-])(error|failed|failure|fatal|traceback|permission denied|command not found"
+    r"|no such file or directory|cannot|unable to|abort(ed)?)(?![\w/-]|\.\w)",
+    re.IGNORECASE,
+)
+
+# 無法安全地逐行拆開的語法 (heredoc、多行流程控制、函式定義)，整個 code block 視為一條指令
+COMPOUND_SYNTAX_PATTERN = re.compile(r"<<|^\s*(if|for|while|until|case|function|select)\b|[{(]\s*$|\\$", re.MULTILINE)
+
+
+def extract_tasks(markdown_content):
+    """將 Assistant1 的 Markdown 拆成依序執行的 Task，每個 shell code block 一個 Task。
+
+    回傳 [{"index": 1, "language": "bash", "code": "...", "commands": [...], "file": None}]；
+    標頭帶有 file=<路徑> 的 code block 為寫入檔案的 Task ("file" 為路徑，"code" 為檔案內容)。
+    其他語言的 code block (例如檔案內容範例) 僅作為參考，不會成為 Task。
+    """
+    tasks = []
+    for match in CODE_BLOCK_PATTERN.finditer(markdown_content):
+        language = match.group("lang").lower()
+        target = FILE_TARGET_PATTERN.search(match.group("info"))
+        if target is None and language not in SHELL_LANGUAGES:
+            continue
+        code = textwrap.dedent(match.group("code"))
+        if target is not None:
+            # 檔案內容保留第一行的縮排，只去除前後空行並以換行結尾
+            content = code.strip("\n").rstrip()
+            tasks.append({
+                "index": len(tasks) + 1,
+                "language": language,
+                "code": content + "\n" if content else "",
+                "commands": [],
+                "file": target.group("path"),
+            })
+        elif code.strip():
+            code = code.strip()
+            tasks.append({
+                "index": len(tasks) + 1,
+                "language": language or "bash",
+                "code": code,
+                "commands": split_commands(code, language),
+                "file": None,
+            })
+    return tasks
+
+
+def split_commands(code, language="bash"):
+    """將 code block 拆成可逐一直接執行的指令。
+
+    每個非空、非註解的行為一條指令；console 區塊的 "$ " 提示字元會被移除，
+    沒有提示字元的行視為輸出範例而略過。含有 heredoc 或多行語法時整個區塊為一條指令。
+    """
+    lines = code.splitlines()
+    if language == "console":
+        lines = [line.strip()[2:] for line in lines if line.strip().startswith("$ ")]
+        code = "\n".join(lines)
+    if COMPOUND_SYNTAX_PATTERN.search(code):
+        return [code] if code.strip() else []
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+def is_interactive_command(command):
+    """判斷指令是否需要終端機互動 (編輯器、確認提示等)，這類指令不走直接執行。"""
+    for part in re.split(r"&&|\|\||;|\|", command):
+        part = part.strip()
+        if INTERACTIVE_COMMAND_PATTERN.match(part) and not BATCH_MODE_PATTERN.match(part):
+            return True
+        if APT_CONFIRM_PATTERN.match(part) and not APT_YES_PATTERN.search(part):
+            return True
+    return False
+
+
+def looks_suspicious(output):
+    """exit code 為 0 時，以輸出內容判斷是否仍需要 Assistant2 確認結果。"""
+    return bool(SUSPICIOUS_OUTPUT_PATTERN.search(output))
@@ -0,0 +1,99 @@
+import posixpath
+import stat
+
+
+# SFTP 每次讀寫的區塊大小；寫入時以 pipelined 模式連續送出，不需逐塊等待伺服器回應
+CHUNK_SIZE = 32768
+
+
+# === 一次 WriteFile / ReadFile 的結果 ===
+class FileResult:
+    def __init__(self, action, path, size=0, offset=0, data=b"", remaining=0, mode=None, error=None):
+        self.action = action
+        self.path = path
+        self.size = size  # WriteFile：寫入的位元組數；ReadFile：檔案大小
+        self.offset = offset
+        self.data = data
+        self.remaining = remaining
+        self.mode = mode
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def binary(self):
+        return b"\0" in self.data
+
+    @property
+    def text(self):
+        return self.data.decode("utf-8", errors="replace")
+
+
+def parse_mode(mode):
+    """將 "755"、"0o644" 或 JSON 數字 644 轉成權限位元；None 表示不變更。"""
+    if mode is None or mode == "":
+        return None
+    try:
+        value = int(str(mode).strip(), 8)
+    except ValueError:
+        raise ValueError(f"無效的檔案權限: {mode}")
+    if not 0 <= value <= 0o7777:
+        raise ValueError(f"無效的檔案權限: {mode}")
+    return value
+
+
+def make_dirs(sftp, path):
+    """建立 path 及其不存在的上層目錄 (相當於 mkdir -p)。"""
+    missing = []
+    while path and path != "/":
+        try:
+            if not stat.S_ISDIR(sftp.stat(path).st_mode):
+                raise NotADirectoryError(f"{path} 不是目錄")
+            break
+        except FileNotFoundError:
+            missing.append(path)
+            path = posixpath.dirname(path)
+    for directory in reversed(missing):
+        sftp.mkdir(directory)
+
+
+def write_file(sftp, path, content, mode=None, append=False, chunk_size=CHUNK_SIZE):
+    """以 SFTP 分塊寫入檔案，必要時建立上層目錄；檔案系統錯誤 (權限不足等) 記錄在 FileResult.error。"""
+    data = content.encode("utf-8")
+    try:
+        mode = parse_mode(mode)
+        make_dirs(sftp, posixpath.dirname(path))
+        with sftp.open(path, "ab" if append else "wb") as remote:
+            remote.set_pipelined(True)
+            for start in range(0, len(data), chunk_size):
+                remote.write(data[start:start + chunk_size])
+        if mode is not None:
+            sftp.chmod(path, mode)
+    except (OSError, ValueError) as e:
+        return FileResult("WriteFile", path, error=str(e) or e.__class__.__name__)
+    return FileResult("WriteFile", path, size=len(data), mode=mode)
+
+
+def read_file(sftp, path, offset=0, length=None, limit=16384, chunk_size=CHUNK_SIZE, on_chunk=None):
+    """以 SFTP 分塊讀取檔案 offset 起最多 length 個位元組 (上限為 limit)；on_chunk(data) 會收到每個區塊。"""
+    length = limit if length is None else min(length, limit)
+    try:
+        if offset < 0 or length < 0:
+            raise ValueError("offset 與 length 不可為負數")
+        size = sftp.stat(path).st_size
+        data = bytearray()
+        with sftp.open(path, "rb") as remote:
+            remote.seek(offset)
+            while len(data) < length:
+                chunk = remote.read(min(chunk_size, length - len(data)))
+                if not chunk:
+                    break
+                data += chunk
+                if on_chunk:
+                    on_chunk(chunk)
+    except (OSError, ValueError) as e:
+        return FileResult("ReadFile", path, offset=offset, error=str(e) or e.__class__.__name__)
+    return FileResult("ReadFile", path, size=size, offset=offset, data=bytes(data),
+                      remaining=max(0, size - offset - len(data)))
@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+import json
+import re
+import unicodedata
+
+import pymongo
+
+from mongo_indexes import ensure_ttl_index, ensure_ttl_index_async
+
+
+# 正規化時忽略的結尾標點 (「檢查磁碟空間。」與「檢查磁碟空間」視為同一個需求)
+TRAILING_PUNCTUATION = ".。!！?？~～ "
+
+
+def normalize_request(text):
+    """全形轉半形、轉小寫並合併空白，讓只有格式不同的需求對應到同一筆快取。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip().rstrip(TRAILING_PUNCTUATION)
+
+
+def _digest(*parts):
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def request_cache_key(user_message, facts, prompt_version, context=()):
+    """Assistant1 回覆的快取鍵：正規化後的需求 + 裝置環境資訊 (不含蒐集時間) + system prompt 版本 + 對話脈絡。
+
+    context 為這則需求之前的對話 (摘要與最近訊息)，「繼續」、「再試一次」等簡短的後續訊息
+    只會命中相同對話脈絡下的回覆；新聊天室的第一則需求沒有脈絡，可在不同聊天室間共用。
+    """
+    facts = {key: value for key, value in (facts or {}).items() if key != "collected_at"}
+    conversation = [[message["role"], message["content"]] for message in context]
+    return _digest(prompt_version, normalize_request(user_message), json.dumps(facts, sort_keys=True, ensure_ascii=False),
+                   json.dumps(conversation, ensure_ascii=False))
+
+
+def plan_cache_key(markdown_content, device_id):
+    """Assistant2 執行紀錄的快取鍵：Markdown 內容 + 裝置。"""
+    return _digest(device_id, markdown_content)
+
+
+def _lookup(key, ttl_seconds):
+    """回傳 find_one_and_update 的 (filter, update)：只取未過期的項目，並更新最後使用時間。"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        {"key": key, "created_at": {"$gt": now - datetime.timedelta(seconds=ttl_seconds)}},
+        {"$set": {"last_used_at": now}, "$inc": {"hits": 1}},
+    )
+
+
+# (索引鍵, 選項)：同步與 asyncio 版本建立相同的索引，另外再加上 created_at 的 TTL 索引
+CACHE_INDEXES = [
+    ("key", {"unique": True}),
+    ([("last_used_at", pymongo.ASCENDING)], {}),
+]
+
+
+def _entry(key, value):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return {"$set": {"key": key, "value": value, "created_at": now, "last_used_at": now, "hits": 0}}
+
+
+# === 存於 MongoDB 的回應快取：逾時 (TTL) 自動刪除，超過筆數上限時淘汰最久未使用的項目 ===
+class ResponseCache:
+    def __init__(self, collection, ttl_seconds=604800, max_entries=500):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        for keys, options in CACHE_INDEXES:
+            self.collection.create_index(keys, **options)
+        # 與裝置環境資訊快取相同，讀取時仍會檢查時間，避免刪除排程延遲時用到過期資料
+        ensure_ttl_index(self.collection, "created_at", ttl_seconds)
+
+    def get(self, key):
+        """回傳快取的值並更新最後使用時間；沒有或已過期時回傳 None。"""
+        doc = self.collection.find_one_and_update(*_lookup(key, self.ttl_seconds))
+        return doc["value"] if doc else None
+
+    def put(self, key, value):
+        self.collection.update_one({"key": key}, _entry(key, value), upsert=True)
+        self._evict()
+
+    def invalidate(self, key):
+        self.collection.delete_one({"key": key})
+
+    def _evict(self):
+        excess = self.collection.count_documents({}) - self.max_entries
+        if excess > 0:
+            oldest = self.collection.find({}, {"_id": 1}).sort("last_used_at", 1).limit(excess)
+            self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
+
+
+# === asyncio 版回應快取 (pymongo AsyncMongoClient)，第一次使用時以非同步的 create_index 建立索引 ===
+class AsyncResponseCache:
+    def __init__(self, collection, ttl_seconds=604800, max_entries=500):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._ready = False
+
+    async def ensure_ready(self):
+        if self._ready:
+            return
+        for keys, options in CACHE_INDEXES:
+            await self.collection.create_index(keys, **options)
+        await ensure_ttl_index_async(self.collection, "created_at", self.ttl_seconds)
+        self._ready = True
+
+    async def get(self, key):
+        await self.ensure_ready()
+        doc = await self.collection.find_one_and_update(*_lookup(key, self.ttl_seconds))
+        return doc["value"] if doc else None
+
+    async def put(self, key, value):
+        await self.ensure_ready()
+        await self.collection.update_one({"key": key}, _entry(key, value), upsert=True)
+        excess = await self.collection.count_documents({}) - self.max_entries
+        if excess > 0:
+            oldest = await self.collection.find({}, {"_id": 1}).sort("last_used_at", 1).limit(excess).to_list(None)
+            await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
@@ -0,0 +1,44 @@
+import functools
+import logging
+import threading
+
+from werkzeug.local import LocalProxy
+
+logger = logging.getLogger(__name__)
+
+
+# === 共用服務：第一次使用時才建立，匯入 app 或建立 Flask app 時不連線任何外部服務 ===
+class LazyServices:
+    """register() 回傳的代理物件與原本的物件用法相同 (屬性、方法、[] 皆轉給實體)；
+    第一次使用時才呼叫建立函式，之後所有請求與執行緒共用同一個實體。
+    建立失敗時不會保留結果，下次使用時重新嘗試 (例如 MongoDB 暫時無法連線)。
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        # 建立函式可能再使用其他服務 (例如 chat_store 使用 db)，因此使用可重入的鎖
+        self._lock = threading.RLock()
+
+    def register(self, name, factory):
+        self._factories[name] = factory
+        return LocalProxy(functools.partial(self.get, name))
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(name)
+                if instance is None:
+                    instance = self._factories[name]()
+                    self._instances[name] = instance
+                    logger.info(f"{name} 建立成功")
+        return instance
+
+    def created(self, name):
+        return name in self._instances
+
+    def reset(self, name):
+        """捨棄已建立的實體 (例如 API Key 變更)，下次使用時重新建立；回傳被捨棄的實體或 None。"""
+        with self._lock:
+            return self._instances.pop(name, None)
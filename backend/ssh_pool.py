@@ -0,0 +1,170 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+import paramiko
+
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+
+# === 單一裝置的連線狀態 ===
+class _DeviceEntry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = threading.Condition()
+        self.channels = 0
+        self.leases = 0
+        self.client = None
+        self.signature = None
+        # 已損壞或已被取代、但仍可能有人借用中的連線，等所有借用都歸還後才關閉
+        self.retired = []
+
+
+# === 依 device_id 保存長連線的 SSH 連線池 ===
+class DeviceConnectionPool:
+    """每次借出時宣告該次最多會同時開啟的 channel 數 (shell、互動式 shell、SFTP 各算一條)，
+    同一裝置借出中的 channel 總數不超過 max_channels_per_device (應小於 sshd 的 MaxSessions)。
+    在借出時預留而非開啟時才計算，避免兩個執行各自開到一半後互相等待。
+    """
+
+    def __init__(self, keepalive_interval=30, max_channels_per_device=4, connect_timeout=10, acquire_timeout=60):
+        self.keepalive_interval = keepalive_interval
+        self.max_channels_per_device = max_channels_per_device
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self._entries = {}
+        self._entries_lock = threading.Lock()
+
+    def _entry(self, device_id):
+        with self._entries_lock:
+            entry = self._entries.get(device_id)
+            if entry is None:
+                entry = _DeviceEntry()
+                self._entries[device_id] = entry
+            return entry
+
+    @staticmethod
+    def _signature(device_info):
+        return (
+            device_info.get("hostname"),
+            device_info.get("port", 22),
+            device_info.get("username"),
+            device_info.get("password"),
+        )
+
+    @staticmethod
+    def _is_alive(client):
+        if client is None:
+            return False
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect(self, device_id, device_info):
+        hostname = device_info.get("hostname")
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        logger.info(f"連線池建立 {device_id} ({hostname}) 的 SSH 連線 ...")
+        with span("ssh.connect", device_id=device_id):
+            client.connect(
+                hostname=hostname,
+                username=device_info.get("username"),
+                password=device_info.get("password"),
+                port=device_info.get("port", 22),
+                timeout=self.connect_timeout,
+            )
+        client.get_transport().set_keepalive(self.keepalive_interval)
+        logger.info(f"{device_id} SSH 連線建立成功")
+        return client
+
+    def get_client(self, device_id, device_info):
+        """取得裝置的 SSHClient；連線已中斷或連線資訊變更時自動重新連線。"""
+        entry = self._entry(device_id)
+        signature = self._signature(device_info)
+        with entry.lock:
+            if entry.client is not None and (entry.signature != signature or not self._is_alive(entry.client)):
+                logger.info(f"{device_id} SSH 連線失效，重新連線")
+                self._retire(entry)
+            if entry.client is None:
+                entry.client = self._connect(device_id, device_info)
+                entry.signature = signature
+            return entry.client
+
+    def acquire(self, device_id, device_info, channels=1, timeout=None):
+        """借出裝置連線並預留 channels 條 channel；timeout 未指定時使用 acquire_timeout，逾時拋出 TimeoutError。"""
+        entry = self._entry(device_id)
+        channels = min(channels, self.max_channels_per_device)
+        timeout = self.acquire_timeout if timeout is None else timeout
+        with entry.slots:
+            if not entry.slots.wait_for(lambda: entry.channels + channels <= self.max_channels_per_device, timeout):
+                raise TimeoutError(f"裝置 {device_id} 的 SSH 通道已達上限 ({self.max_channels_per_device})")
+            entry.channels += channels
+            entry.leases += 1
+        try:
+            return self.get_client(device_id, device_info)
+        except Exception:
+            self.release(device_id, channels)
+            raise
+
+    def release(self, device_id, channels=1, discard=False):
+        """歸還借出的連線與預留的 channel；discard=True 表示連線已損壞，之後的借出改用新連線，
+        其他人仍在使用的舊連線等最後一個借用歸還時才關閉。"""
+        entry = self._entry(device_id)
+        if discard:
+            self.invalidate(device_id)
+        with entry.slots:
+            entry.channels -= min(channels, self.max_channels_per_device)
+            entry.leases -= 1
+            idle = entry.leases == 0
+            entry.slots.notify_all()
+        if idle:
+            self._close_retired(device_id, entry)
+
+    @contextmanager
+    def lease(self, device_id, device_info, channels=1, timeout=None):
+        client = self.acquire(device_id, device_info, channels=channels, timeout=timeout)
+        discard = False
+        try:
+            yield client
+        except (paramiko.SSHException, OSError):
+            discard = True
+            raise
+        finally:
+            self.release(device_id, channels, discard=discard)
+
+    def invalidate(self, device_id):
+        """捨棄裝置目前的連線，下次借出時會重新建立；借用中的連線於歸還後才關閉。"""
+        entry = self._entry(device_id)
+        with entry.lock:
+            if entry.client is not None:
+                self._retire(entry)
+                logger.info(f"已捨棄 {device_id} 的 SSH 連線")
+        with entry.slots:
+            idle = entry.leases == 0
+        if idle:
+            self._close_retired(device_id, entry)
+
+    @staticmethod
+    def _retire(entry):
+        # 呼叫端須持有 entry.lock
+        entry.retired.append(entry.client)
+        entry.client = None
+
+    @staticmethod
+    def _close_retired(device_id, entry):
+        with entry.lock:
+            retired, entry.retired = entry.retired, []
+        for client in retired:
+            client.close()
+        if retired:
+            logger.info(f"已關閉 {device_id} 的 {len(retired)} 條舊 SSH 連線")
+
+    def close_all(self):
+        with self._entries_lock:
+            entries = list(self._entries.items())
+        for device_id, entry in entries:
+            with entry.lock:
+                if entry.client is not None:
+                    self._retire(entry)
+            self._close_retired(device_id, entry)
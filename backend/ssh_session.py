@@ -0,0 +1,636 @@
+import base64
+import codecs
+import logging
+import posixpath
+import re
+import select
+import shlex
+import time
+import uuid
+
+from remote_files import read_file, write_file
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+
+# 非互動式指令每個輸出串流 (stdout / stderr) 預設保留的位元組數
+DEFAULT_OUTPUT_BUDGET = 16384
+
+
+# === 只保留開頭與結尾的輸出緩衝區 ===
+class BoundedBuffer:
+    """保留輸出的前半與後半共 budget 個位元組，中間超出的部分只記錄被捨棄的數量。
+
+    budget 為 None 時不設上限 (供內部指令，例如擷取 env 使用)。
+    """
+
+    def __init__(self, budget=DEFAULT_OUTPUT_BUDGET):
+        if budget is None:
+            self.head_limit = self.tail_limit = None
+        else:
+            budget = max(budget, 2048)
+            self.head_limit = budget // 2
+            self.tail_limit = budget - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    def write(self, data):
+        if self.head_limit is None:
+            self.head += data
+            return
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            excess = len(self.tail) - self.tail_limit
+            if excess > 0:
+                del self.tail[:excess]
+                self.dropped += excess
+
+    def recent(self, size):
+        return bytes(self.head[-size:] + self.tail)[-size:]
+
+    def cut_at_last(self, marker):
+        """移除最後一個 marker (含) 之後的內容，並回傳 marker 之後的位元組。"""
+        data = bytes(self.head + self.tail)
+        index = data.rfind(marker)
+        if index == -1:
+            return b""
+        trailer = data[index + len(marker):]
+        if index >= len(self.head):
+            del self.tail[index - len(self.head):]
+        else:
+            del self.head[index:]
+            self.tail.clear()
+        return trailer
+
+    def text(self):
+        head = bytes(self.head).decode("utf-8", errors="ignore")
+        tail = bytes(self.tail).decode("utf-8", errors="ignore")
+        if self.dropped:
+            return f"{head}\n... [省略 {self.dropped} bytes] ...\n{tail}"
+        return head + tail
+
+
+def drain_channel(channel, stdout_buf, stderr_buf, wait):
+    """等待至多 wait 秒，並將 channel 目前可讀的 stdout 與 stderr 一併讀入緩衝區。"""
+    select.select([channel], [], [], wait)
+    while channel.recv_ready():
+        stdout_buf.write(channel.recv(65536))
+    while channel.recv_stderr_ready():
+        stderr_buf.write(channel.recv_stderr(65536))
+
+
+def partial_marker_length(data, marker):
+    """data 結尾可能是 marker 開頭的最長長度，這部分需等下一個區塊才能判斷。"""
+    for length in range(min(len(marker) - 1, len(data)), 0, -1):
+        if marker.startswith(bytes(data[-length:])):
+            return length
+    return 0
+
+
+# === 即時輸出：將位元組區塊解碼後轉交給 on_output(stream, text) ===
+class LiveOutput:
+    """marker 不為 None 時，遇到 marker 即停止轉交，且保留可能是 marker 開頭的結尾位元組。"""
+
+    def __init__(self, stream, on_output, marker=None, transform=None):
+        self.stream = stream
+        self.on_output = on_output
+        self.marker = marker
+        self.transform = transform
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.pending = b""
+        self.finished = False
+
+    def __call__(self, data):
+        if self.finished:
+            return
+        if self.marker is not None:
+            data = self.pending + data
+            index = data.find(self.marker)
+            if index != -1:
+                data = data[:index]
+                self.finished = True
+                self.pending = b""
+            else:
+                keep = partial_marker_length(data, self.marker)
+                data, self.pending = data[:len(data) - keep], data[len(data) - keep:]
+        text = self.decoder.decode(data)
+        if self.transform:
+            text = self.transform(text)
+        if text:
+            self.on_output(self.stream, text)
+
+
+# === 單一指令的執行結果 ===
+class CommandResult:
+    def __init__(self, command, stdout, stderr, exit_code, cwd, timed_out=False,
+                 stdout_dropped=0, stderr_dropped=0):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.cwd = cwd
+        self.timed_out = timed_out
+        self.stdout_dropped = stdout_dropped
+        self.stderr_dropped = stderr_dropped
+
+    @classmethod
+    def from_buffers(cls, command, stdout_buf, stderr_buf, exit_code, cwd, timed_out=False):
+        return cls(command, stdout_buf.text(), stderr_buf.text(), exit_code, cwd, timed_out,
+                   stdout_buf.dropped, stderr_buf.dropped)
+
+    @property
+    def ok(self):
+        return self.exit_code == 0 and not self.timed_out
+
+    @property
+    def dropped_bytes(self):
+        return self.stdout_dropped + self.stderr_dropped
+
+    @property
+    def combined_output(self):
+        return (self.stdout + "\n" + self.stderr).strip()
+
+
+def capture_exec(ssh_client, command, output_budget=DEFAULT_OUTPUT_BUDGET, timeout=300):
+    """以 exec_command 執行單一非互動式指令，同時讀取 stdout / stderr 並取得 exit code。
+
+    兩個串流交錯讀取，避免大量 stderr 塞滿 channel window 造成 stdout 卡住。
+    """
+    with span("ssh.exec_command") as current:
+        channel = ssh_client.get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            channel.shutdown_write()
+            stdout_buf = BoundedBuffer(output_budget)
+            stderr_buf = BoundedBuffer(output_budget)
+            deadline = time.monotonic() + timeout
+            while not (channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    current.status = "timeout"
+                    return CommandResult.from_buffers(command, stdout_buf, stderr_buf, None, None, timed_out=True)
+                drain_channel(channel, stdout_buf, stderr_buf, min(remaining, 1.0))
+            exit_code = channel.recv_exit_status()
+            current.set(exit_code=exit_code)
+            return CommandResult.from_buffers(command, stdout_buf, stderr_buf, exit_code, None)
+        finally:
+            channel.close()
+
+
+# 可能改變環境變數的指令，執行後需重新擷取 env
+ENV_CHANGING_PATTERN = re.compile(r"(^|[\s;&|(])(export|unset|source|\.)\s")
+
+# 互動式 shell 輸出中的 ANSI 控制碼 (nano 等全螢幕程式會大量輸出)
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07]*\x07|[()][0-9A-Za-z]|[@-Z\\-_=>])")
+
+# 互動式 shell 判斷「程式已就緒、等待輸入」的提示字元；第一個為 shell 本身的提示字元
+# 以 \Z 錨定在輸出的最末端：提示字元之後不會再有換行，結尾為 "$ \n" 的一般輸出行不算提示字元
+SHELL_PROMPT_PATTERN = re.compile(r"[$#] \Z")
+DEFAULT_PROMPT_PATTERNS = [
+    SHELL_PROMPT_PATTERN,
+    re.compile(r"\[[Yy]/[Nn]\][ \t]*\Z"),
+    re.compile(r"\([Yy]es/[Nn]o[^)]*\)\??[ \t]*\Z"),
+    re.compile(r"[Pp]assword[^:\n]*:[ \t]*\Z"),
+]
+
+# 全螢幕程式 (nano、less、vim 等) 切換到 / 離開 alternate screen 的控制碼
+ALT_SCREEN_PATTERN = re.compile(rb"\x1b\[\?(?:1049|1047|47)([hl])")
+
+# SendKeys 可用的按鍵名稱
+KEY_SEQUENCES = {
+    "enter": "\r",
+    "tab": "\t",
+    "esc": "\x1b",
+    "space": " ",
+    "backspace": "\x7f",
+    "up": "\x1b[A",
+    "down": "\x1b[B",
+    "right": "\x1b[C",
+    "left": "\x1b[D",
+}
+
+
+def encode_keys(keys):
+    """將 ["ctrl+x", "y", "enter"] 之類的按鍵描述轉成實際送出的字元。"""
+    if isinstance(keys, str):
+        keys = [keys]
+    encoded = ""
+    for key in keys:
+        name = key.strip().lower()
+        if name.startswith("ctrl+") and len(name) == 6:
+            encoded += chr(ord(name[-1].upper()) - 64)
+        elif name in KEY_SEQUENCES:
+            encoded += KEY_SEQUENCES[name]
+        else:
+            encoded += key
+    return encoded
+
+
+def strip_ansi(text):
+    return ANSI_ESCAPE_PATTERN.sub("", text).replace("\r\n", "\n").replace("\r", "\n")
+
+
+# === 互動式 shell 的一次讀取結果 ===
+class ExpectResult:
+    def __init__(self, output, reason, at_shell_prompt):
+        self.output = output
+        # "prompt"：偵測到提示字元 (shell 或 [Y/n]、密碼等輸入提示)
+        # "idle"：未偵測到提示字元，但輸出已靜止且畫面停在全螢幕程式或未換行的一行 (可能在等待輸入)
+        # "timeout"：直到 hard_timeout 都沒有提示字元 (程式可能仍在執行) / "closed"：channel 已關閉
+        self.reason = reason
+        self.at_shell_prompt = at_shell_prompt
+
+
+def awaits_input(data, alternate_screen):
+    """輸出靜止時判斷程式是否可能在等待輸入：全螢幕程式仍開啟中，或最後一行尚未換行 (例如 "Name: ")。
+
+    以 \r 重繪的進度列 (apt、pip 下載) 與以換行結尾的一般輸出視為仍在執行。
+    """
+    if alternate_screen:
+        return True
+    last_line = bytes(data[data.rfind(b"\n") + 1:])
+    if b"\r" in last_line:
+        return False
+    return bool(strip_ansi(last_line.decode("utf-8", errors="ignore")).strip())
+
+
+# === invoke_shell() 的 expect 式讀取器 ===
+class InteractiveShell:
+    """保留同一條 invoke_shell() channel，偵測到提示字元時立即返回。
+
+    idle_timeout：輸出靜止多久後檢查畫面是否停在全螢幕程式或未換行的輸入提示 (例如 nano 畫面已繪製完成)，
+    是的話即返回；否則 (例如 apt、pip 下載時長時間沒有輸出) 繼續讀取。
+    hard_timeout：單次讀取的最長等待時間，避免長時間指令無限等待。
+    """
+
+    def __init__(self, ssh_client, idle_timeout=3.0, hard_timeout=120, prompt_patterns=None):
+        self.ssh_client = ssh_client
+        self.idle_timeout = idle_timeout
+        self.hard_timeout = hard_timeout
+        self.prompt_patterns = prompt_patterns or DEFAULT_PROMPT_PATTERNS
+        self.channel = None
+        self.at_shell_prompt = False
+        self.alternate_screen = False
+
+    def open(self, cwd=None):
+        with span("ssh.invoke_shell"):
+            self.channel = self.ssh_client.invoke_shell(width=200, height=50)
+            self.expect()
+        if cwd:
+            self.send_line(f"cd {shlex.quote(cwd)}")
+        return self
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    @property
+    def alive(self):
+        return self.channel is not None and not self.channel.closed and not self.channel.exit_status_ready()
+
+    def send_line(self, text, **expect_kwargs):
+        with span("ssh.interactive", kind="line") as current:
+            stale = self._take_stale_output()
+            self.channel.sendall((text + "\n").encode("utf-8"))
+            result = self.expect(stale=stale, **expect_kwargs)
+            current.set(reason=result.reason)
+            return result
+
+    def send_keys(self, keys, **expect_kwargs):
+        with span("ssh.interactive", kind="keys") as current:
+            stale = self._take_stale_output()
+            self.channel.sendall(encode_keys(keys).encode("utf-8"))
+            result = self.expect(stale=stale, **expect_kwargs)
+            current.set(reason=result.reason)
+            return result
+
+    def _take_stale_output(self):
+        """送出前先讀走上一次讀取返回後才收到的輸出，避免其中舊的提示字元被當成這次的結果。"""
+        stale = bytearray()
+        while self.channel.recv_ready():
+            stale += self.channel.recv(65536)
+        self._track_screen(stale)
+        return bytes(stale)
+
+    def _track_screen(self, data):
+        modes = ALT_SCREEN_PATTERN.findall(bytes(data))
+        if modes:
+            self.alternate_screen = modes[-1] == b"h"
+
+    def expect(self, patterns=None, idle_timeout=None, hard_timeout=None, on_output=None, stale=b""):
+        """讀取輸出直到偵測到提示字元、輸出靜止、逾時或 channel 關閉。
+
+        stale 為送出前已讀走的舊輸出：會併入回傳的 output，但不用來比對提示字元。
+        """
+        patterns = patterns or self.prompt_patterns
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        hard_timeout = self.hard_timeout if hard_timeout is None else hard_timeout
+        start = last_data = time.monotonic()
+        buf = bytearray()
+        reason = "timeout"
+        matched = None
+        live = LiveOutput("interactive", on_output, transform=strip_ansi) if on_output else None
+        if live and stale:
+            live(stale)
+        while True:
+            now = time.monotonic()
+            if now - start >= hard_timeout:
+                break
+            quiet = now - last_data
+            if quiet >= idle_timeout:
+                if awaits_input(buf, self.alternate_screen):
+                    reason = "idle"
+                    break
+                # 沒有提示字元且看起來仍在執行：繼續讀取到 hard_timeout，每秒檢查一次 channel 是否關閉
+                wait = min(hard_timeout - (now - start), 1.0)
+            else:
+                wait = min(idle_timeout - quiet, hard_timeout - (now - start))
+            select.select([self.channel], [], [], max(wait, 0.01))
+            received = len(buf)
+            while self.channel.recv_ready():
+                data = self.channel.recv(65536)
+                buf += data
+                if live:
+                    live(data)
+            if len(buf) > received:
+                last_data = time.monotonic()
+                # 控制碼可能被切在兩個區塊之間，因此從上一個區塊的結尾前幾個位元組開始找
+                self._track_screen(buf[max(received - 8, 0):])
+                tail = strip_ansi(bytes(buf[-1024:]).decode("utf-8", errors="ignore"))
+                matched = next((p for p in patterns if p.search(tail)), None)
+                if matched is not None:
+                    reason = "prompt"
+                    break
+            elif self.channel.closed or self.channel.exit_status_ready():
+                reason = "closed"
+                break
+        self.at_shell_prompt = matched is SHELL_PROMPT_PATTERN
+        if self.at_shell_prompt:
+            self.alternate_screen = False
+        output = strip_ansi((stale + bytes(buf)).decode("utf-8", errors="ignore"))
+        return ExpectResult(output, reason, self.at_shell_prompt)
+
+
+# === 每次執行 (一次 /assistant2/execute) 共用的持續性 shell ===
+class ExecutionSession:
+    """在同一條 SSH channel 上保留一個 bash，讓 cd / export 延續到後續指令。
+
+    每條指令以 base64 包裝後交給 eval 執行，結束後在 stdout 與 stderr 各印出一次
+    sentinel 標記，藉此精準切出該指令的輸出、exit code 與執行後的工作目錄。
+    """
+
+    # 同時開啟的 SSH channel 上限：持續性 shell、互動式 shell 與 SFTP 各一條 (向連線池借出時預留)
+    CHANNELS = 3
+
+    def __init__(self, ssh_client, command_timeout=300, output_budget=DEFAULT_OUTPUT_BUDGET,
+                 interactive_options=None):
+        self.ssh_client = ssh_client
+        self.command_timeout = command_timeout
+        self.output_budget = output_budget
+        self.interactive_options = interactive_options or {}
+        self.interactive = None
+        self._sftp = None
+        self.token = f"__A2_DONE_{uuid.uuid4().hex}__"
+        self.channel = None
+        self._pending_stdout = bytearray()
+        self._pending_stderr = bytearray()
+        self.cwd = None
+        self.env = {}
+        self._baseline_env = None
+
+    # --- 生命週期 ---
+    def start(self):
+        with span("ssh.session_start"):
+            self.channel = self.ssh_client.get_transport().open_session()
+            self.channel.exec_command("bash --noprofile --norc")
+            if self._baseline_env is None:
+                self._baseline_env = self._snapshot_env()
+            elif self.cwd or self.env:
+                self._restore_state()
+            result = self._run_framed("true")
+            self.cwd = result.cwd
+        return self
+
+    def close(self):
+        if self.interactive is not None:
+            self.interactive.close()
+            self.interactive = None
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        self._close_channel()
+
+    def _close_channel(self):
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+        self._pending_stdout.clear()
+        self._pending_stderr.clear()
+
+    @property
+    def alive(self):
+        return self.channel is not None and not self.channel.closed and not self.channel.exit_status_ready()
+
+    def interactive_shell(self):
+        """取得本次執行共用的互動式 shell；若仍停在 shell 提示字元則先切換到目前 cwd。"""
+        if self.interactive is None or not self.interactive.alive:
+            self.interactive = InteractiveShell(self.ssh_client, **self.interactive_options).open(self.cwd)
+        elif self.interactive.at_shell_prompt and self.cwd:
+            self.interactive.send_line(f"cd {shlex.quote(self.cwd)}")
+        return self.interactive
+
+    # --- 指令執行 ---
+    def run(self, command, timeout=None, on_output=None):
+        """執行一條非互動式指令；on_output(stream, text) 會即時收到 stdout / stderr 的輸出片段。"""
+        if not self.alive:
+            logger.info("持續性 shell 已結束，重新啟動並還原工作目錄與環境變數")
+            self._close_channel()
+            self.start()
+        with span("ssh.run") as current:
+            result = self._run_framed(command, timeout=timeout, on_output=on_output)
+            current.set(exit_code=result.exit_code)
+            if result.timed_out:
+                current.status = "timeout"
+        if result.cwd:
+            self.cwd = result.cwd
+        if self.alive and ENV_CHANGING_PATTERN.search(command):
+            self._update_env()
+        return result
+
+    def run_batch(self, commands, timeout=None, on_output=None):
+        """一次送出多條非互動式指令依序執行，任一條失敗 (exit code 非 0 或逾時) 即停止。
+
+        回傳已執行指令的 CommandResult 列表；未執行的指令不在列表中。timeout 為每條指令的上限。
+        """
+        if not self.alive:
+            logger.info("持續性 shell 已結束，重新啟動並還原工作目錄與環境變數")
+            self._close_channel()
+            self.start()
+        # 由最後一條往前包成巢狀 if，前一條成功才會執行下一條
+        script = ""
+        for command in reversed(commands):
+            guarded = f"if [ \"$__a2_rc\" -eq 0 ]; then\n{script}fi\n" if script else ""
+            script = self._frame(command) + guarded
+        with span("ssh.run_batch", commands=len(commands)) as current:
+            self.channel.sendall(script.encode("utf-8"))
+            results = []
+            for command in commands:
+                result = self._read_until_sentinel(command, timeout or self.command_timeout, self.output_budget, on_output)
+                results.append(result)
+                if result.cwd:
+                    self.cwd = result.cwd
+                if not result.ok or not self.alive:
+                    break
+            current.set(executed=len(results))
+        if self.alive and any(ENV_CHANGING_PATTERN.search(result.command) for result in results):
+            self._update_env()
+        return results
+
+    # --- 檔案讀寫 (SFTP，與 shell 共用同一條 SSH 連線) ---
+    def sftp(self):
+        if self._sftp is None:
+            with span("sftp.open"):
+                self._sftp = self.ssh_client.open_sftp()
+        return self._sftp
+
+    def resolve_path(self, path):
+        """~ 展開為家目錄，相對路徑以目前 cwd 為準。"""
+        home = (self._baseline_env or {}).get("HOME", "")
+        if home and (path == "~" or path.startswith("~/")):
+            path = home + path[1:]
+        return posixpath.normpath(posixpath.join(self.cwd or home or "/", path))
+
+    def write_file(self, path, content, mode=None, append=False):
+        with span("sftp.write_file") as current:
+            result = write_file(self.sftp(), self.resolve_path(path), content, mode=mode, append=append)
+            current.set(bytes=result.size)
+            if not result.ok:
+                current.status = "error"
+            return result
+
+    def read_file(self, path, offset=0, length=None, on_output=None):
+        """讀取檔案的指定範圍，最多 output_budget 個位元組；on_output 會以 stdout 即時收到內容。"""
+        on_chunk = LiveOutput("stdout", on_output) if on_output else None
+        with span("sftp.read_file") as current:
+            result = read_file(self.sftp(), self.resolve_path(path), offset=offset, length=length,
+                               limit=self.output_budget, on_chunk=on_chunk)
+            current.set(bytes=len(result.data))
+            if not result.ok:
+                current.status = "error"
+            return result
+
+    def _frame(self, command):
+        # 指令以 base64 傳送並以 eval 執行，結束後以 sentinel 回報 exit code 與目前工作目錄
+        encoded = base64.b64encode(command.encode("utf-8")).decode("ascii")
+        return (
+            f"eval \"$(printf '%s' '{encoded}' | base64 -d)\" </dev/null\n"
+            "__a2_rc=$?\n"
+            f"printf '\\n{self.token} %d %s\\n' \"$__a2_rc\" \"$PWD\"\n"
+            f"printf '\\n{self.token}\\n' >&2\n"
+        )
+
+    def _run_framed(self, command, timeout=None, bounded=True, on_output=None):
+        self.channel.sendall(self._frame(command).encode("utf-8"))
+        output_budget = self.output_budget if bounded else None
+        return self._read_until_sentinel(command, timeout or self.command_timeout, output_budget, on_output)
+
+    def _read_until_sentinel(self, command, timeout, output_budget, on_output=None):
+        marker = ("\n" + self.token).encode("utf-8")
+        on_stdout = LiveOutput("stdout", on_output, marker) if on_output else None
+        on_stderr = LiveOutput("stderr", on_output, marker) if on_output else None
+        deadline = time.monotonic() + timeout
+        stdout_buf = BoundedBuffer(output_budget)
+        stderr_buf = BoundedBuffer(output_budget)
+        stdout_done = stderr_done = False
+        while True:
+            # 批次執行時 channel 中可能已有下一條指令的輸出，只取到本指令的 sentinel 為止
+            stdout_done = stdout_done or self._take_until_trailer(self._pending_stdout, stdout_buf, on_stdout, marker)
+            stderr_done = stderr_done or self._take_until_trailer(self._pending_stderr, stderr_buf, on_stderr, marker)
+            if stdout_done and stderr_done:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # 逾時：關閉 channel 以終止遠端程序，下次 run() 時重新啟動 shell
+                self._close_channel()
+                return CommandResult.from_buffers(command, stdout_buf, stderr_buf, None, self.cwd, timed_out=True)
+            select.select([self.channel], [], [], min(remaining, 1.0))
+            while self.channel.recv_ready():
+                self._pending_stdout += self.channel.recv(65536)
+            while self.channel.recv_stderr_ready():
+                self._pending_stderr += self.channel.recv_stderr(65536)
+            if self.channel.exit_status_ready() and not self.channel.recv_ready() \
+                    and not self.channel.recv_stderr_ready() \
+                    and self._pending_stdout.find(marker) == self._pending_stderr.find(marker) == -1:
+                # 指令中途結束了 shell (例如 exit)，以 shell 的結束碼回報
+                for pending, buf, live in ((self._pending_stdout, stdout_buf, on_stdout),
+                                           (self._pending_stderr, stderr_buf, on_stderr)):
+                    buf.write(bytes(pending))
+                    if live:
+                        live(bytes(pending))
+                    pending.clear()
+                return CommandResult.from_buffers(command, stdout_buf, stderr_buf,
+                                                  self.channel.recv_exit_status(), self.cwd)
+
+        trailer = stdout_buf.cut_at_last(marker)
+        stderr_buf.cut_at_last(marker)
+        exit_code, _, cwd = trailer.decode("utf-8", errors="ignore").strip().partition(" ")
+        return CommandResult.from_buffers(command, stdout_buf, stderr_buf, int(exit_code), cwd)
+
+    @staticmethod
+    def _take_until_trailer(pending, buf, live, marker):
+        """將 pending 中屬於目前指令的位元組移入 buf；若已含完整的 sentinel 行則一併移入並回傳 True。
+
+        可能是 marker 開頭的結尾位元組會留在 pending，等下一個區塊再判斷。
+        """
+        index = pending.find(marker)
+        if index != -1:
+            end = pending.find(b"\n", index + len(marker))
+            if end != -1:
+                size = end + 1
+            else:
+                size = index
+        else:
+            size = len(pending) - partial_marker_length(pending, marker)
+        if size:
+            data = bytes(pending[:size])
+            del pending[:size]
+            buf.write(data)
+            if live:
+                live(data)
+        return index != -1 and size > index
+
+    # --- 環境變數追蹤 ---
+    def _snapshot_env(self):
+        result = self._run_framed("env -0", bounded=False)
+        snapshot = {}
+        for item in result.stdout.split("\0"):
+            key, sep, value = item.partition("=")
+            if sep and key and not key.startswith("__a2"):
+                snapshot[key] = value
+        return snapshot
+
+    def _update_env(self):
+        current = self._snapshot_env()
+        env = {key: value for key, value in current.items() if self._baseline_env.get(key) != value}
+        env.update({key: None for key in self._baseline_env if key not in current})
+        env.pop("OLDPWD", None)
+        env.pop("PWD", None)
+        self.env = env
+
+    def _restore_state(self):
+        lines = []
+        for key, value in self.env.items():
+            if value is None:
+                lines.append(f"unset {key}")
+            else:
+                lines.append(f"export {key}={shlex.quote(value)}")
+        if self.cwd:
+            lines.append(f"cd {shlex.quote(self.cwd)}")
+        self._run_framed("\n".join(lines))
@@ -0,0 +1,256 @@
+import bisect
+import contextvars
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pymongo.monitoring
+
+
+# === 追蹤 ID：每個 HTTP 請求一個，跟著背景工作與執行緒傳遞，寫入每一行 log ===
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id():
+    return trace_id_var.get()
+
+
+def start_thread(target, *args, name=None):
+    """以目前的 context (含追蹤 ID) 啟動 daemon 執行緒。"""
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target, *args), name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+# === Prometheus 指標 (text exposition format 0.0.4) ===
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SPAN_DURATION = REGISTRY.histogram(
+    "agent_span_duration_seconds", "Duration of instrumented operations (OpenAI calls, SSH, SFTP).", ["span", "status"])
+LLM_TOKENS = REGISTRY.counter(
+    "agent_llm_tokens_total", "Tokens used by chat completions.", ["model", "purpose", "type"])
+MONGO_COMMAND_DURATION = REGISTRY.histogram(
+    "agent_mongo_command_duration_seconds", "Duration of MongoDB commands.", ["command", "status"])
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "agent_http_request_duration_seconds", "Duration of HTTP requests (until the response object is returned).",
+    ["method", "endpoint", "status"])
+EXECUTIONS = REGISTRY.counter(
+    "agent_executions_total", "Markdown executions on a device by final status.", ["status"])
+EXECUTION_ITERATIONS = REGISTRY.histogram(
+    "agent_execution_iterations", "Assistant2 iterations (LLM round trips) per execution.", [],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+TASKS = REGISTRY.counter(
+    "agent_tasks_total", "Tasks by how they were completed (direct, replayed, assistant2) and status.", ["path", "status"])
+CACHE_LOOKUPS = REGISTRY.counter(
+    "agent_cache_lookups_total", "Response cache lookups by cache and result.", ["cache", "result"])
+MODEL_ESCALATIONS = REGISTRY.counter(
+    "agent_model_escalations_total", "Assistant2 requests routed to the strong model, by reason.", ["reason"])
+
+
+# === 計時區段：記錄到 SPAN_DURATION，並以 DEBUG 等級輸出結構化 log ===
+logger = logging.getLogger("telemetry")
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.status = "ok"
+        self.started = time.monotonic()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        duration = time.monotonic() - self.started
+        SPAN_DURATION.observe(duration, span=self.name, status=self.status)
+        logger.debug(f"span {self.name}", extra={"fields": {
+            "span": self.name, "status": self.status, "duration_ms": round(duration * 1000, 2), **self.attributes,
+        }})
+        return duration
+
+
+@contextmanager
+def span(name, **attributes):
+    current = Span(name, attributes)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        current.end()
+
+
+def record_usage(usage, model, purpose, current_span=None):
+    """記錄 chat completion 的 token 用量；usage 為 None (例如未回傳用量的串流) 時略過。"""
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens, model=model, purpose=purpose, type="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens, model=model, purpose=purpose, type="completion")
+    if current_span is not None:
+        current_span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+# === MongoDB 指令監聽：pymongo 在發出指令的執行緒上同步呼叫，因此 log 也帶有追蹤 ID ===
+class MongoCommandMetrics(pymongo.monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event, "ok")
+
+    def failed(self, event):
+        self._observe(event, "error")
+
+    @staticmethod
+    def _observe(event, status):
+        duration = event.duration_micros / 1e6
+        MONGO_COMMAND_DURATION.observe(duration, command=event.command_name, status=status)
+        logger.debug(f"mongo {event.command_name}", extra={"fields": {
+            "span": "mongo." + event.command_name, "status": status, "duration_ms": round(duration * 1000, 2),
+        }})
+
+
+# === 結構化 log ===
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get() or "-"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, "trace_id", "-"),
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s [%(levelname)s] [%(trace_id)s] %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+def configure_logging(level="INFO", log_format="json"):
+    """log_format 為 "json" (每行一筆 JSON) 或 "text"；與原本的 print 相同輸出到 stdout。"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(TraceIdFilter())
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # 第三方套件的 log 只保留警告以上，避免 paramiko / werkzeug 的細節淹沒應用程式的 log
+    for name in ("paramiko", "werkzeug", "urllib3", "httpx", "openai", "pymongo"):
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
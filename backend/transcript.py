@@ -0,0 +1,46 @@
+# === Assistant2 對話紀錄的壓縮：較舊的 CLI Output 以摘要取代，只保留最近幾筆完整輸出 ===
+
+# 行數與字元數都不超過此值的輸出直接保留，摘要不會比原文短
+SHORT_OUTPUT_LINES = 6
+SHORT_OUTPUT_CHARS = 400
+
+
+def add_output(messages, content):
+    """將一次指令輸出加入對話紀錄並編上步驟號碼，Assistant2 可用 {"ShowOutput": 步驟} 取回完整內容。"""
+    step = sum(1 for message in messages if "step" in message) + 1
+    messages.append({"role": "user", "content": f"[步驟 {step}] {content}", "step": step})
+    return step
+
+
+def find_output(messages, step):
+    for message in messages:
+        if message.get("step") == step:
+            return message["content"]
+    return None
+
+
+def digest_output(content, step, head_lines=2, tail_lines=2):
+    """保留標頭 (exit code / cwd)、開頭與結尾幾行，並註明原始長度。"""
+    header, _, body = content.partition("\n")
+    lines = body.splitlines()
+    if len(lines) <= SHORT_OUTPUT_LINES and len(body) <= SHORT_OUTPUT_CHARS:
+        return content
+    kept = lines[:head_lines] + ["..."] + lines[-tail_lines:] if len(lines) > head_lines + tail_lines else lines
+    return (
+        f"{header}\n"
+        f"[已摘要：原始輸出 {len(body.encode('utf-8'))} bytes / {len(lines)} 行，"
+        f"完整內容請回覆 {{\"ShowOutput\": {step}}}]\n" + "\n".join(kept)
+    )
+
+
+def compact_messages(messages, keep_recent=2):
+    """回傳要送給 GPT 的訊息列表：最近 keep_recent 筆輸出保留原文，更早的輸出改為摘要。"""
+    steps = [message["step"] for message in messages if "step" in message]
+    verbatim = set(steps[-keep_recent:]) if keep_recent > 0 else set()
+    compacted = []
+    for message in messages:
+        content = message["content"]
+        if "step" in message and message["step"] not in verbatim:
+            content = digest_output(content, message["step"])
+        compacted.append({"role": message["role"], "content": content})
+    return compacted
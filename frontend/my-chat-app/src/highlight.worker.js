@@ -0,0 +1,34 @@
+// src/highlight.worker.js
+/* eslint-env worker */
+// 在背景執行緒中以 highlight.js 為程式碼區塊上色，避免 highlightAuto 阻塞畫面。
+
+import hljs from 'highlight.js'
+
+// 未指定語言時才需要自動偵測；過長的內容（例如大量 CLI 輸出）偵測成本高且多半不是程式碼，直接略過
+const MAX_AUTO_DETECT_LENGTH = 20000;
+
+function escapeHtml(text) {
+  return text
+    .replace(/&/g, '&amp;')
+    .replace(/</g, '&lt;')
+    .replace(/>/g, '&gt;')
+    .replace(/"/g, '&quot;')
+    .replace(/'/g, '&#39;');
+}
+
+self.onmessage = ({ data }) => {
+  const { id, code, lang } = data;
+  let html;
+  try {
+    if (lang && hljs.getLanguage(lang)) {
+      html = hljs.highlight(code, { language: lang }).value;
+    } else if (code.length <= MAX_AUTO_DETECT_LENGTH) {
+      html = hljs.highlightAuto(code).value;
+    } else {
+      html = escapeHtml(code);
+    }
+  } catch (error) {
+    html = escapeHtml(code);
+  }
+  self.postMessage({ id, html });
+};
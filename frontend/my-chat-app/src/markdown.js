@@ -0,0 +1,181 @@
+// src/markdown.js
+// Assistant 訊息的 Markdown 渲染：解析結果依內容雜湊快取，程式碼區塊的語法上色交給 Web Worker。
+
+import { marked } from 'marked'
+
+// 快取的 HTML 數量上限（超過時淘汰最久未使用的項目）
+const HTML_CACHE_SIZE = 500;
+// 已上色的程式碼區塊數量上限
+const HIGHLIGHT_CACHE_SIZE = 1000;
+
+const htmlCache = new Map();
+const highlightCache = new Map();
+// 已送往 worker、尚未回覆的程式碼區塊：key => Promise
+const pendingHighlights = new Map();
+
+/**
+ * 53-bit 字串雜湊（cyrb53），用來當作快取鍵，不必保留整段 Markdown。
+ */
+export function hashString(text) {
+  let h1 = 0xdeadbeef;
+  let h2 = 0x41c6ce57;
+  for (let i = 0; i < text.length; i++) {
+    const ch = text.charCodeAt(i);
+    h1 = Math.imul(h1 ^ ch, 2654435761);
+    h2 = Math.imul(h2 ^ ch, 1597334677);
+  }
+  h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+  h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+  return (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(36) + ':' + text.length;
+}
+
+function escapeHtml(text) {
+  return text
+    .replace(/&/g, '&amp;')
+    .replace(/</g, '&lt;')
+    .replace(/>/g, '&gt;')
+    .replace(/"/g, '&quot;')
+    .replace(/'/g, '&#39;');
+}
+
+// Map 依插入順序排列：讀取時移到最後，超過上限時刪除最前面的項目
+function cacheGet(cache, key) {
+  const value = cache.get(key);
+  if (value !== undefined) {
+    cache.delete(key);
+    cache.set(key, value);
+  }
+  return value;
+}
+
+function cacheSet(cache, key, value, limit) {
+  cache.delete(key);
+  cache.set(key, value);
+  if (cache.size > limit) {
+    cache.delete(cache.keys().next().value);
+  }
+}
+
+// === 語法上色 worker ===
+let worker = null;
+let workerFailed = false;
+let nextRequestId = 0;
+const workerRequests = new Map();
+
+function getWorker() {
+  if (worker === null && !workerFailed && typeof Worker !== 'undefined') {
+    worker = new Worker(new URL('./highlight.worker.js', import.meta.url));
+    worker.onmessage = ({ data }) => {
+      const resolve = workerRequests.get(data.id);
+      workerRequests.delete(data.id);
+      if (resolve) resolve(data.html);
+    };
+    worker.onerror = (error) => {
+      // worker 無法使用時保留未上色的程式碼
+      console.error('Highlight worker error:', error);
+      workerFailed = true;
+      worker.terminate();
+      worker = null;
+      for (const resolve of workerRequests.values()) resolve(null);
+      workerRequests.clear();
+    };
+  }
+  return worker;
+}
+
+function requestHighlight(key, code, lang) {
+  if (pendingHighlights.has(key)) return pendingHighlights.get(key);
+  const highlightWorker = getWorker();
+  if (highlightWorker === null) return null;
+  const id = nextRequestId++;
+  const promise = new Promise(resolve => {
+    workerRequests.set(id, resolve);
+    highlightWorker.postMessage({ id, code, lang });
+  }).then(html => {
+    pendingHighlights.delete(key);
+    // 上色失敗時也記錄未上色的結果，避免重複送出
+    cacheSet(highlightCache, key, html !== null ? html : escapeHtml(code), HIGHLIGHT_CACHE_SIZE);
+  });
+  pendingHighlights.set(key, promise);
+  return promise;
+}
+
+// === 自訂 marked 的 renderer ===
+// 目前這次 parse 中尚未上色的程式碼區塊；為 null 時不送出上色請求（例如串流中的回覆）
+let missingHighlights = null;
+
+function renderCode(maybeCode, maybeLanguage) {
+  let code = maybeCode;
+  let lang = maybeLanguage || '';
+
+  if (typeof code === 'object' && code !== null) {
+    if (code.lang) {
+      lang = code.lang;
+    }
+    if (typeof code.text === 'string') {
+      code = code.text;
+    } else {
+      code = JSON.stringify(code);
+    }
+  }
+
+  const safeCode = typeof code === 'string' ? code : String(code);
+  const safeLang = escapeHtml(lang);
+  const key = hashString(lang + '\n' + safeCode);
+
+  // 已上色過的區塊直接使用快取；否則先顯示未上色的程式碼，上色完成後再重新渲染
+  let highlighted = cacheGet(highlightCache, key);
+  if (highlighted === undefined) {
+    highlighted = escapeHtml(safeCode);
+    if (missingHighlights !== null) {
+      const promise = requestHighlight(key, safeCode, lang);
+      if (promise) missingHighlights.push(promise);
+    }
+  }
+
+  return (
+    '<div class="code-block-container" style="position: relative; margin: 1em 0; background-color: #2d2d2d; border-radius: 5px;">' +
+      '<div class="code-block-header" style="display: flex; justify-content: space-between; align-items: center; padding: 5px 10px; background-color: #1e1e1e; border-top-left-radius: 5px; border-top-right-radius: 5px;">' +
+        '<span class="code-language" style="font-size: 0.9em; color: #fff;">' + (safeLang.toUpperCase()) + '</span>' +
+        '<button class="copy-code-button" style="font-size: 0.8em; padding: 2px 5px; background-color: #007bff; color: #fff; border: none; border-radius: 3px; cursor: pointer;" onclick="copyCode(this)">Copy</button>' +
+      '</div>' +
+      '<pre style="margin: 0; overflow-x: auto; padding: 10px;"><code class="hljs ' + safeLang + '">' + highlighted + '</code></pre>' +
+    '</div>'
+  );
+}
+
+marked.use({ renderer: { code: renderCode } });
+
+/**
+ * 將 Markdown 轉成 HTML，回傳 { html, pending }。
+ * 相同內容的結果會被快取；pending 不為 null 時表示仍有程式碼區塊在 worker 中上色，
+ * 完成後再呼叫一次即可取得上色後的 HTML。
+ * highlight 為 false 時（串流中的回覆）不快取也不送出上色請求，避免每個片段都重新上色。
+ */
+export function renderMarkdown(markdown, { highlight = true } = {}) {
+  const text = markdown || '';
+  if (!highlight) {
+    return { html: marked.parse(text), pending: null };
+  }
+
+  const key = hashString(text);
+  const cached = cacheGet(htmlCache, key);
+  if (cached !== undefined) {
+    return { html: cached, pending: null };
+  }
+
+  const missing = [];
+  let html;
+  missingHighlights = missing;
+  try {
+    html = marked.parse(text);
+  } finally {
+    missingHighlights = null;
+  }
+  if (missing.length) {
+    // 上色完成前的結果不放入快取
+    return { html, pending: Promise.all(missing) };
+  }
+  cacheSet(htmlCache, key, html, HTML_CACHE_SIZE);
+  return { html, pending: null };
+}
@@ -0,0 +1,50 @@
+// src/sse.js
+// EventSource 僅支援 GET，因此以 fetch 送出 POST 並自行解析 Server-Sent Events。
+
+/**
+ * 送出 POST 請求並逐一處理回應中的 SSE 事件。
+ * body 可為 FormData 或一般物件（以 JSON 送出）；每個事件呼叫 onEvent(event, data)。
+ */
+export async function postEventStream(url, body, onEvent) {
+  const options = { method: 'POST' };
+  if (body instanceof FormData) {
+    options.body = body;
+  } else {
+    options.body = JSON.stringify(body);
+    options.headers = { 'Content-Type': 'application/json' };
+  }
+
+  const response = await fetch(url, options);
+  if (!response.ok) {
+    throw new Error(`HTTP ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      const dataLines = [];
+      for (const line of frame.split('\n')) {
+        if (line.startsWith('event:')) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          dataLines.push(line.slice(5).trimStart());
+        }
+        // 以 ":" 開頭的 keepalive 註解直接略過
+      }
+      if (dataLines.length) {
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  }
+}